@@ -2,24 +2,39 @@
 nano.py — NanoBot (JARVIS mode)
 One file. Runs local or cloud. Carries memory via Telegram.
 
-LLM    : Gemini 1.5 Flash → Grok grok-2-1212
-Memory : state.json + Telegram SavedMessages (NANO_STATE:)
+LLM    : Qwen OAuth → Gemini 1.5 Flash → Grok grok-2-1212 (pooled clients)
+Memory : state.json snapshot + state.journal + Telegram SavedMessages (NANO_STATE:)
 PC     : subprocess / mss / PowerShell (local only)
 Agent  : DuckDuckGo idle study, system health monitor, morning briefing
 """
 
 import asyncio
+import hashlib
+import heapq
+import hmac
 import io
 import json
 import os
+import platform
+import queue
 import random
 import re
+import shutil
+import sqlite3
 import subprocess
+import sys
 import threading
-from datetime import datetime, timedelta
-from functools import wraps
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from functools import partial, wraps
 from pathlib import Path
-from typing import Callable
+from types import MappingProxyType
+from typing import Callable, Mapping
 
 # ── Config ─────────────────────────────────────────────────────────────────────
 
@@ -31,7 +46,7 @@ def _load_cfg() -> dict:
             cfg = json.loads(p.read_text(encoding="utf-8"))
         except Exception:
             pass
-    for k in ("TELEGRAM_BOT_TOKEN", "TELEGRAM_OWNER_ID",
+    for k in ("TELEGRAM_BOT_TOKEN", "TELEGRAM_OWNER_ID", "TELEGRAM_ALLOWED_IDS",
               "GEMINI_API_KEY", "GROK_API_KEY", "GROK_MODEL"):
         v = os.getenv(k)
         if v:
@@ -41,30 +56,347 @@ def _load_cfg() -> dict:
 CFG = _load_cfg()
 OWNER_ID: int = int(CFG.get("telegram_owner_id", 0))
 
+def _id_set(v) -> set[int]:
+    if isinstance(v, (str, int)):
+        v = re.split(r"[,\s]+", str(v))
+    return {int(x) for x in v or () if str(x).strip().lstrip("-").isdigit()}
+
+# Team members who may chat, search, plan and set reminders; the PC, shell
+# and admin commands stay with the owner.
+ALLOWED_IDS: set[int] = (_id_set(CFG.get("telegram_allowed_ids")) | {OWNER_ID}) - {0}
+
 # ── Environment ────────────────────────────────────────────────────────────────
 
 IS_LOCAL = Path("C:/Users/VM-openclaw").exists()
 IS_CLOUD = bool(os.getenv("PORT") or os.getenv("REPL_ID") or os.getenv("RAILWAY_ENVIRONMENT"))
 START_TIME = datetime.utcnow()
+_BOOT_T0 = time.perf_counter()
 
 # ── Logging ────────────────────────────────────────────────────────────────────
 
+# _log only enqueues; a writer thread batches lines into nano.log and rotates
+# it by size and age. log_format "json" writes JSON lines carrying extra fields.
 _LOG_FILE = Path(__file__).parent / "nano.log"
+_LOG_JSON = CFG.get("log_format", "text") == "json"
+_LOG_MAX_BYTES = int(CFG.get("log_max_bytes", 5_000_000))
+_LOG_MAX_AGE = float(CFG.get("log_rotate_hours", 24)) * 3600
+_LOG_BACKUPS = int(CFG.get("log_backups", 5))
+_log_q: queue.SimpleQueue = queue.SimpleQueue()
+_log_start_lock = threading.Lock()
+_logger: dict = {"thread": None}
+
+def _log(tag: str, msg: str = "", **fields):
+    _log_q.put((time.time(), tag, msg, fields))
+    if _logger["thread"] is None:
+        with _log_start_lock:
+            if _logger["thread"] is None:
+                _logger["thread"] = threading.Thread(target=_log_worker, name="nano-log", daemon=True)
+                _logger["thread"].start()
+
+def _log_line(ts: float, tag: str, msg: str, fields: dict) -> str:
+    stamp = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+    if _LOG_JSON:
+        return json.dumps({"ts": stamp, "tag": tag, "msg": msg, **fields},
+                          ensure_ascii=False, default=str) + "\n"
+    extra = " ".join(f"{k}={v}" for k, v in fields.items())
+    body = " ".join(x for x in (msg, extra) if x)
+    return f"[{stamp}] {tag}" + (f" | {body}" if body else "") + "\n"
+
+def _log_rotate():
+    name = _LOG_FILE.name
+    oldest = _LOG_FILE.with_name(f"{name}.{_LOG_BACKUPS}")
+    if oldest.exists():
+        oldest.unlink()
+    for i in range(_LOG_BACKUPS - 1, 0, -1):
+        src = _LOG_FILE.with_name(f"{name}.{i}")
+        if src.exists():
+            os.replace(src, _LOG_FILE.with_name(f"{name}.{i + 1}"))
+    if _LOG_BACKUPS > 0:
+        os.replace(_LOG_FILE, _LOG_FILE.with_name(f"{name}.1"))
+    else:
+        _LOG_FILE.unlink()
 
-def _log(tag: str, msg: str = ""):
-    ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    line = f"[{ts}] {tag}" + (f" | {msg}" if msg else "")
-    try:
-        with open(_LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(line + "\n")
+def _log_worker():
+    f = None
+    opened = 0.0
+    while True:
+        batch = [_log_q.get()]
+        deadline = time.monotonic() + 0.2   # gather a burst into one write
+        while len(batch) < 1000:
+            try:
+                batch.append(_log_q.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        flushed = [e for e in batch if isinstance(e, threading.Event)]
+        data = "".join(_log_line(*e) for e in batch if not isinstance(e, threading.Event))
+        try:
+            if f is None:
+                f = open(_LOG_FILE, "a", encoding="utf-8")
+                opened = time.time()
+            if data and (f.tell() + len(data) > _LOG_MAX_BYTES or time.time() - opened > _LOG_MAX_AGE):
+                f.close()
+                _log_rotate()
+                f = open(_LOG_FILE, "a", encoding="utf-8")
+                opened = time.time()
+            f.write(data)
             f.flush()
-    except Exception:
+        except Exception:
+            f = None
+        for ev in flushed:
+            ev.set()
+
+def _log_flush(timeout: float = 2.0):
+    """Block until everything logged so far is on disk (shutdown, /logs)."""
+    if _logger["thread"] is not None:
+        ev = threading.Event()
+        _log_q.put(ev)
+        ev.wait(timeout)
+
+def _log_tail(n: int = 20, tag: str | None = None, max_bytes: int = 4_000_000) -> list[str]:
+    """Last n lines (optionally whose tag starts with `tag`), read backwards in
+    blocks from the end of the file rather than loading the whole log."""
+    want = tag.lower() if tag else None
+    out: list[str] = []
+    try:
+        with open(_LOG_FILE, "rb") as f:
+            pos = f.seek(0, os.SEEK_END)
+            carry = b""
+            read = 0
+            while pos > 0 and len(out) < n and read < max_bytes:
+                step = min(8192, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step) + carry
+                read += step
+                lines = chunk.split(b"\n")
+                carry = lines.pop(0) if pos > 0 else b""
+                for raw in reversed(lines):
+                    line = raw.decode("utf-8", "replace").rstrip("\r")
+                    if line and (want is None or _log_tag(line).lower().startswith(want)):
+                        out.append(line)
+                        if len(out) >= n:
+                            break
+    except FileNotFoundError:
         pass
+    return out[::-1]
+
+def _log_tag(line: str) -> str:
+    if line.startswith("{"):
+        try:
+            return json.loads(line).get("tag", "")
+        except ValueError:
+            return ""
+    head = line.partition("] ")[2]
+    return head.partition(" | ")[0]
+
+# ── Metrics ────────────────────────────────────────────────────────────────────
+
+# In-process registry rendered in Prometheus text format at /metrics. Series
+# are keyed by (name, sorted label pairs); callback gauges are evaluated at
+# scrape time so nothing has to be kept in sync.
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_metrics_lock = threading.Lock()
+_COUNTERS: dict = {}   # (name, labels) -> float
+_HISTS: dict = {}      # (name, labels) -> [count per bucket..., +Inf, sum]
+_CALLBACKS: dict = {}  # name -> (type, fn -> {labels: value})
+_HELP: dict = {}       # name -> (type, help)
+
+def _labels(kw: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in kw.items()))
+
+def _inc(name: str, n: float = 1, **labels):
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + n
+
+def _observe(name: str, value: float, **labels):
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        h = _HISTS.get(key)
+        if h is None:
+            h = _HISTS[key] = [0] * (len(_BUCKETS) + 2)
+        for i, b in enumerate(_BUCKETS):
+            if value <= b:
+                h[i] += 1
+                break
+        else:
+            h[len(_BUCKETS)] += 1
+        h[-1] += value
+
+def _metric(name: str, kind: str, help_: str, fn: Callable | None = None):
+    """Declare a metric; fn makes it a callback read at scrape time and returns
+    a number or a {labels tuple: number} map."""
+    _HELP[name] = (kind, help_)
+    if fn is not None:
+        _CALLBACKS[name] = (kind, fn)
+
+def _fmt_labels(labels: tuple, le: str | None = None) -> str:
+    if le is not None:
+        labels = (*labels, ("le", le))
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}" if labels else ""
+
+def _metrics_text() -> str:
+    with _metrics_lock:
+        counters = dict(_COUNTERS)
+        hists = {k: list(v) for k, v in _HISTS.items()}
+    series: dict = {}
+    for (name, labels), v in counters.items():
+        series.setdefault(name, []).append(f"{name}{_fmt_labels(labels)} {v:g}")
+    for (name, labels), h in hists.items():
+        out, acc = series.setdefault(name, []), 0
+        for b, c in zip(_BUCKETS, h):
+            acc += c
+            out.append(f"{name}_bucket{_fmt_labels(labels, f'{b:g}')} {acc}")
+        acc += h[len(_BUCKETS)]
+        out.append(f"{name}_bucket{_fmt_labels(labels, '+Inf')} {acc}")
+        out.append(f"{name}_sum{_fmt_labels(labels)} {h[-1]:.6g}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {acc}")
+    for name, (_, fn) in _CALLBACKS.items():
+        try:
+            val = fn()
+        except Exception as e:
+            _log("METRICS:err", f"{name}: {e}")
+            continue
+        if not isinstance(val, dict):
+            val = {(): val}
+        series[name] = [f"{name}{_fmt_labels(l)} {v:g}" for l, v in val.items() if v is not None]
+    lines = []
+    for name in sorted(series):
+        kind, help_ = _HELP.get(name, ("untyped", ""))
+        lines += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}", *series[name]]
+    return "\n".join(lines) + "\n"
+
+_metric("nano_llm_seconds", "histogram", "LLM call latency by provider and outcome.")
+_metric("nano_llm_fallbacks_total", "counter", "Times a request moved on to another provider.")
+_metric("nano_handler_seconds", "histogram", "Telegram handler latency by handler.")
+_metric("nano_handler_errors_total", "counter", "Handlers that raised.")
+_metric("nano_search_seconds", "histogram", "Web search latency (cache misses only).")
+_metric("nano_state_save_seconds", "histogram", "State journal append / snapshot compaction time.")
+_metric("nano_state_save_bytes_total", "counter", "Bytes written by state saves.")
+_metric("nano_telegram_errors_total", "counter", "Failed Telegram API calls by call site.")
+_metric("nano_loop_lag_seconds", "histogram", "Event-loop scheduling lag (scheduler oversleep).")
+_loop_lag = {"last": 0.0}
+_metric("nano_loop_lag_last_seconds", "gauge", "Most recent event-loop lag sample.", lambda: _loop_lag["last"])
+_metric("nano_uptime_seconds", "gauge", "Seconds since start.",
+        lambda: (datetime.utcnow() - START_TIME).total_seconds())
+_metric("nano_log_queue_depth", "gauge", "Log lines waiting for the writer thread.", lambda: _log_q.qsize())
 
 # ── State ──────────────────────────────────────────────────────────────────────
 
-_state_lock = threading.Lock()
-_STATE: dict = {
+def _freeze(v):
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    if isinstance(v, (dict, MappingProxyType)):
+        return MappingProxyType({k: _freeze(x) for k, x in v.items()})
+    return v
+
+class _PMap(Mapping):
+    """Immutable map split into 64 hash buckets. set/remove copy one bucket and
+    share the rest, so large maps (pending reminders) update in O(n/64)."""
+
+    __slots__ = ("_b", "_n")
+    _W = 64
+
+    def __init__(self, items: Mapping | None = None, _b: tuple | None = None, _n: int = 0):
+        if _b is None:
+            buckets = [{} for _ in range(self._W)]
+            for k, v in (items or {}).items():
+                buckets[hash(k) % self._W][k] = _freeze(v)
+            _b = tuple(MappingProxyType(b) for b in buckets)
+            _n = sum(len(b) for b in buckets)
+        self._b, self._n = _b, _n
+
+    def __getitem__(self, key):
+        return self._b[hash(key) % self._W][key]
+
+    def __iter__(self):
+        for b in self._b:
+            yield from b
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _swap(self, i: int, bucket: dict, n: int) -> "_PMap":
+        return _PMap(_b=self._b[:i] + (MappingProxyType(bucket),) + self._b[i + 1:], _n=n)
+
+    def set(self, key, value) -> "_PMap":
+        i = hash(key) % self._W
+        b = dict(self._b[i])
+        n = self._n + (key not in b)
+        b[key] = _freeze(value)
+        return self._swap(i, b, n)
+
+    def remove(self, key) -> "_PMap":
+        i = hash(key) % self._W
+        if key not in self._b[i]:
+            return self
+        b = dict(self._b[i])
+        del b[key]
+        return self._swap(i, b, self._n - 1)
+
+def _thaw(v):
+    # json.dumps default= for frozen mappings
+    return dict(v) if isinstance(v, (MappingProxyType, _PMap)) else v
+
+def _with(m: Mapping | None, key: str, value) -> Mapping:
+    if isinstance(m, _PMap):
+        return m.set(key, value)
+    d = dict(m or {})
+    d[key] = _freeze(value)
+    return MappingProxyType(d)
+
+def _without(m: Mapping | None, key: str) -> Mapping:
+    if isinstance(m, _PMap):
+        return m.remove(key)
+    d = dict(m or {})
+    d.pop(key, None)
+    return MappingProxyType(d)
+
+class _Store:
+    """Versioned copy-on-write state.
+
+    The published root is never mutated: a write builds a new root that shares
+    every untouched value with the previous one, swaps it in under the writer
+    lock and bumps the version. Readers take the current (version, root) pair
+    with a single attribute read, so they never block writers or copy anything.
+    Values are frozen on the way in (lists → tuples, dicts → read-only
+    mappings). Every write also queues journal ops for the persistence writer.
+    """
+
+    def __init__(self, initial: dict):
+        self._lock = threading.Lock()
+        self._head = (0, _freeze(initial))
+        self._journal: list = []
+
+    @property
+    def version(self) -> int:
+        return self._head[0]
+
+    def snapshot(self) -> tuple[int, Mapping]:
+        return self._head
+
+    def get(self, key: str, default=None):
+        return self._head[1].get(key, default)
+
+    def transact(self, fn: Callable, journal: bool = True):
+        """Run fn(draft, ops) against a shallow copy of the root and publish it
+        atomically. fn stores frozen values and appends journal ops to `ops`."""
+        with self._lock:
+            version, root = self._head
+            draft, ops = dict(root), []
+            result = fn(draft, ops)
+            self._head = (version + 1, MappingProxyType(draft))
+            if journal:
+                self._journal.extend(ops)
+        return result
+
+    def drain(self) -> list:
+        with self._lock:
+            ops, self._journal = self._journal, []
+        return ops
+
+_STATE = _Store({
     "topics": [
         "AI and LLM developments",
         "Python automation tips",
@@ -74,27 +406,136 @@ _STATE: dict = {
         "Business automation tools",
         "Rust programming",
     ],
-    "knowledge": {},
     "history": [],
-    "reminders": [],
+    "reminders": _PMap(),  # str(id) -> {"id", "due" (ISO UTC), "msg", "every"?}
     "autostudy": True,
     "sysmon": True,
+    "stream": True,       # stream chat replies via message edits
     "briefing_hour": 9,   # 24h UTC for morning briefing
-}
+    "topic_studied": {},  # topic -> ISO UTC of last idle study
+    "history_summary": "",  # running summary of turns folded out of history
+})
+
+def _apply_ops(draft: dict, ops: list):
+    """Replay journal ops onto a draft root (reminders are patched in one pass)."""
+    rems = dict(draft.get("reminders") or {})
+    legacy = isinstance(draft.get("reminders"), tuple)
+    for op in ops:
+        kind = op[0]
+        if kind == "set":
+            draft[op[1]] = _freeze(op[2])
+            if op[1] == "reminders" and isinstance(draft[op[1]], Mapping):
+                rems = dict(draft[op[1]])
+        elif kind == "del":
+            draft.pop(op[1], None)
+        elif kind == "rem+":
+            rems[str(op[1]["id"])] = _freeze(op[1])
+        elif kind == "rem-":
+            rems.pop(str(op[1]), None)
+    if not legacy:
+        draft["reminders"] = _PMap(rems)
 
 def _gs(key: str, default=None):
-    with _state_lock:
-        return _STATE.get(key, default)
+    return _store(key).get(key, default)
 
 def _ss(key: str, value):
-    with _state_lock:
-        _STATE[key] = value
-
-def _state_copy() -> dict:
-    with _state_lock:
-        return json.loads(json.dumps(_STATE))
+    def tx(d, ops):
+        d[key] = _freeze(value)
+        ops.append(["set", key, d[key]])
+    _store(key).transact(tx)
+
+def _supdate(key: str, fn: Callable, default=None):
+    """Atomically replace state[key] with fn(current); returns the new value."""
+    def tx(d, ops):
+        d[key] = _freeze(fn(d.get(key, default)))
+        ops.append(["set", key, d[key]])
+        return d[key]
+    return _store(key).transact(tx)
+
+def _sdel(key: str):
+    def tx(d, ops):
+        d.pop(key, None)
+        ops.append(["del", key])
+    _store(key).transact(tx)
+
+# ── State: per-user shards ─────────────────────────────────────────────────────
+
+# The owner uses the main store above. Every other allow-listed user gets a
+# small store of their own (history, summary, stream setting) in
+# users/<id>.json: loaded on first use, written by the persist thread when it
+# changes, and dropped from memory once idle or when more than user_shards_max
+# are loaded (least recently used first). Everything else — reminders,
+# topics, knowledge, settings — stays in the main store. Handlers set _uid for
+# their task, so _gs/_ss pick the right store without being told.
+_USERS_DIR = Path(__file__).parent / "users"
+_USER_KEYS = {"history": (), "history_summary": "", "stream": True}
+_SHARD_MAX = int(CFG.get("user_shards_max", 32))
+_SHARD_IDLE = float(CFG.get("user_shard_idle_minutes", 30)) * 60
+_uid: ContextVar = ContextVar("nano_uid", default=None)
+_shards: OrderedDict = OrderedDict()   # uid -> [_Store, last use], LRU first
+_shards_lock = threading.Lock()
+_metric("nano_user_shards_loaded", "gauge", "Per-user state shards in memory.", lambda: len(_shards))
+
+def _shard_file(uid: int) -> Path:
+    return _USERS_DIR / f"{uid}.json"
+
+def _store(key: str) -> _Store:
+    uid = _uid.get()
+    if uid is None or uid == OWNER_ID or key not in _USER_KEYS:
+        return _STATE
+    now = time.monotonic()
+    with _shards_lock:
+        s = _shards.get(uid)
+        if s is None:
+            data = dict(_USER_KEYS)
+            try:
+                saved = json.loads(_shard_file(uid).read_text(encoding="utf-8"))
+                data.update((k, v) for k, v in saved.items() if k in _USER_KEYS)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                _log("STATE:shard_err", f"uid={uid} {e}")
+            s = _shards[uid] = [_Store(data), now]
+        else:
+            _shards.move_to_end(uid)
+            s[1] = now
+        _shards_evict(now)
+    return s[0]
+
+def _shards_evict(now: float):
+    # caller holds _shards_lock. Shards with unwritten changes stay until the
+    # persist thread has saved them; a shard touched in the last few seconds
+    # may still be about to get a write, so it stays too.
+    over = len(_shards) - _SHARD_MAX
+    for uid, (st, used) in list(_shards.items()):
+        idle = now - used
+        if idle > _SHARD_IDLE or (over > 0 and idle > 5):
+            if not st._journal:
+                del _shards[uid]
+                over -= 1
+        elif over <= 0:
+            break
+
+def _shards_flush():
+    """Rewrite every shard with pending changes (atomic rename, one file per user)."""
+    with _shards_lock:
+        dirty = [(uid, s[0]) for uid, s in _shards.items() if s[0]._journal]
+    for uid, st in dirty:
+        st.drain()
+        blob = json.dumps(st.snapshot()[1], ensure_ascii=False, default=_thaw).encode("utf-8")
+        path = _shard_file(uid)
+        try:
+            _USERS_DIR.mkdir(exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(blob)
+            os.replace(tmp, path)
+            _inc("nano_state_save_bytes_total", len(blob), kind="shard")
+        except Exception as e:
+            _log("STATE:shard_err", f"uid={uid} {e}")
+    with _shards_lock:
+        _shards_evict(time.monotonic())
 
-# ── LLM: Gemini 1.5 Flash → Grok ───────────────────────────────────────────────
+# ── LLM: provider registry (Qwen OAuth → Gemini 1.5 Flash → Grok) ──────────────
 
 _SYSTEM = (
     "You are Jai, a personal AI assistant — sharp, proactive, and concise like JARVIS. "
@@ -102,91 +543,565 @@ _SYSTEM = (
     "Respond in plain conversational text. No markdown unless asked. "
     "If asked to do something you can't, say so briefly and suggest an alternative."
 )
+_LLM_DOWN = (
+    "⚠️ I'm here, but my LLM brains are unavailable: Qwen (401), Gemini (Quota/404), Grok (403). "
+    "Please check your API keys and credits."
+)
+
+_QWEN_CREDS = Path.home() / ".qwen" / "oauth_creds.json"
+_qwen_cache: dict = {"mtime": None, "creds": None}
+_provider_lock = threading.Lock()
+_CLIENTS: dict = {}   # name -> (api_key, base_url, client)
 
 def _load_qwen_token() -> tuple[str, str] | None:
-    creds_path = Path.home() / ".qwen" / "oauth_creds.json"
+    """Qwen OAuth creds, re-read only when the file's mtime changes."""
     try:
-        if creds_path.exists():
-            creds = json.loads(creds_path.read_text(encoding="utf-8"))
-            url = f"https://{creds['resource_url']}/v1"
-            return creds["access_token"], url
-    except Exception:
-        pass
-    return None
-
-def ask_llm(history: list[dict], prompt: str, system: str | None = None) -> str:
-    from openai import OpenAI
-
-    sys_msg = system or _SYSTEM
-    msgs = [{"role": "system", "content": sys_msg}]
-    msgs += history[-6:]
-    msgs.append({"role": "user", "content": prompt})
-
-    # 1. Qwen OAuth (Primary)
+        mtime = _QWEN_CREDS.stat().st_mtime
+    except OSError:
+        return None
+    with _provider_lock:
+        if _qwen_cache["mtime"] != mtime:
+            creds = None
+            try:
+                raw = json.loads(_QWEN_CREDS.read_text(encoding="utf-8"))
+                creds = raw["access_token"], f"https://{raw['resource_url']}/v1"
+            except Exception as e:
+                _log("LLM:qwen", f"creds unreadable: {e}")
+            _qwen_cache.update(mtime=mtime, creds=creds)
+        return _qwen_cache["creds"]
+
+def _usable_key(key: str) -> bool:
+    return bool(key) and not key.startswith("YOUR_")
+
+# Prompt-token budget per provider (system + summary + history + prompt).
+# llm_context_tokens may be one number for all providers or a {name: n} map.
+_CTX_BUDGET = {"qwen": 6000, "gemini": 8000, "grok": 6000}
+_ctx_cfg = CFG.get("llm_context_tokens")
+if isinstance(_ctx_cfg, dict):
+    _CTX_BUDGET.update({k: int(v) for k, v in _ctx_cfg.items()})
+elif _ctx_cfg:
+    _CTX_BUDGET = dict.fromkeys(_CTX_BUDGET, int(_ctx_cfg))
+
+# Whole-request budget, hedges and failovers included. No single attempt may
+# outlive it, so it is also each provider's HTTP timeout (per read when streaming).
+_LLM_DEADLINE = float(CFG.get("llm_deadline", 8.0))
+
+def _providers() -> list[dict]:
+    """Configured providers in fallback order."""
+    out = []
     qwen = _load_qwen_token()
     if qwen:
-        token, base_url = qwen
-        try:
-            client = OpenAI(api_key=token, base_url=base_url, timeout=15.0)
-            resp = client.chat.completions.create(
-                model="qwen3-coder-plus", messages=msgs, max_tokens=600,
-            )
-            ans = resp.choices[0].message.content.strip()
-            _log("LLM:qwen", f"ok {len(ans)}c")
-            return ans
-        except Exception as e:
-            _log("LLM:qwen", f"failed: {e}")
-
-    # 2. Gemini 1.5 Flash
+        out.append({"name": "qwen", "api_key": qwen[0], "base_url": qwen[1],
+                    "model": "qwen3-coder-plus", "timeout": _LLM_DEADLINE, "budget": _CTX_BUDGET["qwen"]})
     gemini_key = CFG.get("gemini_api_key", "")
-    if gemini_key and not gemini_key.startswith("YOUR_"):
-        try:
-            client = OpenAI(
-                api_key=gemini_key,
-                base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-                timeout=20.0,
-            )
-            # Use 'gemini-1.5-flash' (confirmed available via list)
-            resp = client.chat.completions.create(
-                model="gemini-1.5-flash", messages=msgs, max_tokens=600
-            )
-            ans = resp.choices[0].message.content.strip()
-            _log("LLM:gemini", f"ok {len(ans)}c")
-            return ans
-        except Exception as e:
-            _log("LLM:gemini", f"failed: {e}")
-
-    # 3. Grok (Fallback)
+    if _usable_key(gemini_key):
+        # Use 'gemini-1.5-flash' (confirmed available via list)
+        out.append({"name": "gemini", "api_key": gemini_key,
+                    "base_url": "https://generativelanguage.googleapis.com/v1beta/openai/",
+                    "model": "gemini-1.5-flash", "timeout": _LLM_DEADLINE, "budget": _CTX_BUDGET["gemini"]})
     grok_key = CFG.get("grok_api_key", "")
-    if grok_key and not grok_key.startswith("YOUR_"):
+    if _usable_key(grok_key):
+        out.append({"name": "grok", "api_key": grok_key, "base_url": "https://api.x.ai/v1",
+                    "model": CFG.get("grok_model", "grok-2-1212"), "timeout": _LLM_DEADLINE,
+                    "budget": _CTX_BUDGET["grok"]})
+    urls = CFG.get("llm_base_urls") or {}   # {name: url}, e.g. a local stand-in for benchmarks
+    for p in out:
+        p["base_url"] = urls.get(p["name"], p["base_url"])
+    return out
+
+def _client(p: dict):
+    """Long-lived AsyncOpenAI client per provider; rebuilt only when its key or
+    URL changes (a stale pool is left to GC, since closing it needs the loop
+    that opened it)."""
+    import httpx
+    from openai import AsyncOpenAI
+
+    with _provider_lock:
+        cached = _CLIENTS.get(p["name"])
+        if cached and cached[:2] == (p["api_key"], p["base_url"]):
+            return cached[2]
+        limits = httpx.Limits(max_connections=8, max_keepalive_connections=4, keepalive_expiry=300)
+        client = AsyncOpenAI(api_key=p["api_key"], base_url=p["base_url"], timeout=p["timeout"],
+                             max_retries=0,
+                             http_client=httpx.AsyncClient(limits=limits, timeout=p["timeout"]))
+        _CLIENTS[p["name"]] = (p["api_key"], p["base_url"], client)
+    return client
+
+def _tokens(text: str) -> int:
+    # ~4 bytes/token for English; UTF-8 makes CJK ~0.75 token/char, close enough
+    return len(text.encode("utf-8")) // 4 + 1
+
+def _msg_tokens(m: Mapping) -> int:
+    return _tokens(m.get("content") or "") + 4   # role/framing overhead
+
+def _llm_messages(history: list[dict], prompt: str, system: str | None) -> list[dict]:
+    """Full prompt; _fit trims it per provider. A conversation (non-empty
+    history) also carries the running summary of turns folded out of it."""
+    msgs = [{"role": "system", "content": system or _SYSTEM}]
+    summary = _gs("history_summary", "") if history else ""
+    if summary:
+        msgs.append({"role": "system", "content": f"Earlier in this conversation (summary): {summary}"})
+    msgs += [dict(m) for m in history]
+    msgs.append({"role": "user", "content": prompt})
+    return msgs
+
+def _fit(msgs: list[dict], budget: int) -> list[dict]:
+    """Drop the oldest history turns until msgs fits budget. System messages
+    and the prompt always stay."""
+    head = [m for m in msgs[:-1] if m["role"] == "system"]
+    turns = [m for m in msgs[:-1] if m["role"] != "system"]
+    left = budget - sum(_msg_tokens(m) for m in head) - _msg_tokens(msgs[-1])
+    keep = len(turns)
+    while keep and left - _msg_tokens(turns[keep - 1]) >= 0:
+        keep -= 1
+        left -= _msg_tokens(turns[keep])
+    if keep < len(turns) and turns[keep]["role"] == "assistant":
+        keep += 1   # don't open on an orphaned reply
+    return head + turns[keep:] + msgs[-1:]
+
+# Per-provider health: a consecutive-failure breaker that half-opens after a
+# cooldown, EWMA latency/error rate for routing, and a latency window whose p95
+# sets the hedge deadline.
+_BREAKER_FAILS = int(CFG.get("llm_breaker_fails", 3))
+_BREAKER_COOLDOWN = float(CFG.get("llm_breaker_cooldown", 60))
+_HEDGE = bool(CFG.get("llm_hedge", True))
+_HEDGE_AFTER = float(CFG.get("llm_hedge_after", 3.0))   # until we have p95 samples
+_HEALTH: dict = {}
+
+def _health(name: str) -> dict:
+    # caller holds _provider_lock
+    h = _HEALTH.get(name)
+    if h is None:
+        h = _HEALTH[name] = {"fails": 0, "opened": 0.0, "ewma_ms": None, "err": 0.0,
+                             "lat": deque(maxlen=64)}
+    return h
+
+def _breaker(h: dict) -> str:
+    if h["fails"] < _BREAKER_FAILS:
+        return "closed"
+    if time.monotonic() - h["opened"] >= _BREAKER_COOLDOWN:
+        return "half-open"
+    return "open"
+
+def _route() -> list[dict]:
+    """Providers to try, best first. Open breakers are skipped; a half-open one
+    is tried first as the probe (hedging covers it) and its cooldown restarts,
+    so at most one probe goes out per cooldown window."""
+    ranked = []
+    provs = _providers()
+    now = time.monotonic()
+    with _provider_lock:
+        for i, p in enumerate(provs):
+            h = _health(p["name"])
+            state = _breaker(h)
+            if state == "open":
+                continue
+            if state == "half-open":
+                h["opened"] = now
+                ranked.append((0, 0.0, i, p))
+                continue
+            score = (h["ewma_ms"] or 0.0) * (1 + 4 * h["err"])
+            ranked.append((1, score, i, p))
+    ranked.sort(key=lambda t: t[:3])
+    return [t[3] for t in ranked]
+
+def _record(name: str, ok: bool | None, ms: float | None = None, err: Exception | None = None):
+    """ok=None records latency only (a hedge loser cut short after `ms`)."""
+    fatal = getattr(err, "status_code", None) in (401, 403)
+    if ms is not None:
+        _observe("nano_llm_seconds", ms / 1000, provider=name,
+                 outcome="cancelled" if ok is None else "ok" if ok else "error")
+    with _provider_lock:
+        h = _health(name)
+        if ms is not None:
+            h["ewma_ms"] = ms if h["ewma_ms"] is None else 0.7 * h["ewma_ms"] + 0.3 * ms
+            h["lat"].append(ms)
+        if ok is None:
+            return
+        h["err"] = 0.8 * h["err"] + (0.0 if ok else 0.2)
+        if ok:
+            h["fails"] = 0
+            return
+        h["fails"] = max(h["fails"] + 1, _BREAKER_FAILS if fatal else 0)
+        if h["fails"] >= _BREAKER_FAILS:
+            h["opened"] = time.monotonic()
+    if fatal or h["fails"] == _BREAKER_FAILS:
+        _log(f"LLM:{name}", "breaker open")
+
+def _hedge_delay(name: str) -> float:
+    with _provider_lock:
+        lat = sorted(_health(name)["lat"])
+    if len(lat) < 5:
+        return _HEDGE_AFTER
+    p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))] / 1000
+    return min(max(p95, 0.5), _LLM_DEADLINE / 2)   # leave the backup time to answer
+
+def _llm_health_lines() -> list[str]:
+    lines = []
+    with _provider_lock:
+        for name, h in _HEALTH.items():
+            ms = f"{h['ewma_ms']:.0f}ms" if h["ewma_ms"] is not None else "—"
+            lines.append(f"  {name}: {_breaker(h)} · {ms} · err {h['err'] * 100:.0f}%")
+    return lines
+
+# ── LLM: response cache ────────────────────────────────────────────────────────
+
+# Content-addressed on (system, trimmed history, prompt, model chain); TTL +
+# LRU with entry and character bounds, optionally persisted next to state.json.
+_CACHE_FILE = Path(__file__).parent / "llm_cache.json"
+_CACHE_TTL = float(CFG.get("llm_cache_ttl", 3600))
+_CACHE_TTL_RESEARCH = float(CFG.get("llm_cache_ttl_research", 6 * 3600))
+_CACHE_MAX = int(CFG.get("llm_cache_max", 500))
+_CACHE_MAX_CHARS = int(CFG.get("llm_cache_max_chars", 2_000_000))
+_CACHE_PERSIST = bool(CFG.get("llm_cache_persist", True))
+_cache_lock = threading.Lock()
+_CACHE: OrderedDict = OrderedDict()   # key -> (expires epoch, answer)
+_cache_stats = {"hit": 0, "miss": 0, "shared": 0, "chars": 0, "dirty": False, "saved": 0.0}
+_INFLIGHT: dict = {}                  # key -> asyncio.Task (singleflight)
+_metric("nano_llm_cache_total", "counter", "LLM response cache lookups by result.",
+        lambda: {(("result", k),): _cache_stats[k] for k in ("hit", "miss", "shared")})
+_metric("nano_llm_inflight", "gauge", "Distinct LLM requests in flight.", lambda: len(_INFLIGHT))
+
+def _cache_key(msgs: list[dict]) -> str:
+    ps = _providers()
+    fitted = _fit(msgs, max((p["budget"] for p in ps), default=0))
+    blob = json.dumps([fitted, [p["model"] for p in ps]],
+                      ensure_ascii=False, sort_keys=True, default=_thaw)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def _cache_drop(key: str):
+    # caller holds _cache_lock
+    _, ans = _CACHE.pop(key)
+    _cache_stats["chars"] -= len(ans)
+
+def _cache_get(key: str) -> str | None:
+    with _cache_lock:
+        entry = _CACHE.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            _cache_drop(key)
+            return None
+        _CACHE.move_to_end(key)
+        _cache_stats["hit"] += 1
+        return entry[1]
+
+def _cache_put(key: str, ans: str, ttl: float):
+    if ans == _LLM_DOWN or not ans or ttl <= 0:
+        return
+    with _cache_lock:
+        if key in _CACHE:
+            _cache_drop(key)
+        _CACHE[key] = (time.time() + ttl, ans)
+        _cache_stats["chars"] += len(ans)
+        while _CACHE and (len(_CACHE) > _CACHE_MAX or _cache_stats["chars"] > _CACHE_MAX_CHARS):
+            _cache_drop(next(iter(_CACHE)))
+        _cache_stats["dirty"] = True
+
+def _cache_save(force: bool = False):
+    if not _CACHE_PERSIST or not _cache_stats["dirty"]:
+        return
+    if not force and time.time() - _cache_stats["saved"] < 60:
+        return
+    now = time.time()
+    with _cache_lock:
+        data = {k: v for k, v in _CACHE.items() if v[0] > now}
+        _cache_stats["dirty"] = False
+        _cache_stats["saved"] = now
+    try:
+        tmp = _CACHE_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, _CACHE_FILE)
+    except Exception as e:
+        _log("CACHE:save_err", str(e))
+
+def _cache_load():
+    if not _CACHE_PERSIST or not _CACHE_FILE.exists():
+        return
+    try:
+        data = json.loads(_CACHE_FILE.read_text(encoding="utf-8"))
+    except Exception as e:
+        _log("CACHE:load_err", str(e))
+        return
+    now = time.time()
+    for key, (exp, ans) in sorted(data.items(), key=lambda kv: kv[1][0]):
+        if exp > now:
+            _cache_put(key, ans, exp - now)
+    _cache_stats["dirty"] = False
+    _log("CACHE:loaded", f"{len(_CACHE)} entries")
+
+async def _ask_one(p: dict, msgs: list[dict]) -> str:
+    t0 = time.monotonic()
+    msgs = _fit(msgs, p["budget"])
+    try:
+        resp = await _client(p).chat.completions.create(
+            model=p["model"], messages=msgs, max_tokens=600,
+        )
+        ans = resp.choices[0].message.content.strip()
+    except asyncio.CancelledError:
+        # Lost a hedge race: not a failure, but it was at least this slow.
+        _record(p["name"], None, (time.monotonic() - t0) * 1000)
+        raise
+    except Exception as e:
+        ms = (time.monotonic() - t0) * 1000
+        _log(f"LLM:{p['name']}", f"failed: {e}", ms=round(ms))
+        _record(p["name"], False, ms, e)
+        raise
+    ms = (time.monotonic() - t0) * 1000
+    _record(p["name"], True, ms)
+    _log(f"LLM:{p['name']}", f"ok {len(ans)}c", ms=round(ms), tok=sum(map(_msg_tokens, msgs)))
+    return ans
+
+async def ask_llm_async(history: list[dict], prompt: str, system: str | None = None,
+                        ttl: float | None = None) -> str:
+    """Cached, coalesced completion: identical concurrent requests share one
+    upstream call, which keeps running even if the caller that started it is
+    cancelled. ttl=0 bypasses the cache."""
+    ttl = _CACHE_TTL if ttl is None else ttl
+    msgs = _llm_messages(history, prompt, system)
+    if ttl <= 0:
+        return await _ask_routed(msgs)
+    key = _cache_key(msgs)
+    hit = _cache_get(key)
+    if hit is not None:
+        return hit
+    task = _INFLIGHT.get(key)
+    if task:
+        _cache_stats["shared"] += 1
+    else:
+        _cache_stats["miss"] += 1
+        task = _INFLIGHT[key] = asyncio.create_task(_ask_routed(msgs))
+
+        def _done(t: asyncio.Task):
+            _INFLIGHT.pop(key, None)
+            if not t.cancelled() and not t.exception():
+                _cache_put(key, t.result(), ttl)
+        task.add_done_callback(_done)
+    return await asyncio.shield(task)
+
+async def _ask_routed(msgs: list[dict]) -> str:
+    """Route to the best healthy provider. A failure fails over immediately; with
+    hedging on, a provider that hasn't answered by its p95 gets a backup racing
+    it and the first answer wins."""
+    queue = _route()
+    running: dict = {}
+    deadline = time.monotonic() + _LLM_DEADLINE
+
+    def launch():
+        p = queue.pop(0)
+        running[asyncio.create_task(_ask_one(p, msgs))] = p
+
+    if queue:
+        launch()
+    try:
+        while running:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                _log("LLM:deadline", f"{_LLM_DEADLINE:.0f}s")
+                break
+            wait = left
+            if _HEDGE and queue:
+                newest = list(running.values())[-1]
+                wait = min(left, _hedge_delay(newest["name"]))
+            done, _ = await asyncio.wait(running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if queue:
+                    slow = list(running.values())[-1]["name"]
+                    _log("LLM:hedge", f"{slow} → {queue[0]['name']}")
+                    _inc("nano_llm_fallbacks_total", reason="hedge", provider=slow)
+                    launch()
+                continue
+            for t in done:
+                p = running.pop(t)
+                if not t.exception():
+                    return t.result()
+                if queue:
+                    _inc("nano_llm_fallbacks_total", reason="failover", provider=p["name"])
+            if queue and (not running or _HEDGE):
+                launch()
+    finally:
+        for t in running:
+            t.cancel()
+    return _LLM_DOWN
+
+async def _stream_open(p: dict, msgs: list[dict]):
+    """Open a stream on p and wait for its first token."""
+    t0 = time.monotonic()
+    stream = None
+    try:
+        stream = await _client(p).chat.completions.create(
+            model=p["model"], messages=_fit(msgs, p["budget"]), max_tokens=600, stream=True,
+        )
+        chunks = aiter(stream)
+        async for chunk in chunks:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                break
+        else:
+            raise ValueError("empty stream")
+    except BaseException as e:
+        ms = (time.monotonic() - t0) * 1000
+        if isinstance(e, asyncio.CancelledError):
+            _record(p["name"], None, ms)
+        elif isinstance(e, Exception):
+            _log(f"LLM:{p['name']}", f"stream failed: {e}", ms=round(ms))
+            _record(p["name"], False, ms, e)
+        await _stream_close(stream)
+        raise
+    _log(f"LLM:{p['name']}", "first token", ms=round((time.monotonic() - t0) * 1000))
+    return stream, chunks, delta, t0
+
+async def _stream_close(stream):
+    if stream is not None:
         try:
-            client = OpenAI(api_key=grok_key, base_url="https://api.x.ai/v1", timeout=20.0)
-            resp = client.chat.completions.create(
-                model=CFG.get("grok_model", "grok-2-1212"),
-                messages=msgs, max_tokens=600,
-            )
-            ans = resp.choices[0].message.content.strip()
-            _log("LLM:grok", f"ok {len(ans)}c")
-            return ans
-        except Exception as e:
-            _log("LLM:grok", f"failed: {e}")
+            await stream.close()
+        except Exception:
+            pass
 
-    return "⚠️ I'm here, but my LLM brains are unavailable: Qwen (401), Gemini (Quota/404), Grok (403). Please check your API keys and credits."
+async def ask_llm_stream(history: list[dict], prompt: str, system: str | None = None):
+    """Yield reply text as it streams. Until the first token arrives providers
+    are hedged and failed over as in _ask_routed, under the same deadline;
+    after that a broken stream is reported inline."""
+    msgs = _llm_messages(history, prompt, system)
+    key = _cache_key(msgs) if _CACHE_TTL > 0 else None
+    if key:
+        hit = _cache_get(key)
+        if hit is not None:
+            yield hit
+            return
+        _cache_stats["miss"] += 1
+    queue = _route()
+    running: dict = {}
+    deadline = time.monotonic() + _LLM_DEADLINE
+    won, spare = None, []
+
+    def launch():
+        p = queue.pop(0)
+        running[asyncio.create_task(_stream_open(p, msgs))] = p
+
+    if queue:
+        launch()
+    try:
+        while running and not won:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                _log("LLM:deadline", f"{_LLM_DEADLINE:.0f}s to first token")
+                break
+            wait = left
+            if _HEDGE and queue:
+                newest = list(running.values())[-1]
+                wait = min(left, _hedge_delay(newest["name"]))
+            done, _ = await asyncio.wait(running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if queue:
+                    slow = list(running.values())[-1]["name"]
+                    _log("LLM:hedge", f"{slow} → {queue[0]['name']}")
+                    _inc("nano_llm_fallbacks_total", reason="hedge", provider=slow)
+                    launch()
+                continue
+            for t in done:
+                p = running.pop(t)
+                if t.exception():
+                    if queue:
+                        _inc("nano_llm_fallbacks_total", reason="failover", provider=p["name"])
+                elif won:
+                    spare.append(t.result()[0])   # tied on the first token
+                else:
+                    won = (p, *t.result())
+            if not won and queue and (not running or _HEDGE):
+                launch()
+    finally:
+        for t in running:
+            t.cancel()
+        for s in spare:
+            await _stream_close(s)
+    if not won:
+        yield _LLM_DOWN
+        return
+    p, stream, chunks, first, t0 = won
+    parts = [first]
+    try:
+        yield first
+        async for chunk in chunks:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+    except Exception as e:
+        _log(f"LLM:{p['name']}", f"stream failed: {e}")
+        _record(p["name"], False, (time.monotonic() - t0) * 1000, e)
+        yield "\n⚠️ (reply cut off)"
+        return
+    finally:
+        await _stream_close(stream)
+    ans = "".join(parts).strip()
+    _record(p["name"], True)   # whole-stream time would skew the hedge p95
+    _observe("nano_llm_seconds", time.monotonic() - t0, provider=p["name"], outcome="streamed")
+    _log(f"LLM:{p['name']}", f"ok {len(ans)}c streamed", ms=round((time.monotonic() - t0) * 1000))
+    if key:
+        _cache_put(key, ans, _CACHE_TTL)
 
 # ── Auth guard ─────────────────────────────────────────────────────────────────
 
-def owner_only(fn: Callable) -> Callable:
+def _guard(fn: Callable, allowed: Callable[[int], bool]) -> Callable:
     @wraps(fn)
     async def _w(update, context, *a, **k):
         uid = getattr(getattr(update, "effective_user", None), "id", None)
-        if uid != OWNER_ID:
-            _log("AUTH:deny", f"uid={uid}")
+        if uid is None or not allowed(uid):
+            _log("AUTH:deny", f"uid={uid}", handler=fn.__name__)
             if getattr(update, "effective_message", None):
-                await update.effective_message.reply_text("⛔ Not authorised.")
+                await _reply(update, "⛔ Not authorised.", site="auth")
             return
-        return await fn(update, context, *a, **k)
+        token = _uid.set(uid)   # selects this user's state shard for the task
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, context, *a, **k)
+        except Exception as e:
+            _inc("nano_handler_errors_total", handler=fn.__name__, error=type(e).__name__)
+            if type(e).__module__.startswith("telegram"):
+                _inc("nano_telegram_errors_total", site=fn.__name__)
+            raise
+        finally:
+            _observe("nano_handler_seconds", time.perf_counter() - t0, handler=fn.__name__)
+            _uid.reset(token)
     return _w
 
+def owner_only(fn: Callable) -> Callable:
+    return _guard(fn, lambda uid: uid == OWNER_ID)
+
+def member_only(fn: Callable) -> Callable:
+    # looked up per call, so OWNER_ID / ALLOWED_IDS changes after import count
+    return _guard(fn, lambda uid: uid == OWNER_ID or uid in ALLOWED_IDS)
+
+# Sliding one-hour windows per user; the owner is not limited.
+_QUOTA = {"llm": int(CFG.get("user_llm_per_hour", 60)),
+          "search": int(CFG.get("user_search_per_hour", 20))}
+_quota_log: dict = {}   # (uid, kind) -> deque of call times
+_metric("nano_quota_rejections_total", "counter", "Requests refused by per-user hourly quotas.")
+
+def _quota_wait(kind: str) -> float:
+    """Record one call for the current user; seconds to wait if over quota."""
+    uid = _uid.get()
+    limit = _QUOTA[kind]
+    if uid is None or uid == OWNER_ID or limit <= 0:
+        return 0.0
+    now = time.monotonic()
+    q = _quota_log.setdefault((uid, kind), deque())
+    while q and now - q[0] > 3600:
+        q.popleft()
+    if len(q) >= limit:
+        return 3600 - (now - q[0])
+    q.append(now)
+    return 0.0
+
+async def _over_quota(update, kind: str) -> bool:
+    wait = _quota_wait(kind)
+    if wait:
+        _inc("nano_quota_rejections_total", kind=kind)
+        await _reply(update, f"⛔ {kind.upper()} limit reached ({_QUOTA[kind]}/hour). "
+                             f"Try again in {int(wait // 60) + 1}m.", site="quota")
+    return bool(wait)
+
 # ── Shell guard ────────────────────────────────────────────────────────────────
 
 _BLOCKED = {
@@ -228,299 +1143,2050 @@ def _shell(cmd: str, timeout: int = 12) -> str:
     except Exception as e:
         return f"Error: {e}"
 
-def _screenshot() -> bytes | None:
+# mss handles are bound to the thread that opened them, so one long-lived
+# grabber lives on a dedicated single-thread executor.
+_SS_MAX_WIDTH = int(CFG.get("ss_max_width", 1600))
+_SS_QUALITY = int(CFG.get("ss_quality", 70))
+_SS_FORMAT = "WEBP" if str(CFG.get("ss_format", "jpeg")).lower() == "webp" else "JPEG"
+_ss_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nano-ss")
+_grab: dict = {"sct": None}
+
+def _grabber():
+    # only called on the _ss_pool thread
+    if _grab["sct"] is None:
+        import mss
+        _grab["sct"] = mss.mss()
+    return _grab["sct"]
+
+def _monitors() -> list[dict]:
+    return _grabber().monitors
+
+def _screenshot(monitor: int = 1, region: tuple[int, int, int, int] | None = None,
+                full: bool = False) -> tuple[bytes, str] | None:
+    """Grab a monitor (0 = all) or a region of it → (bytes, file extension).
+    Downscaled to ss_max_width and JPEG/WebP-encoded unless `full`, which
+    returns lossless full-resolution PNG."""
     if not IS_LOCAL:
         return None
     try:
-        import mss, mss.tools
-        with mss.mss() as sct:
-            img = sct.grab(sct.monitors[0])
-            buf = io.BytesIO()
-            mss.tools.to_png(img.rgb, img.size, output=buf)
-            return buf.getvalue()
-    except Exception:
+        import mss.tools
+        mons = _monitors()
+        mon = mons[monitor if monitor < len(mons) else 1 if len(mons) > 1 else 0]
+        box = mon
+        if region:
+            x, y, w, h = region
+            w, h = min(w, mon["width"] - x), min(h, mon["height"] - y)
+            if x < 0 or y < 0 or w <= 0 or h <= 0:
+                return None
+            box = {"left": mon["left"] + x, "top": mon["top"] + y, "width": w, "height": h}
+        img = _grabber().grab(box)
+        try:
+            from PIL import Image
+        except ImportError:
+            full = True   # no Pillow: fall back to mss's PNG encoder
+        if full:
+            return mss.tools.to_png(img.rgb, img.size), "png"
+        im = Image.frombytes("RGB", img.size, img.bgra, "raw", "BGRX")
+        if im.width > _SS_MAX_WIDTH:
+            im.thumbnail((_SS_MAX_WIDTH, im.height), Image.BILINEAR, reducing_gap=2.0)
+        buf = io.BytesIO()
+        im.save(buf, format=_SS_FORMAT, quality=_SS_QUALITY)
+        return buf.getvalue(), _SS_FORMAT.lower().replace("jpeg", "jpg")
+    except Exception as e:
+        _log("SS:err", str(e))
+        _grab["sct"] = None   # display layout may have changed; reopen next time
         return None
 
+# ── Files: /ls pages and /find index ───────────────────────────────────────────
+
+# Directory listings come from os.scandir and are cached per directory until its
+# mtime changes (entries added, removed or renamed). The /find index walks the
+# root through the same cache, so a refresh only re-lists directories that
+# changed. File sizes/mtimes in a cached listing can lag until then.
+_FILES_ROOT = Path(CFG.get("files_root", "C:/Users/VM-openclaw/EliteBook"))
+_LS_PAGE = int(CFG.get("ls_page", 25))
+_INDEX_EVERY = float(CFG.get("index_refresh", 300))
+_INDEX_SKIP = set(CFG.get("index_skip", [".git", "node_modules", "__pycache__", ".venv", "$RECYCLE.BIN"]))
+_DIRS: dict = {}   # dir path -> (st_mtime_ns, [(name, is_dir, size, mtime)])
+_INDEX: dict = {"files": [], "at": 0.0, "dirs": 0}   # files: (rel path, size, mtime)
+_index_lock = threading.Lock()
+_ls_tokens: OrderedDict = OrderedDict()   # token -> path (callback_data is capped at 64 bytes)
+
+def _scan_dir(path: str) -> list:
+    mtime = os.stat(path).st_mtime_ns
+    hit = _DIRS.get(path)
+    if hit and hit[0] == mtime:
+        return hit[1]
+    out = []
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                is_dir = e.is_dir(follow_symlinks=False)
+                st = e.stat(follow_symlinks=False)   # free on Windows: comes with the listing
+            except OSError:
+                continue
+            out.append((e.name, is_dir, 0 if is_dir else st.st_size, st.st_mtime))
+    out.sort(key=lambda x: (not x[1], x[0].lower()))
+    _DIRS[path] = (mtime, out)
+    return out
+
+def _index_refresh():
+    if not _index_lock.acquire(blocking=False):
+        return   # a refresh is already running
+    try:
+        t0 = time.perf_counter()
+        root = str(_FILES_ROOT.resolve())
+        files, seen, stack = [], set(), [root]
+        while stack:
+            d = stack.pop()
+            try:
+                entries = _scan_dir(d)
+            except OSError:
+                continue
+            seen.add(d)
+            rel = os.path.relpath(d, root)
+            rel = "" if rel == "." else rel + os.sep
+            for name, is_dir, size, mtime in entries:
+                if is_dir:
+                    if name not in _INDEX_SKIP:
+                        stack.append(os.path.join(d, name))
+                else:
+                    files.append((rel + name, size, mtime))
+        for d in [d for d in _DIRS if d not in seen]:
+            _DIRS.pop(d, None)
+        _INDEX.update(files=files, at=time.time(), dirs=len(seen))
+        _log("FILES:index", f"{len(files)} files in {len(seen)} dirs",
+             ms=round((time.perf_counter() - t0) * 1000))
+    finally:
+        _index_lock.release()
+
+def _find(pattern: str, limit: int = 30) -> tuple[list, int]:
+    """Glob (`*.pdf`, `report_??.xlsx`) against file names, else a substring of
+    the relative path; case-insensitive, newest first."""
+    import fnmatch
+    pat = pattern.lower()
+    if any(c in pat for c in "*?["):
+        rx = re.compile(fnmatch.translate(pat))
+        hits = [f for f in _INDEX["files"] if rx.match(os.path.basename(f[0]).lower())]
+    else:
+        hits = [f for f in _INDEX["files"] if pat in f[0].lower()]
+    hits.sort(key=lambda f: -f[2])
+    return hits[:limit], len(hits)
+
+def _ls_resolve(arg: str | None) -> Path | None:
+    root = _FILES_ROOT.resolve()
+    p = Path(arg) if arg else root
+    if not p.is_absolute():
+        p = root / p
+    p = p.resolve()
+    return p if p == root or p.is_relative_to(root) else None
+
+def _ls_token(path: Path) -> str:
+    tok = hashlib.sha1(str(path).encode("utf-8")).hexdigest()[:12]
+    _ls_tokens[tok] = path
+    _ls_tokens.move_to_end(tok)
+    while len(_ls_tokens) > 512:
+        _ls_tokens.popitem(last=False)
+    return tok
+
+def _human(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+def _ls_render(path: Path, page: int):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    entries = _scan_dir(str(path))
+    pages = max(1, -(-len(entries) // _LS_PAGE))
+    page = min(max(page, 0), pages - 1)
+    lines = [f"📂 {path}  ({len(entries)} items, page {page + 1}/{pages})", ""]
+    for name, is_dir, size, mtime in entries[page * _LS_PAGE:(page + 1) * _LS_PAGE]:
+        if is_dir:
+            lines.append(f"📁 {name}/")
+        else:
+            lines.append(f"📄 {name}  · {_human(size)} · {datetime.fromtimestamp(mtime):%Y-%m-%d %H:%M}")
+    tok = _ls_token(path)
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("◀️ Prev", callback_data=f"ls:{tok}:{page - 1}"))
+    if path != _FILES_ROOT.resolve():
+        row.append(InlineKeyboardButton("⬆️ Up", callback_data=f"ls:{_ls_token(path.parent)}:0"))
+    if page + 1 < pages:
+        row.append(InlineKeyboardButton("Next ▶️", callback_data=f"ls:{tok}:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([row]) if row else None
+
+# ── System metrics sampler ─────────────────────────────────────────────────────
+
+# Sampled in-process every few seconds (/proc on Linux, kernel32 on Windows)
+# into a one-hour ring buffer; /status, /sysinfo and sysmon read from it.
+_SAMPLE_SECS = float(CFG.get("sysmon_sample_secs", 5))
+_SAMPLES: deque = deque(maxlen=max(1, int(3600 / _SAMPLE_SECS)))
+_DISK_ROOT = "C:\\" if os.name == "nt" else "/"
+_cpu_prev: dict = {"t": None}
+
+def _cpu_times() -> tuple[float, float] | None:
+    """(idle, total) CPU time counters since boot."""
+    if sys.platform.startswith("linux"):
+        with open("/proc/stat", encoding="ascii") as f:
+            vals = [float(x) for x in f.readline().split()[1:9]]
+        return vals[3] + vals[4], sum(vals)   # idle + iowait
+    if os.name == "nt":
+        import ctypes
+        idle, kernel, user = ctypes.c_ulonglong(), ctypes.c_ulonglong(), ctypes.c_ulonglong()
+        ctypes.windll.kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user))
+        return float(idle.value), float(kernel.value + user.value)   # kernel time includes idle
+    return None
+
+def _mem_bytes() -> tuple[int, int] | None:
+    """(used, total) physical memory."""
+    if sys.platform.startswith("linux"):
+        info = {}
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                k, _, v = line.partition(":")
+                info[k] = int(v.split()[0]) * 1024
+        total = info["MemTotal"]
+        return total - info.get("MemAvailable", info.get("MemFree", 0)), total
+    if os.name == "nt":
+        import ctypes
+
+        class _MemStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong)] + [
+                (n, ctypes.c_ulonglong) for n in ("total", "avail", "tpage", "apage", "tvirt", "avirt", "aext")
+            ]
+
+        st = _MemStatus()
+        st.dwLength = ctypes.sizeof(st)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(st))
+        return st.total - st.avail, st.total
+    return None
+
+def _sample() -> dict:
+    now = _cpu_times()
+    prev, _cpu_prev["t"] = _cpu_prev["t"], now
+    cpu = None
+    if now and prev and now[1] > prev[1]:
+        cpu = round(100 * (1 - (now[0] - prev[0]) / (now[1] - prev[1])), 1)
+    elif not now and hasattr(os, "getloadavg"):
+        cpu = round(min(100.0, os.getloadavg()[0] / (os.cpu_count() or 1) * 100), 1)
+    s = {"ts": time.time(), "cpu": cpu}
+    mem = _mem_bytes()
+    if mem:
+        s.update(mem=round(mem[0] / mem[1] * 100, 1), mem_used=mem[0], mem_total=mem[1])
+    du = shutil.disk_usage(_DISK_ROOT)
+    s.update(disk=round(du.used / du.total * 100, 1), disk_used=du.used, disk_free=du.free)
+    return s
+
+async def _sample_tick():
+    _SAMPLES.append(_sample())
+
 def _sysinfo_raw() -> dict:
-    """Returns dict with cpu%, mem%, disk% (Windows only)."""
-    if not IS_LOCAL:
+    """Latest cpu%, mem%, disk% from the sampler ({} before the first sample)."""
+    if not _SAMPLES:
         return {}
+    s = _SAMPLES[-1]
+    return {k: s[k] for k in ("cpu", "mem", "disk") if s.get(k) is not None}
+
+def _window(metric: str, secs: float) -> list[float]:
+    cutoff = time.time() - secs
+    return [s[metric] for s in reversed(_SAMPLES) if s["ts"] >= cutoff and s.get(metric) is not None]
+
+# ── Work queue (LLM / search admission) ────────────────────────────────────────
+
+class _Busy(Exception):
+    pass
+
+class _WorkQueue:
+    """Admission control for slow work: `workers` jobs run at once and up to
+    `depth` wait, interactive (prio 0) ahead of background (prio 1). Beyond
+    that, callers get _Busy instead of piling up."""
+
+    def __init__(self, workers: int, depth: int):
+        self.workers, self.depth = workers, depth
+        self.free = workers
+        self.waiters: list = []   # heap of [prio, seq, future]
+        self._seq = 0
+
+    async def acquire(self, prio: int = 0, on_queued: Callable | None = None):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        if len(self.waiters) >= self.depth:
+            raise _Busy()
+        self._seq += 1
+        entry = [prio, self._seq, asyncio.get_running_loop().create_future()]
+        heapq.heappush(self.waiters, entry)
+        try:
+            if on_queued:
+                await on_queued(sum(1 for w in self.waiters if w[:2] <= entry[:2]))
+            await entry[2]
+        except BaseException:
+            # cancelled, or on_queued failed: never leave a dead waiter behind
+            if entry[2].done() and not entry[2].cancelled():
+                self.release()   # slot was handed over just as we bailed out
+            else:
+                entry[2].cancel()
+                if entry in self.waiters:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+            raise
+
+    def release(self):
+        while self.waiters:
+            fut = heapq.heappop(self.waiters)[2]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.free += 1
+
+_WORK = _WorkQueue(int(CFG.get("llm_workers", 3)), int(CFG.get("llm_queue_max", 16)))
+_metric("nano_work_queue", "gauge", "LLM/search work queue slots.",
+        lambda: {(("state", "busy"),): _WORK.workers - _WORK.free, (("state", "waiting"),): len(_WORK.waiters)})
+
+@asynccontextmanager
+async def _work_slot(update=None, prio: int = 0):
+    """Hold an LLM/search slot; tells the user their place when they have to wait."""
+    async def queued(pos: int):
+        if update is not None and getattr(update, "effective_message", None):
+            await _reply(update, f"⏳ Busy, queued #{pos}", site="queued")
+    await _WORK.acquire(prio, queued)
     try:
-        ps = (
-            'powershell -NoProfile -c "'
-            '$cpu=[math]::Round((Get-CimInstance Win32_Processor | Measure-Object -Property LoadPercentage -Average).Average,1);'
-            '$os=Get-CimInstance Win32_OperatingSystem;'
-            '$mem=[math]::Round(($os.TotalVisibleMemorySize-$os.FreePhysicalMemory)/$os.TotalVisibleMemorySize*100,1);'
-            '$disk=Get-PSDrive C|Select-Object Used,Free;'
-            '$total=$disk.Used+$disk.Free;'
-            '$diskp=[math]::Round($disk.Used/$total*100,1);'
-            'Write-Output \"$cpu $mem $diskp\""'
-        )
-        r = subprocess.run(ps, shell=True, capture_output=True, text=True, timeout=10)
-        parts = r.stdout.strip().split()
-        if len(parts) == 3:
-            return {"cpu": float(parts[0]), "mem": float(parts[1]), "disk": float(parts[2])}
-    except Exception:
-        pass
-    return {}
+        yield
+    finally:
+        _WORK.release()
+
+_BUSY_MSG = "🚦 Too many requests in flight — try again in a moment."
+
+# ── Conversation memory ────────────────────────────────────────────────────────
+
+# history holds recent turns up to history_tokens and history_max entries; once
+# it grows past either, the oldest turns are folded into history_summary by a
+# background LLM call until about half of both is left. Only past twice
+# history_max (folding can't keep up or can't run) are turns dropped unsummarised.
+_HISTORY_TOKENS = int(CFG.get("history_tokens", 3000))
+_HISTORY_MAX = int(CFG.get("history_max", 40))
+_HISTORY_CAP = 2 * _HISTORY_MAX
+_fold: dict = {}   # uid -> running fold task
+
+def _remember(*turn: dict):
+    hist = _supdate("history", lambda h: (*h, *turn)[-_HISTORY_CAP:], ())
+    task = _fold.get(_uid.get())
+    over = len(hist) > _HISTORY_MAX or sum(map(_msg_tokens, hist)) > _HISTORY_TOKENS
+    if over and (task is None or task.done()):
+        _fold[_uid.get()] = asyncio.create_task(_fold_history())
+
+async def _fold_history():
+    hist = tuple(_gs("history", ()))
+    cut, kept = len(hist), 0
+    while (cut > 2 and len(hist) - cut < _HISTORY_MAX // 2
+           and kept + _msg_tokens(hist[cut - 1]) <= _HISTORY_TOKENS // 2):
+        cut -= 1
+        kept += _msg_tokens(hist[cut])
+    cut = min(cut, len(hist) - 2)
+    if cut > 0 and hist[cut]["role"] == "assistant":
+        cut += 1
+    if cut <= 0:
+        return
+    old = hist[:cut]
+    summary = _gs("history_summary", "")
+    turns = "\n".join(f"{m['role']}: {m['content'][:2000]}" for m in old)
+    try:
+        async with _work_slot(prio=1):
+            new = await ask_llm_async(
+                [],
+                f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{turns}\n\n"
+                "Rewrite the summary to cover both. Keep names, facts, decisions and open "
+                "requests; drop small talk. Under 150 words.",
+                "You maintain the running summary of a chat between a user and their assistant Jai.",
+                ttl=0,
+            )
+    except _Busy:
+        return
+    if new == _LLM_DOWN or not new:
+        return
+
+    def tx(d, ops):
+        h = tuple(d.get("history", ()))
+        if h[:cut] != old:   # cleared or rewritten meanwhile
+            return False
+        d["history"], d["history_summary"] = h[cut:], new
+        ops += [["set", "history", d["history"]], ["set", "history_summary", new]]
+        return True
+    if _store("history").transact(tx):
+        _save_state()
+        _log("CTX:fold", f"{cut} msgs → summary {len(new)}c")
 
 # ── DuckDuckGo search ──────────────────────────────────────────────────────────
 
+# One DDGS session per search thread, results cached per normalised query,
+# and a token bucket so a batch of queries can't get us rate-limited.
+_SEARCH_TTL = float(CFG.get("search_cache_minutes", 30)) * 60
+_SEARCH_MAX = int(CFG.get("search_cache_max", 256))
+_SEARCH_RATE = float(CFG.get("search_rate", 1.0))     # queries/sec sustained
+_SEARCH_BURST = int(CFG.get("search_burst", 3))
+_search_pool = ThreadPoolExecutor(max_workers=int(CFG.get("search_workers", 2)),
+                                  thread_name_prefix="nano-search")
+_ddgs = threading.local()
+_SEARCH_CACHE: OrderedDict = OrderedDict()   # (query, n) -> (ts, results)
+_SEARCH_INFLIGHT: dict = {}
+_search_stats = {"hit": 0, "miss": 0}
+_metric("nano_search_cache_total", "counter", "Search cache lookups by result.",
+        lambda: {(("result", k),): v for k, v in _search_stats.items()})
+
 def _search(query: str, n: int = 5) -> list[dict]:
     try:
-        from duckduckgo_search import DDGS
-        with DDGS() as ddgs:
-            return list(ddgs.text(query, max_results=n))
-    except Exception:
+        if getattr(_ddgs, "s", None) is None:
+            from duckduckgo_search import DDGS
+            _ddgs.s = DDGS()
+        return list(_ddgs.s.text(query, max_results=n))
+    except Exception as e:
+        _ddgs.s = None   # session may be wedged (ratelimit, TLS); start fresh next time
+        _log("SEARCH:err", f"{query[:60]}: {e}")
         return []
 
+def _search_norm(query: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+class _Bucket:
+    """Token bucket: `rate` tokens/sec, holding at most `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.at = float(burst), time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+            self.at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_search_bucket = _Bucket(_SEARCH_RATE, _SEARCH_BURST)
+
+async def _search_async(query: str, n: int = 5) -> list[dict]:
+    key = (_search_norm(query), n)
+    hit = _SEARCH_CACHE.get(key)
+    if hit and time.time() - hit[0] < _SEARCH_TTL:
+        _SEARCH_CACHE.move_to_end(key)
+        _search_stats["hit"] += 1
+        return list(hit[1])
+    fut = _SEARCH_INFLIGHT.get(key)
+    if fut:
+        _search_stats["hit"] += 1
+        return list(await asyncio.shield(fut))
+    _search_stats["miss"] += 1
+    fut = _SEARCH_INFLIGHT[key] = asyncio.get_running_loop().create_future()
+    results: list = []
+    try:
+        await _search_bucket.take()
+        t0 = time.perf_counter()
+        results = await asyncio.get_running_loop().run_in_executor(_search_pool, _search, query, n)
+        _observe("nano_search_seconds", time.perf_counter() - t0, outcome="ok" if results else "empty")
+        if results:
+            stamp, uid = datetime.utcnow().isoformat(), _uid.get() or OWNER_ID
+            for r in results:
+                _rag_add({"kind": "web", "ts": stamp, "topic": r.get("title", ""),
+                          "summary": r.get("body", ""), "href": r.get("href", ""), "uid": uid})
+            _SEARCH_CACHE[key] = (time.time(), results)
+            _SEARCH_CACHE.move_to_end(key)
+            while len(_SEARCH_CACHE) > _SEARCH_MAX:
+                _SEARCH_CACHE.popitem(last=False)
+    finally:
+        del _SEARCH_INFLIGHT[key]
+        fut.set_result(results)
+    return list(results)
+
+async def _search_many(queries: list[str], n: int = 5) -> list[list[dict]]:
+    """Run queries concurrently (rate-limited); a URL is kept only under the
+    first query that returned it, so summaries don't repeat each other."""
+    batches = await asyncio.gather(*(_search_async(q, n) for q in queries))
+    seen: set = set()
+    out = []
+    for results in batches:
+        keep = []
+        for r in results:
+            url = (r.get("href") or "").split("#")[0].rstrip("/")
+            if url and url in seen:
+                continue
+            seen.add(url)
+            keep.append(r)
+        out.append(keep)
+    return out
+
 # ── Memory ─────────────────────────────────────────────────────────────────────
 
 _STATE_FILE = Path(__file__).parent / "state.json"
 _NANO_TAG = "NANO_STATE:"
 
+_JOURNAL_FILE = Path(__file__).parent / "state.journal"
+_SAVE_DEBOUNCE = float(CFG.get("state_debounce", 0.5))
+_COMPACT_OPS = int(CFG.get("state_compact_ops", 500))
+_persist_wake = threading.Event()
+_persist_io = threading.Lock()
+_persist: dict = {"thread": None, "ops": 0}
+_metric("nano_state_pending_ops", "gauge", "State changes not yet in the journal.", lambda: len(_STATE._journal))
+
 def _save_state():
-    try:
-        data = _state_copy()
-        data["history"] = data["history"][-8:]
-        kb = data.get("knowledge", {})
-        if len(kb) > 40:
-            data["knowledge"] = {k: kb[k] for k in sorted(kb.keys())[-30:]}
-        _STATE_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    except Exception as e:
-        _log("STATE:save_err", str(e))
+    """Schedule a save. Returns immediately: the writer thread coalesces bursts
+    into one journal append + fsync, so handlers never touch the disk."""
+    if _persist["thread"] is None:
+        t = threading.Thread(target=_persist_worker, name="nano-persist", daemon=True)
+        _persist["thread"] = t
+        t.start()
+    _persist_wake.set()
+
+def _persist_worker():
+    while True:
+        _persist_wake.wait()
+        time.sleep(_SAVE_DEBOUNCE)
+        _persist_wake.clear()
+        _persist_flush()
+
+def _persist_flush(compact: bool = False):
+    with _persist_io:
+        ops = _STATE.drain()
+        lines = "".join(json.dumps(op, ensure_ascii=False, default=_thaw) + "\n" for op in ops)
+        try:
+            if lines:
+                t0 = time.perf_counter()
+                with open(_JOURNAL_FILE, "a", encoding="utf-8") as f:
+                    f.write(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                _persist["ops"] += len(ops)
+                _observe("nano_state_save_seconds", time.perf_counter() - t0, kind="journal")
+                _inc("nano_state_save_bytes_total", len(lines.encode("utf-8")), kind="journal")
+            if compact or _persist["ops"] >= _COMPACT_OPS:
+                _compact_state()
+        except Exception as e:
+            _log("STATE:save_err", str(e))
+        _shards_flush()
+        _cache_save(force=compact)
+
+def _compact_state():
+    """Write a full snapshot via atomic rename, then truncate the journal.
+    Ops queued meanwhile are already in the snapshot and replay idempotently."""
+    t0 = time.perf_counter()
+    version, root = _STATE.snapshot()
+    data = dict(root)
+    data["history"] = data.get("history", ())[-_HISTORY_CAP:]
+    blob = json.dumps(data, ensure_ascii=False, indent=2, default=_thaw).encode("utf-8")
+    tmp = _STATE_FILE.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, _STATE_FILE)
+    open(_JOURNAL_FILE, "w").close()
+    _persist["ops"] = 0
+    _observe("nano_state_save_seconds", time.perf_counter() - t0, kind="snapshot")
+    _inc("nano_state_save_bytes_total", len(blob), kind="snapshot")
+    _log("STATE:compacted", f"v{version} {len(data)} keys")
 
 def _load_state():
     if _STATE_FILE.exists():
         try:
             data = json.loads(_STATE_FILE.read_text(encoding="utf-8"))
-            with _state_lock:
-                _STATE.update(data)
-            _log("STATE:loaded", f"kb={len(_STATE.get('knowledge',{}))}")
+            _STATE.transact(lambda d, _ops: d.update(_freeze(data)), journal=False)
+            _log("STATE:loaded", f"{len(data)} keys")
         except Exception as e:
             _log("STATE:load_err", str(e))
+    ops = []
+    if _JOURNAL_FILE.exists():
+        try:
+            good = 0
+            with open(_JOURNAL_FILE, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("unterminated")
+                        ops.append(json.loads(line))
+                    except ValueError:
+                        break   # torn tail from a crash mid-append
+                    good += len(line)
+            if good < _JOURNAL_FILE.stat().st_size:
+                # cut the torn tail, or the next append would be glued onto it
+                with open(_JOURNAL_FILE, "r+b") as f:
+                    f.truncate(good)
+                    os.fsync(f.fileno())
+                _log("STATE:journal_torn", f"truncated to {good} bytes")
+            _persist["ops"] = len(ops)
+            _log("STATE:replayed", f"{len(ops)} ops")
+        except Exception as e:
+            _log("STATE:journal_err", str(e))
+    _STATE.transact(lambda d, _ops: _apply_ops(d, ops), journal=False)
     env_state = os.getenv("NANO_STATE_JSON")
     if env_state:
         try:
-            with _state_lock:
-                _STATE.update(json.loads(env_state))
+            env = json.loads(env_state)
+            _STATE.transact(lambda d, _ops: d.update(_freeze(env)), journal=False)
             _log("STATE:env_loaded")
         except Exception:
             pass
+    fresh = not _STATE_FILE.exists() and not ops and not env_state
+    _kb_migrate()
+    _sync["fresh"] = _sync["pending"] = fresh and not _kb_count()   # nothing local: restore from Telegram
+    _cache_load()
+
+# ── Knowledge store (SQLite + FTS5) ────────────────────────────────────────────
+
+_KB_FILE = Path(__file__).parent / "knowledge.db"
+_KB_RETENTION_DAYS = float(CFG.get("kb_retention_days", 365))
+_KB_MAX = int(CFG.get("kb_max_entries", 0))   # 0 = no count cap
+_kb_lock = threading.Lock()
+_kb: dict = {"db": None, "fts": False}
+_metric("nano_knowledge_entries", "gauge", "Rows in the knowledge store.", lambda: _kb_count())
+
+def _kb_db() -> sqlite3.Connection:
+    # caller holds _kb_lock
+    if _kb["db"] is None:
+        db = sqlite3.connect(_KB_FILE, check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS knowledge (
+                id      INTEGER PRIMARY KEY,
+                ts      TEXT NOT NULL,
+                topic   TEXT NOT NULL,
+                summary TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS knowledge_ts ON knowledge(ts);
+            CREATE INDEX IF NOT EXISTS knowledge_topic ON knowledge(topic, ts);
+        """)
+        try:
+            db.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts
+                    USING fts5(topic, summary, content='knowledge', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS knowledge_ai AFTER INSERT ON knowledge BEGIN
+                    INSERT INTO knowledge_fts(rowid, topic, summary)
+                    VALUES (new.id, new.topic, new.summary);
+                END;
+                CREATE TRIGGER IF NOT EXISTS knowledge_ad AFTER DELETE ON knowledge BEGIN
+                    INSERT INTO knowledge_fts(knowledge_fts, rowid, topic, summary)
+                    VALUES ('delete', old.id, old.topic, old.summary);
+                END;
+            """)
+            _kb["fts"] = True
+        except sqlite3.OperationalError as e:
+            _log("KB:no_fts5", str(e))   # /recall falls back to LIKE
+        _kb["db"] = db
+    return _kb["db"]
+
+def _kb_add(ts: str, topic: str, summary: str):
+    cutoff = (datetime.utcnow() - timedelta(days=_KB_RETENTION_DAYS)).isoformat()
+    with _kb_lock:
+        db = _kb_db()
+        db.execute("BEGIN")
+        db.execute("INSERT INTO knowledge(ts, topic, summary) VALUES (?, ?, ?)", (ts, topic, summary))
+        db.execute("DELETE FROM knowledge WHERE ts < ?", (cutoff,))
+        if _KB_MAX:
+            db.execute("DELETE FROM knowledge WHERE id IN "
+                       "(SELECT id FROM knowledge ORDER BY ts DESC LIMIT -1 OFFSET ?)", (_KB_MAX,))
+        db.execute("COMMIT")
+    _rag_add({"kind": "kb", "ts": ts, "topic": topic, "summary": summary})
+
+def _kb_range(since: datetime, until: datetime | None = None) -> list[dict]:
+    sql, args = "SELECT ts, topic, summary FROM knowledge WHERE ts >= ?", [since.isoformat()]
+    if until:
+        sql += " AND ts < ?"
+        args.append(until.isoformat())
+    with _kb_lock:
+        return [dict(r) for r in _kb_db().execute(sql + " ORDER BY ts", args)]
+
+def _kb_latest(n: int) -> list[dict]:
+    with _kb_lock:
+        rows = _kb_db().execute(
+            "SELECT ts, topic, summary FROM knowledge ORDER BY ts DESC LIMIT ?", (n,)
+        ).fetchall()
+    return [dict(r) for r in reversed(rows)]
+
+def _kb_count(since: datetime | None = None) -> int:
+    with _kb_lock:
+        if since is None:
+            return _kb_db().execute("SELECT COUNT(*) FROM knowledge").fetchone()[0]
+        return _kb_db().execute(
+            "SELECT COUNT(*) FROM knowledge WHERE ts >= ?", (since.isoformat(),)
+        ).fetchone()[0]
+
+def _kb_search(query: str, limit: int = 5) -> list[dict]:
+    words = re.findall(r"\w+", query)
+    if not words:
+        return []
+    with _kb_lock:
+        db = _kb_db()
+        if _kb["fts"]:
+            match = " OR ".join(f'"{w}"' for w in words)
+            rows = db.execute(
+                "SELECT k.ts, k.topic, k.summary FROM knowledge_fts f "
+                "JOIN knowledge k ON k.id = f.rowid WHERE knowledge_fts MATCH ? "
+                "ORDER BY bm25(knowledge_fts) LIMIT ?", (match, limit),
+            ).fetchall()
+        else:
+            like = f"%{query}%"
+            rows = db.execute(
+                "SELECT ts, topic, summary FROM knowledge WHERE topic LIKE ? OR summary LIKE ? "
+                "ORDER BY ts DESC LIMIT ?", (like, like, limit),
+            ).fetchall()
+    return [dict(r) for r in rows]
+
+def _kb_after(row_id: int) -> list[dict]:
+    with _kb_lock:
+        return [dict(r) for r in _kb_db().execute(
+            "SELECT id, ts, topic, summary FROM knowledge WHERE id > ? ORDER BY id", (row_id,))]
+
+def _kb_max_id() -> int:
+    with _kb_lock:
+        return _kb_db().execute("SELECT COALESCE(MAX(id), 0) FROM knowledge").fetchone()[0]
+
+def _kb_merge(rows: list[dict]) -> int:
+    """Insert rows not already present (same ts and topic); returns how many."""
+    added = 0
+    with _kb_lock:
+        db = _kb_db()
+        db.execute("BEGIN")
+        for r in rows:
+            if not db.execute("SELECT 1 FROM knowledge WHERE ts = ? AND topic = ?",
+                              (r["ts"], r["topic"])).fetchone():
+                db.execute("INSERT INTO knowledge(ts, topic, summary) VALUES (?, ?, ?)",
+                           (r["ts"], r["topic"], r["summary"]))
+                added += 1
+        db.execute("COMMIT")
+    return added
+
+def _kb_migrate():
+    """Move the pre-SQLite knowledge dict (keyed by ISO timestamp) out of state."""
+    legacy = _gs("knowledge")
+    if legacy is None:
+        return
+    with _kb_lock:
+        db = _kb_db()
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT INTO knowledge(ts, topic, summary) VALUES (?, ?, ?)",
+            [(ts, e.get("topic", ""), e.get("summary", "")) for ts, e in sorted(legacy.items())],
+        )
+        db.execute("COMMIT")
+    _sdel("knowledge")
+    _save_state()
+    _log("KB:migrated", f"{len(legacy)} entries")
+
+# ── Retrieval: BM25 over knowledge ─────────────────────────────────────────────
+
+# In-memory BM25 index over knowledge entries and recent search snippets, used
+# to ground chat replies in what Jai already learned. Each term keeps growable
+# NumPy arrays of (doc id, term frequency), so a query only touches the
+# postings of its own terms and scores them in a few vector ops. Entries are
+# added as they are learned; snippets live in a bounded ring and the index is
+# rebuilt off-thread once evicted snippets pile up. Without NumPy, retrieval
+# falls back to the SQLite FTS search behind /recall. Study notes are shared;
+# a web snippet is only retrieved for the user whose search fetched it.
+_RAG_K = int(CFG.get("rag_top_k", 3))
+_RAG_TOKENS = int(CFG.get("rag_tokens", 600))
+_RAG_MIN_SCORE = float(CFG.get("rag_min_score", 3.0))
+_RAG_SNIPPETS = int(CFG.get("rag_snippets_max", 2000))
+_STOP = frozenset(
+    "a an and are as at be but by can do does for from had has have how i if in into is it its "
+    "me my no not of on or our so than that the their them then there these they this to was "
+    "we were what when where which who why will with you your about".split())
+_WORDS = re.compile(r"\w\w+")
+_rag: dict = {"index": None, "snippets": deque(maxlen=_RAG_SNIPPETS), "building": False}
+_metric("nano_rag_seconds", "histogram", "Retrieval query time.")
+_metric("nano_rag_docs", "gauge", "Documents in the retrieval index.",
+        lambda: _rag["index"].n if _rag["index"] else 0)
+
+def _terms(text: str) -> list[str]:
+    return [w for w in _WORDS.findall(text.lower()) if w not in _STOP]
+
+class _BM25:
+    """Incremental BM25 (k1=1.2, b=0.75). add() is O(terms in doc); search()
+    is O(postings of the query terms) plus an argpartition over the hits."""
+
+    k1, b = 1.2, 0.75
+
+    def __init__(self, np):
+        self.np = np
+        self.docs: list[dict] = []
+        self.lens = np.zeros(1024, np.float32)
+        self.post: dict = {}   # term -> [ids int32[], tfs float32[], used]
+        self.total = 0
+        self.kb = 0            # knowledge docs (the rest are snippets)
+        self.lock = threading.Lock()
+
+    @property
+    def n(self) -> int:
+        return len(self.docs)
+
+    def add(self, text: str, doc: dict):
+        np = self.np
+        counts: dict = {}
+        for t in _terms(text):
+            counts[t] = counts.get(t, 0) + 1
+        with self.lock:
+            i = len(self.docs)
+            if i == len(self.lens):
+                self.lens = np.concatenate([self.lens, np.zeros(i, np.float32)])
+            self.lens[i] = sum(counts.values())
+            self.total += int(self.lens[i])
+            for t, c in counts.items():
+                p = self.post.get(t)
+                if p is None:
+                    p = self.post[t] = [np.empty(4, np.int32), np.empty(4, np.float32), 0]
+                elif p[2] == len(p[0]):
+                    p[0], p[1] = np.resize(p[0], 2 * p[2]), np.resize(p[1], 2 * p[2])
+                p[0][p[2]], p[1][p[2]] = i, c
+                p[2] += 1
+            self.docs.append(doc)
+            self.kb += doc.get("kind") == "kb"
+
+    def load(self, items: list[tuple[str, dict]]):
+        """Bulk-load an empty index: every (term, doc) pair is counted in one
+        np.unique pass instead of a Python loop per posting."""
+        np = self.np
+        vocab: dict = {}
+        ids, lens = [], []
+        for text, doc in items:
+            terms = _terms(text)
+            lens.append(len(terms))
+            for t in terms:
+                i = vocab.get(t)
+                if i is None:
+                    i = vocab[t] = len(vocab)
+                ids.append(i)
+            self.docs.append(doc)
+            self.kb += doc.get("kind") == "kb"
+        n = max(len(lens), 1)
+        pairs, tf = np.unique(np.array(ids, np.int64) * n +
+                              np.repeat(np.arange(len(lens), dtype=np.int64), lens), return_counts=True)
+        term, docs = pairs // n, (pairs % n).astype(np.int32)
+        cuts = np.searchsorted(term, np.arange(len(vocab) + 1))
+        tf = tf.astype(np.float32)
+        self.post = {t: [docs[cuts[i]:cuts[i + 1]].copy(), tf[cuts[i]:cuts[i + 1]].copy(),
+                         int(cuts[i + 1] - cuts[i])] for t, i in vocab.items()}
+        self.lens = np.zeros(max(1024, 2 * len(lens)), np.float32)
+        self.lens[:len(lens)] = lens
+        self.total = sum(lens)
+
+    def search(self, query: str, k: int) -> list[tuple[float, dict]]:
+        np = self.np
+        with self.lock:
+            n = len(self.docs)
+            if not n:
+                return []
+            avg = self.total / n or 1.0
+            norm = self.k1 * (1 - self.b + self.b * self.lens[:n] / avg)
+            ids, parts = [], []
+            for t in set(_terms(query)):
+                p = self.post.get(t)
+                if p is None:
+                    continue
+                d, tf = p[0][:p[2]], p[1][:p[2]]
+                idf = np.log(1 + (n - p[2] + 0.5) / (p[2] + 0.5))
+                ids.append(d)
+                parts.append(idf * tf * (self.k1 + 1) / (tf + norm[d]))
+            if not ids:
+                return []
+            ids, parts = np.concatenate(ids), np.concatenate(parts)
+            uniq, inv = np.unique(ids, return_inverse=True)
+            scores = np.bincount(inv, weights=parts)
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(float(scores[j]), self.docs[int(uniq[j])]) for j in top]
+
+def _rag_build():
+    """(Re)build the index from the knowledge store and the snippet ring."""
+    if _rag["building"]:
+        return
+    _rag["building"] = True
+    try:
+        import numpy as np
+        t0 = time.perf_counter()
+        idx = _BM25(np)
+        rows = _kb_after(0)
+        docs = [{"kind": "kb", **r} for r in rows] + list(_rag["snippets"])
+        idx.load([(f"{d['topic']} {d['summary']}", d) for d in docs])
+        _rag["index"] = idx
+        # entries learned while building went to the old index (or none)
+        for r in _kb_after(rows[-1]["id"] if rows else 0):
+            idx.add(f"{r['topic']} {r['summary']}", {"kind": "kb", **r})
+        _log("RAG:built", f"{idx.n} docs, {len(idx.post)} terms",
+             ms=round((time.perf_counter() - t0) * 1000))
+    except ImportError:
+        _log("RAG:off", "numpy not installed, using the FTS search")
+    finally:
+        _rag["building"] = False
+
+def _rag_add(doc: dict):
+    if doc["kind"] == "web":
+        _rag["snippets"].append(doc)
+    idx = _rag["index"]
+    if idx is None:
+        return
+    idx.add(f"{doc['topic']} {doc['summary']}", doc)
+    if idx.n - idx.kb > 2 * _RAG_SNIPPETS and not _rag["building"]:
+        threading.Thread(target=_rag_build, name="nano-rag", daemon=True).start()
+
+def _rag_search(query: str, k: int = _RAG_K) -> list[dict]:
+    t0 = time.perf_counter()
+    idx = _rag["index"]
+    if idx is not None:
+        uid = _uid.get() or OWNER_ID
+        hits = [d for s, d in idx.search(query, 8 * k)
+                if s >= _RAG_MIN_SCORE and (d["kind"] == "kb" or d.get("uid") == uid)]
+    else:
+        hits = [{"kind": "kb", **r} for r in _kb_search(query, k)]
+    seen: set = set()
+    hits = [d for d in hits if not (d["summary"] in seen or seen.add(d["summary"]))][:k]
+    _observe("nano_rag_seconds", time.perf_counter() - t0)
+    return hits
+
+def _rag_system(query: str) -> str | None:
+    """System prompt with the best matching notes appended, within rag_tokens."""
+    notes, used = [], 0
+    for d in _rag_search(query):
+        line = (f"- [{d['ts'][:10]}] {d['topic']}: {d['summary']}" if d["kind"] == "kb"
+                else f"- (web) {d['topic']}: {d['summary']} {d.get('href', '')}")
+        if used + _tokens(line) > _RAG_TOKENS:
+            break
+        notes.append(line.strip())
+        used += _tokens(line)
+    if not notes:
+        return None
+    return (_SYSTEM + "\n\nNotes from your own research that may be relevant. Use them "
+            "when they answer the question; ignore them otherwise:\n" + "\n".join(notes))
+
+# ── Sync: Telegram snapshots ───────────────────────────────────────────────────
+
+# The owner chat doubles as off-site storage. Every sync_snapshot_every syncs a
+# zlib-compressed full snapshot (state + knowledge rows) goes up as a document;
+# in between only a delta does: state keys whose hash changed, deleted keys and
+# knowledge rows added since the last sync. A pinned manifest message lists the
+# snapshot and its deltas, so a fresh instance rebuilds the brain from a few
+# small downloads. Member shards (users/<id>.json) travel the same way, per user. Syncs with nothing new are skipped. Until a fresh instance
+# has restored (or found nothing pinned) it never pushes, so an empty brain
+# can't replace the pinned backup; a failed restore is retried with backoff.
+_SYNC_SNAPSHOT_EVERY = int(CFG.get("sync_snapshot_every", 20))
+_SYNC_EVERY = float(CFG.get("sync_every_minutes", 0 if IS_LOCAL else 30)) * 60
+_sync: dict = {"keys": None, "users": {}, "kb_id": 0, "manifest": None, "msg_id": None,
+               "fresh": False, "pending": False}
+_sync_lock = asyncio.Lock()
+
+def _sync_pack(obj) -> bytes:
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_thaw)
+    return zlib.compress(raw.encode("utf-8"), 9)
+
+def _sync_unpack(blob: bytes) -> dict:
+    return json.loads(zlib.decompress(blob))
+
+def _sync_keyhashes(root: Mapping) -> dict:
+    return {k: hashlib.sha1(json.dumps(v, sort_keys=True, ensure_ascii=False, default=_thaw)
+                            .encode("utf-8")).hexdigest() for k, v in root.items()}
+
+def _sync_users() -> dict:
+    """str(uid) -> shard contents: saved files, overlaid with loaded shards."""
+    out = {}
+    for p in _USERS_DIR.glob("*.json"):
+        try:
+            out[p.stem] = json.loads(p.read_text(encoding="utf-8"))
+        except Exception as e:
+            _log("SYNC:shard_err", f"{p.name} {e}")
+    with _shards_lock:
+        loaded = [(uid, s[0]) for uid, s in _shards.items()]
+    out.update((str(uid), dict(st.snapshot()[1])) for uid, st in loaded)
+    return out
+
+def _sync_digest(keys: dict, users: dict) -> str:
+    """Content hash of state + member shards + knowledge, comparable across instances."""
+    kb = _kb_latest(1)
+    marker = f"{_kb_count()}:{kb[0]['ts'] if kb else ''}"
+    return hashlib.sha256((json.dumps([keys, users], sort_keys=True) + marker).encode()).hexdigest()[:16]
+
+def _sync_build(full: bool):
+    """(blob, keys, users, kb_id, digest) for the next upload, or None if nothing changed."""
+    root = _STATE.snapshot()[1]
+    keys = _sync_keyhashes(root)
+    shards = _sync_users()
+    users = _sync_keyhashes(shards)
+    old, old_users = _sync["keys"], _sync["users"]
+    rows = _kb_after(0 if full else _sync["kb_id"])
+    kb_id = max((r.pop("id") for r in rows), default=_sync["kb_id"])
+    if old is not None and old == keys and old_users == users and kb_id == _sync["kb_id"]:
+        return None
+    if full:
+        body = {"state": dict(root), "kb": rows, "users": shards}
+    else:
+        body = {"set": {k: root[k] for k, h in keys.items() if old.get(k) != h},
+                "del": [k for k in old if k not in keys], "kb": rows,
+                "users": {u: shards[u] for u, h in users.items() if old_users.get(u) != h}}
+    return _sync_pack(body), keys, users, kb_id, _sync_digest(keys, users)
+
+async def _sync_manifest(bot, man: dict):
+    """Edit the pinned manifest in place, or post and pin a new one."""
+    if _sync["pending"]:
+        raise RuntimeError("restore from Telegram still pending")
+    text = (f"🧠 Jai brain sync — {man['at'][:16].replace('T', ' ')} UTC, "
+            f"snapshot + {len(man['deltas'])} deltas\n{_NANO_TAG}{json.dumps(man)}")
+    if _sync["msg_id"]:
+        try:
+            await _tg_call(OWNER_ID, lambda: bot.edit_message_text(
+                text, chat_id=OWNER_ID, message_id=_sync["msg_id"]), "sync", idempotent=True)
+            return
+        except Exception as e:
+            _log("SYNC:manifest_err", f"{e} — posting a new one")
+    msg = await _tg_call(OWNER_ID, lambda: bot.send_message(OWNER_ID, text, disable_notification=True), "sync")
+    await _tg_call(OWNER_ID, lambda: bot.pin_chat_message(
+        OWNER_ID, msg.message_id, disable_notification=True), "sync", idempotent=True)
+    _sync["msg_id"] = msg.message_id
+
+async def _push_to_telegram(bot, full: bool = False) -> str:
+    """Upload a snapshot or delta and update the manifest; returns a short status."""
+    if not OWNER_ID:
+        return "no owner chat"
+    if _sync["pending"]:
+        _log("SYNC:skip", "restore pending")
+        return "failed: restore from Telegram still pending"
+    _save_state()
+    async with _sync_lock:
+        man = _sync["manifest"] or {}
+        full = (full or _sync["keys"] is None or not man.get("snap")
+                or len(man.get("deltas", ())) >= _SYNC_SNAPSHOT_EVERY)
+        try:
+            built = await asyncio.to_thread(_sync_build, full)
+        except Exception as e:
+            _log("SYNC:err", str(e))
+            return f"failed: {e}"
+        if built is None:
+            _log("SYNC:skip", "no changes")
+            return "unchanged"
+        blob, keys, users, kb_id, digest = built
+        kind = "snapshot" if full else "delta"
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        try:
+            doc = await _tg_call(OWNER_ID, lambda: bot.send_document(
+                OWNER_ID, document=blob, filename=f"jai-{kind}-{stamp}.json.z",
+                caption=f"🧠 {kind} {len(blob):,} bytes", disable_notification=True), "sync")
+            fid = doc.document.file_id
+            man = ({"v": 1, "snap": fid, "deltas": []} if full
+                   else {**man, "deltas": [*man["deltas"], fid]})
+            man.update(at=datetime.utcnow().isoformat(timespec="seconds"), hash=digest)
+            await _sync_manifest(bot, man)
+        except Exception as e:
+            _log("SYNC:err", str(e))
+            _inc("nano_telegram_errors_total", site="sync")
+            return f"failed: {e}"
+        _sync.update(keys=keys, users=users, kb_id=kb_id, manifest=man)
+    _log("SYNC:pushed", f"{kind} {len(blob)} bytes", deltas=len(man["deltas"]))
+    return f"{kind}, {len(blob):,} bytes"
+
+def _sync_apply(blobs: list[bytes]) -> tuple[int, int]:
+    """Merge snapshot + deltas into state, member shards and knowledge; returns
+    (keys, new rows)."""
+    snap = _sync_unpack(blobs[0])
+    state, rows, gone = dict(snap["state"]), list(snap["kb"]), set()
+    users = dict(snap.get("users", {}))
+    for blob in blobs[1:]:
+        d = _sync_unpack(blob)
+        users.update(d.get("users", {}))
+        state.update(d["set"])
+        gone.difference_update(d["set"])
+        for k in d["del"]:
+            state.pop(k, None)
+            gone.add(k)
+    ops = [["set", k, _freeze(v)] for k, v in state.items()] + [["del", k] for k in gone]
+
+    def tx(d, out):
+        _apply_ops(d, ops)
+        out.extend(ops)
+    _STATE.transact(tx)
+    added = _kb_merge(rows + [r for b in blobs[1:] for r in _sync_unpack(b)["kb"]])
+    for uid, data in users.items():
+        if not uid.lstrip("-").isdigit():
+            continue
+        path = _shard_file(int(uid))
+        try:
+            _USERS_DIR.mkdir(exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False, default=_thaw), encoding="utf-8")
+            os.replace(tmp, path)
+        except Exception as e:
+            _log("SYNC:shard_err", f"uid={uid} {e}")
+        with _shards_lock:
+            _shards.pop(int(uid), None)   # reloaded from the restored file on next use
+    _save_state()
+    return len(state), added
 
-async def _push_to_telegram(bot):
+async def _sync_restore(bot):
+    """Read the pinned manifest. A fresh instance (no local state) restores from
+    it; otherwise it only sets the delta baseline if local content matches.
+    Holds the sync lock, so a sync started meanwhile waits for the baseline."""
     if not OWNER_ID:
         return
-    _save_state()
+    async with _sync_lock:
+        try:
+            pin = (await bot.get_chat(OWNER_ID)).pinned_message
+            text = (pin.text if pin else None) or ""
+            if _NANO_TAG not in text:
+                _sync["pending"] = False   # nothing pinned: this instance starts the backup
+                return
+            man = json.loads(text.split(_NANO_TAG, 1)[1])
+        except Exception as e:
+            _log("SYNC:manifest_err", str(e))
+            return
+        if _sync["pending"]:
+            t0 = time.perf_counter()
+            try:
+                async def fetch(fid: str) -> bytes:
+                    f = await _tg_call(OWNER_ID, lambda: bot.get_file(fid), "sync", idempotent=True)
+                    return bytes(await f.download_as_bytearray())
+                blobs = await asyncio.gather(*(fetch(f) for f in [man["snap"], *man["deltas"]]))
+                nkeys, added = await asyncio.to_thread(_sync_apply, blobs)
+            except Exception as e:
+                _log("SYNC:restore_err", str(e))
+                return
+            _sync["pending"] = False
+            _rem_rebuild()   # restored reminders (a no-op before the scheduler starts)
+            _sched_wake()
+            _log("SYNC:restored", f"{nkeys} keys, {added} knowledge rows from {1 + len(man['deltas'])} docs",
+                 bytes=sum(map(len, blobs)), ms=round((time.perf_counter() - t0) * 1000))
+        _sync["msg_id"], _sync["manifest"] = pin.message_id, man
+        keys = _sync_keyhashes(_STATE.snapshot()[1])
+        users = _sync_keyhashes(await asyncio.to_thread(_sync_users))
+        if await asyncio.to_thread(_sync_digest, keys, users) == man.get("hash"):
+            _sync.update(keys=keys, users=users, kb_id=await asyncio.to_thread(_kb_max_id))
+
+async def _sync_recover(bot, delay: float = 30.0):
+    """Retry a failed fresh restore with backoff until it lands."""
+    while _sync["pending"]:
+        _log("SYNC:restore_retry", f"in {delay:.0f}s")
+        await asyncio.sleep(delay)
+        await _sync_restore(bot)
+        delay = min(delay * 2, 1800.0)
+
+# ── Scheduler ──────────────────────────────────────────────────────────────────
+
+# One loop runs every background job. A job is due by interval (every), by a
+# cron expression (cron, a string or a callable returning one), by a callable
+# returning the next epoch (when), or after the owner has been idle for
+# `idle` seconds (at most once per `every`). The loop sleeps until the soonest
+# due time and is woken early by _sched_wake() when something changes, so
+# nothing ticks while nothing is due. A job still running when it comes due
+# again is skipped, not stacked; jitter spreads runs that would line up. A job
+# whose timing callables raise is held for sched_hold seconds, then retried.
+_SCHED: dict = {}   # name -> job dict
+_sched: dict = {"wake": None}
+_SCHED_HOLD = float(CFG.get("sched_hold", 300))
+_metric("nano_job_seconds", "histogram", "Scheduled job run time by job.")
+_metric("nano_job_errors_total", "counter", "Scheduled job failures by job (scheduler = the loop itself).")
+
+def _schedule(name: str, fn: Callable, *, every: float | None = None, cron=None,
+              when: Callable | None = None, idle: float | None = None, jitter: float = 0.0,
+              delay: float = 0.0, enabled: Callable | None = None):
+    now = time.time()
+    _SCHED[name] = {
+        "name": name, "fn": fn, "every": every, "cron": cron, "when": when, "idle": idle,
+        "jitter": jitter, "enabled": enabled, "running": False, "hold": 0.0,
+        "next": now + delay if (every or idle) and not cron else None, "after": now + delay,
+        "runs": 0, "errors": 0, "skipped": 0, "total": 0.0, "max": 0.0, "last": None, "err": "",
+    }
+    _sched_wake()
+
+def _sched_wake():
+    if _sched["wake"] is not None:
+        _sched["wake"].set()
+
+def _sched_due(job: dict, now: float) -> float | None:
+    if job["enabled"] and not job["enabled"]():
+        return None
+    if job["when"]:
+        return job["when"]()
+    if job["idle"]:
+        idle_from = _last_activity["time"].replace(tzinfo=timezone.utc).timestamp() + job["idle"]
+        return max(idle_from, job["after"])
+    if job["cron"] and job["next"] is None:
+        expr = job["cron"]() if callable(job["cron"]) else job["cron"]
+        nxt = _cron_next(expr, datetime.utcnow()).replace(tzinfo=timezone.utc).timestamp()
+        job["next"] = nxt + random.uniform(0, job["jitter"])
+    return job["next"]
+
+async def _sched_run(job: dict):
+    job["running"] = True
+    t0 = time.perf_counter()
     try:
-        data = _state_copy()
-        data["history"] = data["history"][-4:]
-        kb = data.get("knowledge", {})
-        data["knowledge"] = {k: kb[k] for k in sorted(kb.keys())[-10:]}
-        payload = _NANO_TAG + json.dumps(data, ensure_ascii=False)
-        await bot.send_message(
-            OWNER_ID,
-            f"🧠 *Jai brain synced* — {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}\n"
-            f"`{payload[:300]}...`",
-            parse_mode="Markdown",
-        )
-        _log("STATE:synced", "pushed to Telegram")
+        await job["fn"]()
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        _log("STATE:sync_err", str(e))
+        _sched_fail(job, e)
+    finally:
+        secs = time.perf_counter() - t0
+        job["running"] = False
+        job["runs"] += 1
+        job["total"] += secs
+        job["max"] = max(job["max"], secs)
+        job["last"] = time.time()
+        _observe("nano_job_seconds", secs, job=job["name"])
+        _sched_wake()
+
+def _sched_fail(job: dict, e: Exception):
+    job["errors"] += 1
+    job["err"] = str(e)[:200]
+    _log("SCHED:err", f"{job['name']}: {e}")
+    _inc("nano_job_errors_total", job=job["name"])
+
+def _sched_advance(job: dict, now: float):
+    """Move a job that just came due to its next slot."""
+    if job["every"] and not job["idle"]:
+        job["next"] = now + job["every"] + random.uniform(0, job["jitter"])
+    elif job["cron"]:
+        job["next"] = None   # recomputed from the expression
+    if job["idle"]:
+        job["after"] = now + (job["every"] or job["idle"])
+
+def _sched_step(job: dict, now: float) -> float | None:
+    """Start the job if it is due; returns when to look at it next."""
+    if job["hold"] > now:
+        return job["hold"]
+    due = _sched_due(job, now)
+    if due is None or due > now:
+        return due
+    if job["running"]:
+        job["skipped"] += not job["when"]
+    else:
+        asyncio.create_task(_sched_run(job))
+    _sched_advance(job, now)
+    if job["when"]:
+        return None   # re-read after the run (it wakes us)
+    return _sched_due(job, now)
+
+async def _sched_loop():
+    _sched["wake"] = asyncio.Event()
+    while True:
+        _sched["wake"].clear()
+        now = time.time()
+        soonest = None
+        for job in list(_SCHED.values()):
+            try:
+                due = _sched_step(job, now)
+            except Exception as e:
+                _sched_fail(job, e)
+                due = job["hold"] = now + _SCHED_HOLD
+            if due is not None and (soonest is None or due < soonest):
+                soonest = due
+        timeout = None if soonest is None else max(0.0, soonest - time.time())
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(_sched["wake"].wait(), timeout)
+        except asyncio.TimeoutError:
+            # oversleep past the soonest job = how long ready callbacks waited for the loop
+            lag = max(0.0, time.perf_counter() - t0 - timeout)
+            _loop_lag["last"] = lag
+            _observe("nano_loop_lag_seconds", lag)
+
+async def _sched_main():
+    """Run the scheduler, restarting it if it ever dies."""
+    while True:
+        try:
+            await _sched_loop()
+        except Exception as e:
+            _log("SCHED:crash", f"{type(e).__name__}: {e} — restarting")
+            _inc("nano_job_errors_total", job="scheduler")
+            await asyncio.sleep(1)
+
+def _sched_line(job: dict, now: float) -> str:
+    if job["idle"]:
+        kind = f"after {_dur(job['idle'])} idle, then every {_dur(job['every'] or job['idle'])}"
+    elif job["every"]:
+        kind = f"every {_dur(job['every'])}"
+    elif job["cron"]:
+        kind = "cron " + (job["cron"]() if callable(job["cron"]) else job["cron"])
+    else:
+        kind = "timed"
+    held = job["hold"] > now
+    due = None if job["running"] or held else _sched_due(job, now)
+    state = ("running" if job["running"] else f"held, retry in {_dur(job['hold'] - now)}" if held
+             else "off" if job["enabled"] and not job["enabled"]()
+             else "nothing due" if due is None else f"next {_dur(max(0, due - now))}")
+    avg = job["total"] / job["runs"] * 1000 if job["runs"] else 0
+    line = (f"{job['name']} · {kind} · {state} · {job['runs']} runs · "
+            f"avg {avg:.0f}ms max {job['max'] * 1000:.0f}ms")
+    if job["skipped"]:
+        line += f" · {job['skipped']} skipped"
+    if job["errors"]:
+        line += f" · {job['errors']} errors ({job['err'][:60]})"
+    return line
+
+def _dur(secs: float) -> str:
+    return f"{secs:.0f}s" if secs < 120 else f"{secs / 60:.0f}m" if secs < 7200 else f"{secs / 3600:.1f}h"
 
 # ── Background: Reminders ──────────────────────────────────────────────────────
 
-async def _reminder_loop(bot):
-    while True:
-        await asyncio.sleep(30)
-        now = datetime.utcnow()
-        reminders = _gs("reminders", [])
-        due = [r for r in reminders if datetime.fromisoformat(r["due"]) <= now]
-        if due:
-            remaining = [r for r in reminders if r not in due]
-            _ss("reminders", remaining)
-            _save_state()
-            for r in due:
-                try:
-                    await bot.send_message(OWNER_ID, f"⏰ *Reminder:* {r['msg']}", parse_mode="Markdown")
-                except Exception:
-                    pass
+# Min-heap of (due epoch, id, due ISO). The loop sleeps exactly until the head
+# is due and is woken early when a reminder is added; cancelled or rescheduled
+# reminders leave stale heap entries that are skipped when popped.
+_rem: dict = {"heap": []}
+_metric("nano_reminders_pending", "gauge", "Reminders scheduled.", lambda: len(_gs("reminders", {})))
+_DOW = {"sun": 0, "mon": 1, "tue": 2, "wed": 3, "thu": 4, "fri": 5, "sat": 6}
+
+def _epoch(iso: str) -> float:
+    return datetime.fromisoformat(iso).replace(tzinfo=timezone.utc).timestamp()
+
+def _cron_field(spec: str, lo: int, hi: int) -> set[int]:
+    out = set()
+    for part in spec.split(","):
+        rng, _, step = part.partition("/")
+        if rng == "*":
+            a, b = lo, hi
+        elif "-" in rng:
+            a, b = (int(_DOW.get(x, x)) for x in rng.split("-"))
+        else:
+            a = b = int(_DOW.get(rng, rng))
+        if not (lo <= a <= b <= hi):
+            raise ValueError(f"{part} outside {lo}-{hi}")
+        out.update(range(a, b + 1, int(step or 1)))
+    return out
+
+def _cron_next(expr: str, after: datetime) -> datetime:
+    """Next time strictly after `after` matching a 5-field cron expression
+    (minute hour day-of-month month day-of-week, Sunday = 0 or 7)."""
+    f = expr.lower().split()
+    if len(f) != 5:
+        raise ValueError("cron needs 5 fields")
+    mins, hours = _cron_field(f[0], 0, 59), sorted(_cron_field(f[1], 0, 23))
+    doms, months = _cron_field(f[2], 1, 31), _cron_field(f[3], 1, 12)
+    dows = {d % 7 for d in _cron_field(f[4], 0, 7)}
+    dom_any, dow_any = f[2] == "*", f[4] == "*"
+    start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    day = start.replace(hour=0, minute=0)
+    for _ in range(366 * 5):
+        dom_ok, dow_ok = day.day in doms, (day.weekday() + 1) % 7 in dows
+        day_ok = (dom_ok or dow_ok) if not (dom_any or dow_any) else (dom_ok and dow_ok)
+        if day.month in months and day_ok:
+            for h in hours:
+                for m in sorted(mins):
+                    t = day.replace(hour=h, minute=m)
+                    if t >= start:
+                        return t
+        day += timedelta(days=1)
+    raise ValueError("cron expression never fires")
+
+_INTERVAL_RE = re.compile(r"^(\d+)(m|h|d)$")
+
+def _interval(spec: str) -> timedelta | None:
+    m = _INTERVAL_RE.match(spec)
+    if not m:
+        return None
+    n, unit = int(m.group(1)), m.group(2)
+    return timedelta(minutes=n) if unit == "m" else timedelta(hours=n) if unit == "h" else timedelta(days=n)
+
+def _next_due(every: str, prev: datetime, now: datetime) -> datetime:
+    """Next occurrence after `now`. Missed occurrences (e.g. while the bot was
+    down) are skipped, not replayed one by one."""
+    step = _interval(every)
+    if step:
+        missed = max(0, int((now - prev) / step))
+        return prev + step * (missed + 1)
+    return _cron_next(every.removeprefix("cron "), now)
+
+def _hhmm(spec: str) -> tuple[int, int]:
+    m = re.fullmatch(r"(\d{1,2}):(\d{2})", spec)
+    if not m or int(m[1]) > 23 or int(m[2]) > 59:
+        raise ValueError(f"{spec!r} is not a time as HH:MM (00:00-23:59)")
+    return int(m[1]), int(m[2])
+
+def _parse_every(args: list[str]) -> tuple[str, int]:
+    """Recurrence from /remind args → (cron or interval spec, args consumed)."""
+    kind = args[0].lower()
+    if kind == "every" and len(args) > 1 and _interval(args[1].lower()):
+        return args[1].lower(), 2
+    if kind == "daily" and len(args) > 1:
+        h, m = _hhmm(args[1])
+        return f"cron {m} {h} * * *", 2
+    if kind == "weekly" and len(args) > 2 and args[1].lower()[:3] in _DOW:
+        h, m = _hhmm(args[2])
+        return f"cron {m} {h} * * {_DOW[args[1].lower()[:3]]}", 3
+    if kind == "cron" and len(args) > 5:
+        spec = " ".join(args[1:6])
+        _cron_next(spec, datetime.utcnow())   # validate
+        return f"cron {spec}", 6
+    raise ValueError(kind)
+
+def _rem_push(rem: dict):
+    heapq.heappush(_rem["heap"], (_epoch(rem["due"]), rem["id"], rem["due"]))
+    _sched_wake()
+
+def _rem_put(rem: dict):
+    def tx(d, ops):
+        d["reminders"] = _with(d.get("reminders"), str(rem["id"]), rem)
+        ops.append(["rem+", rem])
+    _STATE.transact(tx)
+
+def _rem_add(msg: str, due: datetime, every: str | None = None) -> dict:
+    uid = _uid.get()
+    def tx(d, ops):
+        rid = d.get("reminder_seq", 0) + 1
+        rem = {"id": rid, "due": due.isoformat(), "msg": msg}
+        if every:
+            rem["every"] = every
+        if uid and uid != OWNER_ID:
+            rem["uid"] = uid   # delivered to that user; untagged ones go to the owner
+        d["reminder_seq"] = rid
+        d["reminders"] = _with(d.get("reminders"), str(rid), rem)
+        ops += [["set", "reminder_seq", rid], ["rem+", rem]]
+        return rem
+    rem = _STATE.transact(tx)
+    _rem_push(rem)
+    _save_state()
+    return rem
+
+def _rem_mine(rem: Mapping) -> bool:
+    uid = _uid.get()
+    return rem.get("uid") == (None if uid in (None, OWNER_ID) else uid)
+
+def _rem_cancel(rid: int, mine: bool = False) -> Mapping | None:
+    def tx(d, ops):
+        rem = (d.get("reminders") or {}).get(str(rid))
+        if rem and mine and not _rem_mine(rem):
+            return None
+        if rem:
+            d["reminders"] = _without(d["reminders"], str(rid))
+            ops.append(["rem-", rid])
+        return rem
+    rem = _STATE.transact(tx)
+    if rem:
+        _save_state()
+    return rem
+
+def _rem_rebuild():
+    """Load reminders into the heap once at startup (converting the old list
+    format). Anything already past due fires on the loop's first pass."""
+    legacy = _gs("reminders", {})
+    if isinstance(legacy, tuple):
+        _ss("reminders", _PMap())
+        for r in legacy:
+            _rem_add(r["msg"], datetime.fromisoformat(r["due"]), r.get("every"))
+        return
+    heap = _rem["heap"]
+    heap[:] = [(_epoch(r["due"]), r["id"], r["due"]) for r in legacy.values()]   # state is the source of truth
+    heapq.heapify(heap)
+
+def _rem_next() -> float | None:
+    return _rem["heap"][0][0] if _rem["heap"] else None
+
+def _rem_schedule(bot):
+    _rem_rebuild()
+    _schedule("reminders", partial(_rem_fire, bot), when=_rem_next)
+
+async def _rem_fire(bot):
+    heap = _rem["heap"]
+    now = time.time()
+    fired = []
+    reminders = _gs("reminders", {})
+    while heap and heap[0][0] <= now:
+        _, rid, due = heapq.heappop(heap)
+        rem = reminders.get(str(rid))
+        if rem and rem["due"] == due:
+            fired.append(dict(rem))
+    for rem in fired:
+        late = now - _epoch(rem["due"])
+        if rem.get("every"):
+            nxt = _next_due(rem["every"], datetime.fromisoformat(rem["due"]), datetime.utcnow())
+            rem["due"] = nxt.isoformat()
+            _rem_put(rem)
+            heapq.heappush(heap, (_epoch(rem["due"]), rem["id"], rem["due"]))
+        else:
+            _rem_cancel(rem["id"])
+        note = f" _(due {int(late // 60)}m ago)_" if late > 120 else ""
+        _alert(bot, f"⏰ *Reminder:* {rem['msg']}{note}", site="reminder", chat_id=rem.get("uid"))
+    if fired:
+        _save_state()
 
 # ── Background: System monitor ─────────────────────────────────────────────────
 
-_last_alert: dict = {}
-
-async def _sysmon_loop(bot):
-    await asyncio.sleep(120)
-    while True:
-        await asyncio.sleep(300)   # check every 5 min
-        if not _gs("sysmon", True) or not IS_LOCAL:
+# (alert above, re-arm below) over a one-minute average, so a metric hovering
+# around the threshold alerts once instead of flapping.
+_THRESHOLDS = {"cpu": (90, 75), "mem": (90, 80), "disk": (95, 90)}
+_ALERT_TEXT = {"cpu": "🔥 CPU at {}%!", "mem": "🧠 RAM at {}%!", "disk": "💾 Disk " + _DISK_ROOT + " at {}%!"}
+_alarm: dict = {}
+
+async def _sysmon_check(bot):
+    alerts = []
+    for metric, (high, low) in _THRESHOLDS.items():
+        vals = _window(metric, 60)
+        if not vals:
             continue
-        try:
-            info = await asyncio.to_thread(_sysinfo_raw)
-            if not info:
-                continue
-            now = datetime.utcnow()
-            alerts = []
-            if info.get("cpu", 0) > 90:
-                key = "cpu"
-                if (now - _last_alert.get(key, datetime.min)).total_seconds() > 1800:
-                    alerts.append(f"🔥 CPU at {info['cpu']}%!")
-                    _last_alert[key] = now
-            if info.get("mem", 0) > 90:
-                key = "mem"
-                if (now - _last_alert.get(key, datetime.min)).total_seconds() > 1800:
-                    alerts.append(f"🧠 RAM at {info['mem']}%!")
-                    _last_alert[key] = now
-            if info.get("disk", 0) > 95:
-                key = "disk"
-                if (now - _last_alert.get(key, datetime.min)).total_seconds() > 3600:
-                    alerts.append(f"💾 Disk C: at {info['disk']}%!")
-                    _last_alert[key] = now
-            if alerts:
-                await bot.send_message(OWNER_ID, " ".join(alerts))
-        except Exception as e:
-            _log("SYSMON:err", str(e))
+        avg = round(sum(vals) / len(vals), 1)
+        if not _alarm.get(metric) and avg > high:
+            _alarm[metric] = True
+            alerts.append(_ALERT_TEXT[metric].format(avg))
+        elif _alarm.get(metric) and avg < low:
+            _alarm[metric] = False
+    if alerts:
+        _alert(bot, " ".join(alerts), None, site="sysmon")
 
 # ── Background: Idle study agent ───────────────────────────────────────────────
 
 _last_activity = {"time": datetime.utcnow()}
 
-async def _idle_loop(bot):
-    await asyncio.sleep(90)
-    last_collect = datetime.utcnow() - timedelta(hours=1)
-    last_briefing_day = None
-
-    while True:
-        await asyncio.sleep(60)
-        now = datetime.utcnow()
-
-        # Morning briefing
-        briefing_hour = _gs("briefing_hour", 9)
-        if (now.hour == briefing_hour
-                and last_briefing_day != now.date()
-                and OWNER_ID):
-            last_briefing_day = now.date()
-            try:
-                digest = _build_digest(hours=24)
-                await bot.send_message(
-                    OWNER_ID,
-                    f"☀️ *Good morning — Jai briefing*\n\n{digest}",
-                    parse_mode="Markdown",
+# Study runs once the owner has been idle study_idle_minutes, then at most every
+# study_every_minutes while they stay away. The briefing is rendered
+# briefing_prep_minutes ahead (after a study pass, so it includes fresh notes)
+# and delivery at briefing_hour just sends the cached text.
+_STUDY_IDLE = float(CFG.get("study_idle_minutes", 20)) * 60
+_STUDY_EVERY = float(CFG.get("study_every_minutes", 55)) * 60
+_BRIEFING_PREP = int(CFG.get("briefing_prep_minutes", 15))
+_briefing: dict = {"day": None, "text": None}
+
+async def _study_job(bot):
+    now = datetime.utcnow()
+    batch = _stale_topics(now)
+    if not batch:
+        return
+    learned = await _study(batch, now)
+    if not learned:
+        return
+    today_count = await asyncio.to_thread(_kb_count, datetime(now.year, now.month, now.day))
+    if today_count // 3 > (today_count - len(learned)) // 3:
+        await _send(bot, OWNER_ID,
+                    f"🧠 *Jai learned {today_count} things today.*\n"
+                    f"Latest: {', '.join(learned)}\n/digest to read.",
+                    "Markdown", site="idle")
+
+def _briefing_cron(prep: int = 0) -> str:
+    at = (_gs("briefing_hour", 9) * 60 - prep) % 1440
+    return f"{at % 60} {at // 60} * * *"
+
+def _briefing_render() -> str:
+    return f"☀️ *Good morning — Jai briefing*\n\n{_build_digest(hours=24)}"
+
+async def _briefing_prep():
+    now = datetime.utcnow()
+    if _gs("autostudy", True):
+        batch = _stale_topics(now)
+        if batch:
+            await _study(batch, now)
+    day = (now + timedelta(minutes=_BRIEFING_PREP + 1)).date()
+    _briefing.update(day=day, text=await asyncio.to_thread(_briefing_render))
+    _log("BRIEFING:ready", f"{len(_briefing['text'])} chars for {day}")
+
+async def _briefing_send(bot):
+    text = _briefing["text"] if _briefing["day"] == datetime.utcnow().date() else None
+    if text is None:   # prep missed (e.g. started just before the hour)
+        text = await asyncio.to_thread(_briefing_render)
+    _briefing.update(day=None, text=None)
+    await _send(bot, OWNER_ID, text, "Markdown", site="briefing", filename="briefing.txt")
+
+_STUDY_BATCH = int(CFG.get("study_batch", 4))
+_STUDY_STALE = float(CFG.get("study_stale_hours", 24)) * 3600
+
+def _stale_topics(now: datetime) -> list[str]:
+    """Up to study_batch topics not studied within study_stale_hours, oldest first."""
+    studied = _gs("topic_studied", {})
+    cutoff = (now - timedelta(seconds=_STUDY_STALE)).isoformat()
+    stale = [t for t in _gs("topics", ()) if studied.get(t, "") < cutoff]
+    random.shuffle(stale)   # never-studied topics tie on "", don't always pick the same ones
+    stale.sort(key=lambda t: studied.get(t, ""))
+    return stale[:_STUDY_BATCH]
+
+async def _study(topics: list[str], now: datetime) -> list[str]:
+    """Search all topics in one batch, then summarise them in parallel."""
+    results = await _search_many(topics, 4)
+
+    async def one(topic: str, found: list[dict]) -> str | None:
+        if not found:
+            return None
+        ctx = "\n".join(f"- {r.get('title','')}: {r.get('body','')[:150]}" for r in found)
+        try:
+            async with _work_slot(prio=1):
+                summary = await ask_llm_async(
+                    [],
+                    f"Summarise in 2-3 bullets about '{topic}':\n{ctx}",
+                    "You are a research assistant. Give concise factual summaries.",
+                    ttl=_CACHE_TTL_RESEARCH,
                 )
-            except Exception:
-                pass
-
-        # Idle study
-        if not _gs("autostudy", True):
-            continue
-        idle_secs = (now - _last_activity["time"]).total_seconds()
-        if idle_secs < 20 * 60:
-            continue
-        if (now - last_collect).total_seconds() < 55 * 60:
-            continue
+        except _Busy:
+            _log("IDLE:skip", f"topic={topic} work queue full")
+            return None
+        if summary == _LLM_DOWN:
+            return None
+        await asyncio.to_thread(_kb_add, now.isoformat(), topic, summary)
+        return topic
+
+    done = [t for t in await asyncio.gather(*(one(t, r) for t, r in zip(topics, results))) if t]
+    if done:
+        stamp = now.isoformat()
+        keep = set(_gs("topics", ()))
+
+        def mark(m):
+            m = {k: v for k, v in (m or {}).items() if k in keep}
+            m.update((t, stamp) for t in done)
+            return m
+        _supdate("topic_studied", mark, {})
+        _save_state()
+    _log("IDLE:study", f"{len(done)}/{len(topics)} topics", topics=done)
+    return done
 
+def _build_digest(hours: int = 24) -> str:
+    recent = _kb_range(datetime.utcnow() - timedelta(hours=hours))
+    if not recent:
+        return f"Nothing collected in last {hours}h." if _kb_count() else "No knowledge collected yet."
+    lines = [f"📚 {len(recent)} entries (last {hours}h)\n"]
+    for e in recent:
+        lines.append(f"[{e['ts'][11:16]}] *{e['topic']}*\n{e['summary']}\n")
+    return "\n".join(lines)
+
+# ── Telegram: live (streamed) replies ───────────────────────────────────────────
+
+_TG_LIMIT = 4096
+_EDIT_EVERY = float(CFG.get("stream_edit_interval", 1.2))   # Telegram tolerates ~1 edit/s per chat
+_LIVE_TRIES = 3   # attempts for a forced show before falling back to a plain send
+
+def _split_point(text: str, limit: int) -> int:
+    cut = text.rfind("\n", 0, limit)
+    if cut < limit // 2:
+        cut = text.rfind(" ", 0, limit)
+    return cut if cut > 0 else limit
+
+class _LiveReply:
+    """One Telegram message edited in place while a reply streams in.
+
+    Edits are coalesced to at most one per _EDIT_EVERY seconds (a timer flushes
+    whatever arrived in between), RetryAfter pushes the next edit back, and text
+    past 4096 chars is frozen into the current message and continued in a new one.
+    """
+
+    def __init__(self, bot, chat_id: int):
+        self.bot, self.chat_id = bot, chat_id
+        self.msg = None
+        self.text = ""      # body of the current message, including unsent tail
+        self.shown = ""     # what Telegram currently displays
+        self.full = ""
+        self.next_edit = 0.0
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.Task | None = None
+
+    async def feed(self, delta: str):
+        self.full += delta
+        self.text += delta
+        while len(self.text) > _TG_LIMIT:
+            cut = _split_point(self.text, _TG_LIMIT)
+            head, self.text = self.text[:cut], self.text[cut:].lstrip()
+            await self._show(head, force=True)
+            self.msg, self.shown = None, ""
+        await self._show(self.text)
+
+    async def finish(self) -> str:
+        if self._timer:
+            self._timer.cancel()
+        await self._show(self.text, force=True)
+        return self.full.strip()
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        await self._show(self.text)
+
+    async def _show(self, text: str, force: bool = False):
+        """Forced shows (a rolled-over part, the final text) retry after flood
+        waits and errors, then fall back to _send for what never got shown."""
+        async with self._lock:
+            if not text.strip() or text == self.shown:
+                return
+            wait = self.next_edit - time.monotonic()
+            if self.msg is not None and wait > 0:
+                if not force:
+                    if self._timer is None or self._timer.done():
+                        self._timer = asyncio.create_task(self._flush_later(wait))
+                    return
+                await asyncio.sleep(wait)
+            for attempt in range(_LIVE_TRIES if force else 1):
+                if attempt:
+                    await asyncio.sleep(max(1.0, self.next_edit - time.monotonic()))
+                ok = await self._put(text)
+                if ok or ok is None:
+                    return
+            if force:
+                tail = text[len(self.shown):] if self.msg is not None and text.startswith(self.shown) else text
+                msg = await _send(self.bot, self.chat_id, tail, site="live_reply")
+                _log("TG:edit_fallback", f"{len(tail)}c as a new message", ok=msg is not None)
+                if msg is not None:
+                    self.msg, self.shown = self.msg or msg, text
+
+    async def _put(self, text: str) -> bool | None:
+        """True once shown, False to retry, None if a new message may or may
+        not have been posted (a send that timed out) and must not be resent."""
         try:
-            topics = _gs("topics", [])
-            if not topics:
+            await _tg_slot(self.chat_id)
+            if self.msg is None:
+                self.msg = await self.bot.send_message(self.chat_id, text)
+            else:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id,
+                                                 message_id=self.msg.message_id)
+        except Exception as e:
+            if "not modified" in str(e).lower():
+                self.shown = text
+                return True
+            retry = getattr(e, "retry_after", None)
+            if retry:
+                secs = retry.total_seconds() if hasattr(retry, "total_seconds") else float(retry)
+                self.next_edit = time.monotonic() + secs
+            else:
+                _log("TG:edit_err", str(e))
+            _inc("nano_telegram_errors_total", site="live_reply")
+            if (self.msg is None and not retry and type(e).__name__ in ("TimedOut", "NetworkError")
+                    and not _tg_unsent(e)):
+                return None
+            return False
+        self.shown = text
+        self.next_edit = time.monotonic() + _EDIT_EVERY
+        return True
+
+# ── Telegram: outbound queue ────────────────────────────────────────────────────
+
+# Everything the bot sends goes through _send: per-chat and global token
+# buckets sized to Telegram's limits (~1 msg/s per chat, 20/min in groups,
+# ~30/s overall), RetryAfter holds the chat until the flood wait is over, long
+# text is split into numbered chunks and huge text goes out as a file.
+# Background alerts go through _alert and are merged if they land together.
+_TG_RATE = float(CFG.get("tg_rate", 25))               # msgs/sec, whole bot
+_TG_CHAT_RATE = float(CFG.get("tg_chat_rate", 1))      # msgs/sec, one private chat
+_TG_GROUP_RATE = float(CFG.get("tg_group_rate", 20 / 60))
+_TG_FILE_OVER = int(CFG.get("tg_file_over", 12000))    # chars; longer replies become a .txt
+_ALERT_WINDOW = float(CFG.get("alert_window", 3))
+_tg_chats: dict = {}   # chat_id -> {"bucket", "lock"}
+_alerts: dict = {}     # (chat_id, parse_mode) -> {"items": [...], "task"}
+_metric("nano_telegram_sent_total", "counter", "Messages sent through the outbound queue by kind.")
+_metric("nano_telegram_flood_waits_total", "counter", "RetryAfter responses honoured.")
+
+_tg_bucket = _Bucket(_TG_RATE, _TG_RATE)
+
+def _tg_chat(chat_id: int) -> dict:
+    c = _tg_chats.get(chat_id)
+    if c is None:
+        rate = _TG_GROUP_RATE if chat_id < 0 else _TG_CHAT_RATE
+        c = _tg_chats[chat_id] = {"bucket": _Bucket(rate, 3), "lock": asyncio.Lock()}
+    return c
+
+async def _tg_slot(chat_id: int):
+    await _tg_chat(chat_id)["bucket"].take()
+    await _tg_bucket.take()
+
+def _retry_secs(e: Exception) -> float | None:
+    retry = getattr(e, "retry_after", None)
+    if retry is None:
+        return None
+    return retry.total_seconds() if hasattr(retry, "total_seconds") else float(retry)
+
+def _md_split(text: str, limit: int) -> int:
+    """Cut at a paragraph, then a line, then a word; never inside inline markup."""
+    for sep in ("\n\n", "\n"):
+        cut = text.rfind(sep, 0, limit)
+        if cut >= limit // 2:
+            return cut
+    cut = _split_point(text, limit)
+    line = text.rfind("\n", 0, cut) + 1
+    if line > limit // 4 and any(text.count(m, line, cut) % 2 for m in "*_`"):
+        return line
+    return cut
+
+def _chunks(text: str, limit: int = _TG_LIMIT - 16) -> list[str]:
+    """Split for Telegram; a ``` block cut in two is closed and reopened."""
+    parts = []
+    while len(text) > limit:
+        cut = _md_split(text, limit - 8)
+        head, text = text[:cut].rstrip(), text[cut:].lstrip("\n")
+        if head.count("```") % 2:
+            head, text = head + "\n```", "```\n" + text
+        parts.append(head)
+    parts.append(text)
+    if len(parts) > 1:
+        parts = [f"({i}/{len(parts)}) {p}" for i, p in enumerate(parts, 1)]
+    return parts
+
+def _tg_unsent(e: Exception) -> bool:
+    """The request provably never reached Telegram (connect or pool failure)."""
+    return (type(e.__cause__).__name__ in ("ConnectError", "ConnectTimeout", "PoolTimeout")
+            or "pool timeout" in str(e).lower())
+
+async def _tg_call(chat_id: int, fn, site: str, idempotent: bool = False):
+    """One API call under the rate limits; retries flood waits. A timeout or
+    network error is retried only if the call is idempotent or never got
+    sent: a send that timed out has often been delivered already."""
+    for attempt in range(4):
+        await _tg_slot(chat_id)
+        try:
+            return await fn()
+        except Exception as e:
+            secs = _retry_secs(e)
+            if secs is not None and attempt < 3:
+                _inc("nano_telegram_flood_waits_total")
+                _log("TG:flood", f"chat={chat_id} wait {secs:.0f}s", site=site)
+                await asyncio.sleep(secs)
                 continue
-            topic = random.choice(topics)
-            results = await asyncio.to_thread(_search, topic, 4)
-            if not results:
+            if (type(e).__name__ in ("TimedOut", "NetworkError") and attempt < 1
+                    and (idempotent or _tg_unsent(e))):
+                await asyncio.sleep(1)
                 continue
-            ctx = "\n".join(
-                f"- {r.get('title','')}: {r.get('body','')[:150]}" for r in results
-            )
-            summary = await asyncio.to_thread(
-                ask_llm, [],
-                f"Summarise in 2-3 bullets about '{topic}':\n{ctx}",
-                "You are a research assistant. Give concise factual summaries."
-            )
-            key = now.isoformat()
-            with _state_lock:
-                _STATE["knowledge"][key] = {"topic": topic, "summary": summary}
-                kb = _STATE["knowledge"]
-                if len(kb) > 40:
-                    for old in sorted(kb.keys())[:-30]:
-                        del kb[old]
-            _save_state()
-            last_collect = now
-            _log("IDLE:study", f"topic={topic}")
-
-            today_count = sum(
-                1 for k in _gs("knowledge", {}) if k.startswith(now.strftime("%Y-%m-%d"))
-            )
-            if today_count % 3 == 0:
-                await bot.send_message(
-                    OWNER_ID,
-                    f"🧠 *Jai learned {today_count} things today.*\n"
-                    f"Latest: {topic}\n/digest to read.",
-                    parse_mode="Markdown",
-                )
+            raise
+
+async def _send(bot, chat_id: int, text: str, parse_mode: str | None = None,
+                site: str = "send", filename: str = "reply.txt", markup=None):
+    """Send text of any length. Returns the last Message, or None if it failed."""
+    text = text.strip() or "(empty)"
+    c = _tg_chat(chat_id)
+    msg = None
+    async with c["lock"]:   # chunks of one reply stay together
+        try:
+            if len(text) > _TG_FILE_OVER:
+                head = text.split("\n", 1)[0][:200]
+                caption = f"{head}\n({len(text):,} chars, sent as a file)"
+                data = text.encode("utf-8")
+                msg = await _tg_call(chat_id, lambda: bot.send_document(
+                    chat_id, document=data, filename=filename, caption=caption), site)
+                _inc("nano_telegram_sent_total", kind="file")
+                return msg
+            parts = _chunks(text)
+            for i, part in enumerate(parts):
+                mode = parse_mode
+                kb = markup if i == len(parts) - 1 else None   # buttons go under the last chunk
+                try:
+                    msg = await _tg_call(chat_id, lambda: bot.send_message(
+                        chat_id, part, parse_mode=mode, reply_markup=kb), site)
+                except Exception as e:
+                    if not mode or "parse" not in str(e).lower():
+                        raise
+                    # unbalanced markup in model output: send it as plain text
+                    mode = None
+                    msg = await _tg_call(chat_id, lambda: bot.send_message(
+                        chat_id, part, reply_markup=kb), site)
+                _inc("nano_telegram_sent_total", kind="chunk")
         except Exception as e:
-            _log("IDLE:err", str(e))
+            _log("TG:send_err", str(e), site=site, chat=chat_id)
+            _inc("nano_telegram_errors_total", site=site)
+            return None
+    return msg
+
+async def _reply(update, text: str, parse_mode: str | None = None, site: str = "reply", **kw):
+    """_send to the chat an update came from."""
+    return await _send(update.get_bot(), update.effective_chat.id, text, parse_mode, site=site, **kw)
+
+def _alert(bot, text: str, parse_mode: str | None = "Markdown", site: str = "alert",
+           chat_id: int | None = None):
+    """Send a background notification. The first one goes out at once; any that
+    follow within alert_window are merged into a single message after it."""
+    chat_id = chat_id or OWNER_ID
+    if not chat_id:
+        return
+    key = (chat_id, parse_mode)
+    a = _alerts.get(key)
+    if a is None:
+        a = _alerts[key] = {"items": [], "sites": set()}
+        a["task"] = asyncio.create_task(_alert_flush(bot, key, text, site))
+        return
+    a["items"].append(text)
+    a["sites"].add(site)
+
+async def _alert_flush(bot, key: tuple, first: str, site: str):
+    await _send(bot, key[0], first, key[1], site=site)
+    await asyncio.sleep(_ALERT_WINDOW)
+    a = _alerts.pop(key)
+    items = a["items"]
+    if not items:
+        return
+    if len(items) == 1:
+        text = items[0]
+    else:
+        head = f"🔔 *{len(items)} alerts*" if key[1] else f"🔔 {len(items)} alerts"
+        text = head + "\n\n" + "\n".join(items)
+        _log("TG:coalesced", f"{len(items)} alerts", sites=sorted(a["sites"]))
+    await _send(bot, key[0], text, key[1], site="+".join(sorted(a["sites"])))
+
+# ── Jobs: async /run ───────────────────────────────────────────────────────────
+
+# /run starts a subprocess job that streams into a live-edited message; once
+# output outgrows one message the rest is kept and attached as a file at exit.
+_JOB_TIMEOUT = float(CFG.get("job_timeout", 600))
+_JOB_MAX = int(CFG.get("job_max", 3))               # concurrent jobs
+_JOB_LIVE_CHARS = int(CFG.get("job_live_chars", 3500))
+_JOB_MAX_BYTES = int(CFG.get("job_max_bytes", 5_000_000))
+_JOB_KEEP = int(CFG.get("job_keep", 20))            # finished jobs listed by /jobs
+_JOBS: dict = {}   # id -> {"id", "cmd", "status", "rc", "started", "ended", "out", "proc", "task", "truncated"}
+_job_seq = {"n": 0}
+_metric("nano_jobs_running", "gauge", "Shell jobs running.",
+        lambda: sum(j["status"] == "running" for j in _JOBS.values()))
+
+async def _job_kill(proc):
+    if proc.returncode is not None:
+        return
+    try:
+        if platform.system() == "Windows":   # shell=True: kill cmd.exe and its children
+            tk = await asyncio.create_subprocess_exec(
+                "taskkill", "/T", "/F", "/PID", str(proc.pid),
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            await asyncio.wait_for(tk.wait(), 10)
+        else:
+            os.killpg(proc.pid, 9)
+    except Exception:
+        proc.kill()
+
+async def _job_start(bot, chat_id: int, cmd: str, timeout: float) -> dict:
+    _job_seq["n"] += 1
+    job = {"id": _job_seq["n"], "cmd": cmd, "status": "running", "rc": None,
+           "started": time.time(), "ended": None, "out": bytearray(), "truncated": False}
+    job["proc"] = await asyncio.create_subprocess_shell(
+        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        stdin=asyncio.subprocess.DEVNULL, start_new_session=platform.system() != "Windows",
+    )
+    _JOBS[job["id"]] = job
+    job["task"] = asyncio.create_task(_job_run(bot, chat_id, job, timeout))
+    _log("JOB:start", f"#{job['id']} {cmd[:80]}", pid=job["proc"].pid)
+    return job
+
+async def _job_run(bot, chat_id: int, job: dict, timeout: float):
+    import codecs
+    import locale
+    proc = job["proc"]
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False) or "utf-8")("replace")
+    live = _LiveReply(bot, chat_id)
+    await live.feed(f"▶️ #{job['id']} $ {job['cmd']}\n")
+    shown = 0
+
+    async def pump():
+        nonlocal shown
+        while chunk := await proc.stdout.read(4096):
+            if len(job["out"]) < _JOB_MAX_BYTES:
+                job["out"] += chunk[:_JOB_MAX_BYTES - len(job["out"])]
+            else:
+                job["truncated"] = True
+            text = decoder.decode(chunk)
+            if shown < _JOB_LIVE_CHARS:
+                part = text[:_JOB_LIVE_CHARS - shown]
+                shown += len(part)
+                await live.feed(part)
+                if shown >= _JOB_LIVE_CHARS:
+                    await live.feed("\n… (full output attached when done)")
+        return await proc.wait()
 
-def _build_digest(hours: int = 24) -> str:
-    kb = _gs("knowledge", {})
-    if not kb:
-        return "No knowledge collected yet."
-    cutoff = datetime.utcnow() - timedelta(hours=hours)
-    recent = {k: v for k, v in kb.items() if datetime.fromisoformat(k) >= cutoff}
-    if not recent:
-        return f"Nothing collected in last {hours}h."
-    lines = [f"📚 {len(recent)} entries (last {hours}h)\n"]
-    for ts, e in sorted(recent.items()):
-        t = datetime.fromisoformat(ts).strftime("%H:%M")
-        lines.append(f"[{t}] *{e['topic']}*\n{e['summary']}\n")
-    return "\n".join(lines)[:3800]
+    try:
+        job["rc"] = await asyncio.wait_for(pump(), timeout)
+        job["status"] = "done" if job["rc"] == 0 else "failed"
+    except asyncio.TimeoutError:
+        job["status"] = "timeout"
+    except asyncio.CancelledError:
+        job["status"] = "cancelled"
+    finally:
+        await _job_kill(proc)
+        job["ended"] = time.time()
+    if proc.returncode is None:
+        try:
+            await asyncio.wait_for(proc.wait(), 5)
+        except Exception:
+            pass
+    secs = job["ended"] - job["started"]
+    icon = {"done": "✅", "failed": "❌", "timeout": "⏱️", "cancelled": "🛑"}[job["status"]]
+    rc = f" rc={job['rc']}" if job["rc"] is not None else ""
+    summary = f"{icon} #{job['id']} {job['status']}{rc} · {secs:.1f}s"
+    if not shown:
+        await live.feed("(no output)")
+    await live.feed(f"\n{summary}")
+    await live.finish()
+    if shown >= _JOB_LIVE_CHARS:
+        await _job_send_log(bot, chat_id, job, summary)
+    _log("JOB:end", f"#{job['id']} {job['status']}{rc}", secs=round(secs, 1), bytes=len(job["out"]))
+    _job_prune()
+
+async def _job_send_log(bot, chat_id: int, job: dict, caption: str):
+    data = bytes(job["out"]) + (b"\n... (output truncated)\n" if job["truncated"] else b"")
+    try:
+        await _tg_call(chat_id, lambda: bot.send_document(
+            chat_id, document=data, filename=f"job-{job['id']}.log", caption=caption), "job_log")
+    except Exception as e:
+        _log("JOB:send_err", str(e))
+        _inc("nano_telegram_errors_total", site="job_log")
+
+def _job_prune():
+    done = [j for j in _JOBS.values() if j["status"] != "running"]
+    for j in sorted(done, key=lambda j: j["id"])[:-_JOB_KEEP or None]:
+        del _JOBS[j["id"]]
+
+def _job_line(j: dict) -> str:
+    secs = (j["ended"] or time.time()) - j["started"]
+    rc = f" rc={j['rc']}" if j["rc"] is not None else ""
+    return f"#{j['id']} {j['status']}{rc} · {secs:.0f}s · {j['cmd'][:60]}"
 
 # ── Command handlers ────────────────────────────────────────────────────────────
 
-@owner_only
+_MEMBER_HELP = (
+    "⚡ Jai — just talk to me naturally.\n\n"
+    "/search <query> · /plan <goal>\n"
+    "/remind <Xm|Xh|daily HH:MM> <msg> · /remind list\n"
+    "/recall <query> · /digest\n"
+    "/clear — reset chat history · /stream on|off"
+)
+
+@member_only
 async def cmd_start(update, _ctx):
+    if update.effective_user.id != OWNER_ID:
+        await _reply(update, _MEMBER_HELP)
+        return
     env = "🖥️ Local PC" if IS_LOCAL else "☁️ Cloud"
-    await update.message.reply_text(
+    await _reply(
+        update,
         f"⚡ *Jai online* — {env}\n\n"
         "Just talk to me naturally.\n\n"
         "🖥️ PC: /ss /run /open /kill /ls /sysinfo\n"
-        "🧠 Brain: /digest /topics /sync /autostudy\n"
+        "🧠 Brain: /digest /recall /topics /sync /autostudy\n"
         "🔍 Search: /search <query>\n"
         "📋 Plan: /plan <goal>\n"
-        "⏰ Reminders: /remind <Xm|Xh> <msg>\n"
+        "⏰ Reminders: /remind <Xm|Xh|daily HH:MM> <msg>\n"
         "📊 Monitor: /sysmon on|off\n"
-        "⚙️ Other: /status /clear /help",
-        parse_mode="Markdown",
+        "⚙️ Other: /status /logs /clear /stream /help",
+        "Markdown",
     )
 
-@owner_only
+@member_only
 async def cmd_help(update, _ctx):
-    await update.message.reply_text(
+    if update.effective_user.id != OWNER_ID:
+        await _reply(update, _MEMBER_HELP)
+        return
+    await _reply(
+        update,
         "*Jai — Command Reference*\n\n"
         "💬 *AI*\n"
         "  Just type anything — I'm listening\n"
         "  /clear — reset chat history\n"
-        "  /status — system status\n\n"
+        "  /stream on|off — live-typed replies\n"
+        "  /status — system status\n"
+        "  /logs [n] [tag] — tail nano.log\n\n"
         "🖥️ *PC Control (local only)*\n"
-        "  /ss — screenshot\n"
-        "  /run <cmd> — shell command\n"
+        "  /ss [n|all] [x y w h] [full] — screenshot\n"
+        "  /run [-t secs] <cmd> — start a shell job\n"
+        "  /jobs · /job <id> [log] · /cancel <id>\n"
         "  /open <app|url> — launch\n"
         "  /kill <process.exe> — kill\n"
-        "  /ls [path] — list directory\n"
-        "  /sysinfo — CPU / RAM / disk\n\n"
+        "  /ls [path] — browse files (paged)\n"
+        "  /find <glob|text> — search file index\n"
+        "  /sysinfo [history] — CPU / RAM / disk\n\n"
         "🔍 *Research*\n"
         "  /search <query> — web search + AI summary\n"
         "  /plan <goal> — break down a goal\n\n"
         "🧠 *Knowledge*\n"
         "  /digest — today's learning\n"
+        "  /recall <query> — search everything learned\n"
         "  /topics — manage study topics\n"
         "  /autostudy on|off\n"
-        "  /sync — save brain\n\n"
+        "  /sync [full] — save brain to this chat (full = new snapshot)\n\n"
         "⏰ *Reminders*\n"
         "  /remind 30m check email\n"
-        "  /remind 2h meeting\n\n"
+        "  /remind 2h meeting\n"
+        "  /remind daily 08:30 standup\n"
+        "  /remind weekly mon 09:00 report\n"
+        "  /remind list · /remind cancel <id>\n\n"
         "📊 *Monitor*\n"
         "  /sysmon on|off — system health alerts",
-        parse_mode="Markdown",
+        "Markdown",
     )
 
 @owner_only
@@ -529,8 +3195,8 @@ async def cmd_status(update, _ctx):
     grok_ok = bool(CFG.get("grok_api_key", "").strip("YOUR_"))
     uptime = str(datetime.utcnow() - START_TIME).split(".")[0]
     env = "🖥️ Local" if IS_LOCAL else "☁️ Cloud"
-    kb = len(_gs("knowledge", {}))
-    reminders = len(_gs("reminders", []))
+    kb = await asyncio.to_thread(_kb_count)
+    reminders = len(_gs("reminders", {}))
     sysmon = _gs("sysmon", True)
     study = _gs("autostudy", True)
     lines = [
@@ -544,177 +3210,353 @@ async def cmd_status(update, _ctx):
         f"Auto-study:   {'on' if study else 'off'}",
         f"Sysmon:       {'on' if sysmon else 'off'}",
     ]
-    if IS_LOCAL:
-        info = await asyncio.to_thread(_sysinfo_raw)
-        if info:
-            lines.append(f"CPU: {info.get('cpu')}%  RAM: {info.get('mem')}%  Disk: {info.get('disk')}%")
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
-
-@owner_only
+    lines.append(
+        f"LLM cache:    {_cache_stats['hit']} hit · {_cache_stats['miss']} miss · "
+        f"{_cache_stats['shared']} shared · {len(_CACHE)} kept"
+    )
+    lines.append(f"Search cache: {_search_stats['hit']} hit · {_search_stats['miss']} miss · {len(_SEARCH_CACHE)} kept")
+    man = _sync["manifest"]
+    if _sync["pending"]:
+        lines.append("Sync:         ⚠️ restore from Telegram pending, not pushing")
+    elif man:
+        lines.append(f"Sync:         snapshot + {len(man['deltas'])} deltas · {man['at'][11:16]} UTC")
+    if _rag["index"]:
+        lines.append(f"Retrieval:    {_rag['index'].n} docs · {len(_rag['index'].post)} terms")
+    if len(ALLOWED_IDS) > 1:
+        lines.append(f"Users:        {len(_shards)} loaded · {len(ALLOWED_IDS)} allowed")
+    lines.append(f"Work queue:   {_WORK.workers - _WORK.free}/{_WORK.workers} busy · {len(_WORK.waiters)} waiting")
+    health = _llm_health_lines()
+    if health:
+        lines += ["LLM health:"] + health
+    info = _sysinfo_raw()
+    if info:
+        lines.append(f"CPU: {info.get('cpu')}%  RAM: {info.get('mem')}%  Disk: {info.get('disk')}%")
+    await _reply(update, "\n".join(lines), "Markdown")
+
+@member_only
 async def cmd_clear(update, _ctx):
-    _ss("history", [])
-    await update.message.reply_text("🧹 Chat history cleared.")
+    _ss("history", ())
+    _ss("history_summary", "")
+    await _reply(update, "🧹 Chat history cleared.")
 
 @owner_only
 async def cmd_sync(update, ctx):
-    await update.message.reply_text("💾 Syncing…")
-    await _push_to_telegram(ctx.bot)
-    await update.message.reply_text("✅ Brain synced.")
+    full = bool(ctx.args) and ctx.args[0].lower() == "full"
+    await _reply(update, "💾 Syncing…")
+    result = await _push_to_telegram(ctx.bot, full)
+    if result.startswith("failed"):
+        await _reply(update, f"❌ Sync {result}")
+    elif result == "unchanged":
+        await _reply(update, "✅ Already in sync.")
+    else:
+        await _reply(update, f"✅ Brain synced ({result}).")
 
 @owner_only
-async def cmd_ss(update, _ctx):
+async def cmd_ss(update, ctx):
     if not IS_LOCAL:
-        await update.message.reply_text(_cloud_only())
+        await _reply(update, _cloud_only())
+        return
+    args = [a.lower() for a in ctx.args or []]
+    loop = asyncio.get_running_loop()
+    if args[:1] == ["list"]:
+        mons = await loop.run_in_executor(_ss_pool, _monitors)
+        lines = [f"{i}: {m['width']}x{m['height']} @ {m['left']},{m['top']}" + (" (all)" if i == 0 else "")
+                 for i, m in enumerate(mons)]
+        await _reply(update, "🖥️ Monitors:\n" + "\n".join(lines))
+        return
+    full = "full" in args
+    nums = [a for a in args if a not in ("full", "all")]
+    monitor = 0 if "all" in args else 1
+    if len(nums) in (1, 5) and nums[0].isdigit():
+        monitor = int(nums.pop(0))
+    region = None
+    if len(nums) == 4 and all(n.isdigit() for n in nums):
+        region = tuple(int(n) for n in nums)
+    elif nums:
+        await _reply(update, "Usage: /ss [n|all] [x y w h] [full]  ·  /ss list")
         return
-    await update.message.reply_text("📸 Capturing…")
-    data = await asyncio.to_thread(_screenshot)
-    if data:
-        await update.message.reply_photo(photo=io.BytesIO(data), caption="📸 Screenshot")
+    shot = await loop.run_in_executor(_ss_pool, partial(_screenshot, monitor, region, full))
+    if not shot:
+        await _reply(update, "❌ Screenshot failed — try /run powershell Get-Process")
+        return
+    data, ext = shot
+    if full:
+        await _tg_call(update.effective_chat.id, lambda: update.message.reply_document(
+            document=data, filename=f"screenshot.{ext}", caption="📸 Screenshot (full resolution)"), "ss")
     else:
-        await update.message.reply_text("❌ Screenshot failed — try /run powershell Get-Process")
+        await _tg_call(update.effective_chat.id, lambda: update.message.reply_photo(
+            photo=data, caption="📸 Screenshot"), "ss")
 
 @owner_only
 async def cmd_run(update, ctx):
-    if not ctx.args:
-        await update.message.reply_text("Usage: /run <command>")
+    if not IS_LOCAL:
+        await _reply(update, _cloud_only())
+        return
+    args = list(ctx.args or [])
+    timeout = _JOB_TIMEOUT
+    if len(args) > 2 and args[0] == "-t" and args[1].isdigit():
+        timeout, args = float(args[1]), args[2:]
+    if not args:
+        await _reply(update, "Usage: /run [-t secs] <command>")
+        return
+    cmd = " ".join(args)
+    if _is_blocked(cmd):
+        await _reply(update, "❌ Blocked by security policy.")
+        return
+    if sum(j["status"] == "running" for j in _JOBS.values()) >= _JOB_MAX:
+        await _reply(update, f"🚦 {_JOB_MAX} jobs already running — /jobs, /cancel <id>")
+        return
+    try:
+        await _job_start(ctx.bot, update.effective_chat.id, cmd, timeout)
+    except Exception as e:
+        await _reply(update, f"Error: {e}")
+
+@owner_only
+async def cmd_jobs(update, _ctx):
+    now = time.time()
+    lines = ["⏱️ Scheduled:"] + [_sched_line(j, now) for j in _SCHED.values()] if _SCHED else []
+    if _JOBS:
+        jobs = sorted(_JOBS.values(), key=lambda j: (j["status"] != "running", -j["id"]))
+        lines += ["", "🖥️ /run jobs:"] + [_job_line(j) for j in jobs]
+    else:
+        lines += ["", "No /run jobs yet. /run <cmd> starts one."]
+    await _reply(update, "\n".join(lines).strip())
+
+@owner_only
+async def cmd_job(update, ctx):
+    job = _JOBS.get(int(ctx.args[0])) if ctx.args and ctx.args[0].isdigit() else None
+    if job is None:
+        await _reply(update, "Usage: /job <id> [log]  (see /jobs)")
+        return
+    if len(ctx.args) > 1 and ctx.args[1].lower() == "log":
+        await _job_send_log(ctx.bot, update.effective_chat.id, job, _job_line(job))
         return
-    cmd = " ".join(ctx.args)
-    out = await asyncio.to_thread(_shell, cmd)
-    await update.message.reply_text(f"```\n{out}\n```", parse_mode="Markdown")
+    tail = bytes(job["out"][-3000:]).decode("utf-8", "replace").strip()
+    await _reply(update, f"{_job_line(job)}\n\n{tail or '(no output yet)'}")
+
+@owner_only
+async def cmd_cancel(update, ctx):
+    job = _JOBS.get(int(ctx.args[0])) if ctx.args and ctx.args[0].isdigit() else None
+    if job is None or job["status"] != "running":
+        await _reply(update, "Usage: /cancel <id> of a running job (see /jobs)")
+        return
+    job["task"].cancel()
+    await _reply(update, f"🛑 Cancelling #{job['id']}…")
 
 @owner_only
 async def cmd_open(update, ctx):
     if not IS_LOCAL:
-        await update.message.reply_text(_cloud_only())
+        await _reply(update, _cloud_only())
         return
     if not ctx.args:
-        await update.message.reply_text("Usage: /open <app or URL>")
+        await _reply(update, "Usage: /open <app or URL>")
         return
     target = " ".join(ctx.args)
     if _is_blocked(target):
-        await update.message.reply_text("❌ Blocked.")
+        await _reply(update, "❌ Blocked.")
         return
     await asyncio.to_thread(_shell, f'start "" "{target}"')
-    await update.message.reply_text(f"🚀 Launched: {target}")
+    await _reply(update, f"🚀 Launched: {target}")
 
 @owner_only
 async def cmd_kill(update, ctx):
     if not IS_LOCAL:
-        await update.message.reply_text(_cloud_only())
+        await _reply(update, _cloud_only())
         return
     if not ctx.args:
-        await update.message.reply_text("Usage: /kill <process.exe>")
+        await _reply(update, "Usage: /kill <process.exe>")
         return
     name = ctx.args[0]
     if not re.match(r'^[\w\-\.]+\.(exe|bat|cmd)$', name, re.I):
-        await update.message.reply_text("❌ Invalid process name.")
+        await _reply(update, "❌ Invalid process name.")
         return
     out = await asyncio.to_thread(_shell, f"taskkill /F /IM {name}")
-    await update.message.reply_text(out[:1000])
+    await _send(ctx.bot, update.effective_chat.id, out, site="kill")
 
 @owner_only
 async def cmd_ls(update, ctx):
     if not IS_LOCAL:
-        await update.message.reply_text(_cloud_only())
+        await _reply(update, _cloud_only())
+        return
+    p = _ls_resolve(" ".join(ctx.args) if ctx.args else None)
+    if p is None:
+        await _reply(update, f"❌ Access denied outside {_FILES_ROOT.name}.")
         return
-    base = Path("C:/Users/VM-openclaw/EliteBook")
-    p = base
-    if ctx.args:
-        candidate = Path(" ".join(ctx.args))
-        if not candidate.is_absolute():
-            candidate = base / candidate
-        if not str(candidate.resolve()).startswith(str(base.resolve())):
-            await update.message.reply_text("❌ Access denied outside EliteBook.")
-            return
-        p = candidate
     try:
-        entries = sorted(p.iterdir(), key=lambda x: (x.is_file(), x.name.lower()))
-        lines = [f"{'📁' if e.is_dir() else '📄'} {e.name}" for e in entries[:50]]
-        await update.message.reply_text(f"`{p}`\n" + "\n".join(lines), parse_mode="Markdown")
+        text, kb = await asyncio.to_thread(_ls_render, p, 0)
+        await _reply(update, text, markup=kb, site="ls")
     except Exception as e:
-        await update.message.reply_text(f"Error: {e}")
+        await _reply(update, f"Error: {e}")
 
 @owner_only
-async def cmd_sysinfo(update, _ctx):
+async def cb_ls(update, _ctx):
+    q = update.callback_query
+    _, tok, page = q.data.split(":")
+    p = _ls_tokens.get(tok)
+    if p is None:
+        await q.answer("Listing expired — run /ls again.")
+        return
+    await q.answer()
+    try:
+        text, kb = await asyncio.to_thread(_ls_render, p, int(page))
+        await q.edit_message_text(text, reply_markup=kb)
+    except Exception as e:
+        if "not modified" not in str(e).lower():
+            await q.edit_message_text(f"Error: {e}")
+
+@owner_only
+async def cmd_find(update, ctx):
     if not IS_LOCAL:
-        await update.message.reply_text(_cloud_only())
-        return
-    await update.message.reply_text("📊 Checking…")
-    ps = (
-        'powershell -NoProfile -c "'
-        'Write-Output \"OS: $((Get-CimInstance Win32_OperatingSystem).Caption)\";'
-        'Write-Output \"CPU: $((Get-CimInstance Win32_Processor).Name)\";'
-        '$cpu=[math]::Round((Get-CimInstance Win32_Processor).LoadPercentage,1);'
-        'Write-Output \"CPU Load: $cpu%\";'
-        '$os=Get-CimInstance Win32_OperatingSystem;'
-        '$mem=[math]::Round(($os.TotalVisibleMemorySize-$os.FreePhysicalMemory)/1MB,1);'
-        '$total=[math]::Round($os.TotalVisibleMemorySize/1MB,1);'
-        'Write-Output \"RAM: $mem GB / $total GB\";'
-        '$disk=Get-PSDrive C|Select-Object Used,Free;'
-        '$u=[math]::Round($disk.Used/1GB,1);$f=[math]::Round($disk.Free/1GB,1);'
-        'Write-Output \"Disk C: $u GB used, $f GB free\""'
-    )
-    out = await asyncio.to_thread(_shell, ps, timeout=15)
-    await update.message.reply_text(f"```\n{out}\n```", parse_mode="Markdown")
+        await _reply(update, _cloud_only())
+        return
+    if not ctx.args:
+        await _reply(update, "Usage: /find <glob|text>   e.g. /find *.pdf · /find invoice")
+        return
+    if not _INDEX["at"]:
+        await _reply(update, "🗂️ Building file index…", site="find")
+        await asyncio.to_thread(_index_refresh)
+    hits, total = _find(" ".join(ctx.args))
+    if not total:
+        await _reply(update, "No matches.")
+        return
+    age = int(time.time() - _INDEX["at"])
+    lines = [f"🔎 {total} match{'es' if total != 1 else ''} (index {age}s old)", ""]
+    lines += [f"📄 {rel}  · {_human(size)} · {datetime.fromtimestamp(mtime):%Y-%m-%d}" for rel, size, mtime in hits]
+    if total > len(hits):
+        lines.append(f"… {total - len(hits)} more — narrow the pattern")
+    await _reply(update, "\n".join(lines), site="find", filename="find.txt")
 
 @owner_only
+async def cmd_sysinfo(update, ctx):
+    if not _SAMPLES:
+        await _reply(update, "📊 No samples yet — try again in a few seconds.")
+        return
+    gb = 1024 ** 3
+    if ctx.args and ctx.args[0].lower() == "history":
+        span = (_SAMPLES[-1]["ts"] - _SAMPLES[0]["ts"]) / 60
+        lines = [f"Last {span:.0f} min ({len(_SAMPLES)} samples)", "        min    avg    max"]
+        for metric, label in (("cpu", "CPU "), ("mem", "RAM "), ("disk", "Disk")):
+            vals = _window(metric, 3600)
+            if vals:
+                lines.append(f"{label}  {min(vals):5.1f}  {sum(vals) / len(vals):5.1f}  {max(vals):5.1f}")
+        await _reply(update, "```\n" + "\n".join(lines) + "\n```", "Markdown")
+        return
+    s = _SAMPLES[-1]
+    lines = [
+        f"OS: {platform.platform()}",
+        f"CPU: {platform.processor() or platform.machine()} ({os.cpu_count()} cores)",
+        f"CPU Load: {s.get('cpu')}%",
+    ]
+    if s.get("mem_total"):
+        lines.append(f"RAM: {s['mem_used'] / gb:.1f} GB / {s['mem_total'] / gb:.1f} GB")
+    lines.append(f"Disk {_DISK_ROOT}: {s['disk_used'] / gb:.1f} GB used, {s['disk_free'] / gb:.1f} GB free")
+    await _reply(update, "```\n" + "\n".join(lines) + "\n```", "Markdown")
+
+@member_only
 async def cmd_search(update, ctx):
     if not ctx.args:
-        await update.message.reply_text("Usage: /search <query>")
+        await _reply(update, "Usage: /search <query>")
         return
     query = " ".join(ctx.args)
-    await update.message.reply_text(f"🔍 Searching: {query}…")
-    results = await asyncio.to_thread(_search, query, 5)
-    if not results:
-        await update.message.reply_text("No results found.")
+    if await _over_quota(update, "search"):
+        return
+    await _reply(update, f"🔍 Searching: {query}…", site="search")
+    try:
+        async with _work_slot(update):
+            results = await _search_async(query, 5)
+            if not results:
+                await _reply(update, "No results found.")
+                return
+            ctx_text = "\n".join(
+                f"- {r.get('title','')}: {r.get('body','')[:200]}" for r in results
+            )
+            summary = await ask_llm_async(
+                [],
+                f"Summarise these search results for '{query}' in 3-4 concise points:\n{ctx_text}",
+                "You are a research assistant. Summarise clearly and concisely.",
+                ttl=_CACHE_TTL_RESEARCH,
+            )
+    except _Busy:
+        await _reply(update, _BUSY_MSG)
         return
-    ctx_text = "\n".join(
-        f"- {r.get('title','')}: {r.get('body','')[:200]}" for r in results
-    )
-    summary = await asyncio.to_thread(
-        ask_llm, [],
-        f"Summarise these search results for '{query}' in 3-4 concise points:\n{ctx_text}",
-        "You are a research assistant. Summarise clearly and concisely."
-    )
     sources = "\n".join(f"• {r.get('href','')}" for r in results[:3] if r.get("href"))
-    await update.message.reply_text(f"*{query}*\n\n{summary}\n\nSources:\n{sources}", parse_mode="Markdown")
+    await _send(ctx.bot, update.effective_chat.id, f"*{query}*\n\n{summary}\n\nSources:\n{sources}",
+                "Markdown", site="search")
 
-@owner_only
+@member_only
 async def cmd_plan(update, ctx):
     if not ctx.args:
-        await update.message.reply_text("Usage: /plan <goal or task>")
+        await _reply(update, "Usage: /plan <goal or task>")
         return
     goal = " ".join(ctx.args)
-    await update.message.reply_text(f"📋 Planning: {goal}…")
-    plan = await asyncio.to_thread(
-        ask_llm, [],
-        f"Break down this goal into clear numbered steps (max 8). Be specific and actionable:\n{goal}",
-        "You are a smart AI assistant. Create a practical step-by-step plan. Be specific."
-    )
-    await update.message.reply_text(f"📋 *Plan: {goal}*\n\n{plan}", parse_mode="Markdown")
+    if await _over_quota(update, "llm"):
+        return
+    await _reply(update, f"📋 Planning: {goal}…")
+    try:
+        async with _work_slot(update):
+            plan = await ask_llm_async(
+                [],
+                f"Break down this goal into clear numbered steps (max 8). Be specific and actionable:\n{goal}",
+                "You are a smart AI assistant. Create a practical step-by-step plan. Be specific.",
+                ttl=_CACHE_TTL_RESEARCH,
+            )
+    except _Busy:
+        await _reply(update, _BUSY_MSG)
+        return
+    await _send(ctx.bot, update.effective_chat.id, f"📋 *Plan: {goal}*\n\n{plan}", "Markdown",
+                site="plan", filename="plan.txt")
 
-@owner_only
+@member_only
 async def cmd_remind(update, ctx):
-    if len(ctx.args) < 2:
-        await update.message.reply_text("Usage: /remind <Xm|Xh|Xd> <message>\nExample: /remind 30m check email")
+    usage = (
+        "Usage: /remind <Xm|Xh|Xd> <message>\n"
+        "  /remind every <Xm|Xh|Xd> <message>\n"
+        "  /remind daily HH:MM <message>\n"
+        "  /remind weekly mon HH:MM <message>\n"
+        "  /remind cron <m h dom mon dow> <message>\n"
+        "  /remind list · /remind cancel <id>\n"
+        "Example: /remind 30m check email (times are UTC)"
+    )
+    args = ctx.args or []
+    if args[:1] == ["list"]:
+        mine = (r for r in _gs("reminders", {}).values() if _rem_mine(r))
+        pending = heapq.nsmallest(20, mine, key=lambda r: r["due"])
+        if not pending:
+            await _reply(update, "No reminders pending.")
+            return
+        lines = [f"#{r['id']} {r['due'][:16].replace('T', ' ')}"
+                 f"{' ↻ ' + r['every'].removeprefix('cron ') if r.get('every') else ''} — {r['msg']}"
+                 for r in pending]
+        await _reply(update, "⏰ Pending (UTC):\n" + "\n".join(lines))
         return
-    time_str = ctx.args[0].lower()
-    msg = " ".join(ctx.args[1:])
-    m = re.match(r'^(\d+)(m|h|d)$', time_str)
-    if not m:
-        await update.message.reply_text("Time format: 30m, 2h, 1d")
+    if args[:1] == ["cancel"] and len(args) == 2 and args[1].lstrip("#").isdigit():
+        rem = _rem_cancel(int(args[1].lstrip("#")), mine=True)
+        await _reply(update, f"🗑️ Cancelled: {rem['msg']}" if rem else "No such reminder.")
         return
-    n, unit = int(m.group(1)), m.group(2)
-    delta = timedelta(minutes=n if unit == "m" else 0,
-                      hours=n if unit == "h" else 0,
-                      days=n if unit == "d" else 0)
-    due = (datetime.utcnow() + delta).isoformat()
-    reminders = _gs("reminders", [])
-    reminders.append({"due": due, "msg": msg})
-    _ss("reminders", reminders)
-    _save_state()
-    when = (datetime.utcnow() + delta).strftime("%H:%M UTC")
-    await update.message.reply_text(f"⏰ Reminder set for {when}: {msg}")
+    if len(args) < 2:
+        await _reply(update, usage)
+        return
+    now = datetime.utcnow()
+    every = None
+    delta = _interval(args[0].lower())
+    if delta:
+        due, msg = now + delta, " ".join(args[1:])
+    else:
+        try:
+            every, used = _parse_every(args)
+            step = _interval(every)
+            due = now + step if step else _cron_next(every.removeprefix("cron "), now)
+        except ValueError:
+            await _reply(update, usage)
+            return
+        msg = " ".join(args[used:])
+        if not msg:
+            await _reply(update, usage)
+            return
+    rem = _rem_add(msg, due, every)
+    when = due.strftime("%a %H:%M UTC" if due - now > timedelta(hours=20) else "%H:%M UTC")
+    repeat = f" (repeats {every.removeprefix('cron ')})" if every else ""
+    await _reply(update, f"⏰ Reminder #{rem['id']} set for {when}{repeat}: {msg}")
 
 @owner_only
 async def cmd_sysmon(update, ctx):
@@ -722,12 +3564,13 @@ async def cmd_sysmon(update, ctx):
         on = ctx.args[0].lower() in ("on", "1", "true")
         _ss("sysmon", on)
         _save_state()
-        await update.message.reply_text(f"System monitor {'enabled ✅' if on else 'disabled ❌'}")
+        _sched_wake()
+        await _reply(update, f"System monitor {'enabled ✅' if on else 'disabled ❌'}")
     else:
         on = _gs("sysmon", True)
-        await update.message.reply_text(f"System monitor: {'on ✅' if on else 'off ❌'}")
+        await _reply(update, f"System monitor: {'on ✅' if on else 'off ❌'}")
 
-@owner_only
+@member_only
 async def cmd_digest(update, ctx):
     hours = 24
     if ctx.args:
@@ -735,8 +3578,25 @@ async def cmd_digest(update, ctx):
             hours = int(ctx.args[0])
         except ValueError:
             pass
-    digest = _build_digest(hours)
-    await update.message.reply_text(digest, parse_mode="Markdown")
+    digest = await asyncio.to_thread(_build_digest, hours)
+    await _send(ctx.bot, update.effective_chat.id, digest, "Markdown",
+                site="digest", filename="digest.txt")
+
+@member_only
+async def cmd_recall(update, ctx):
+    if not ctx.args:
+        await _reply(update, "Usage: /recall <query>")
+        return
+    query = " ".join(ctx.args)
+    hits = await asyncio.to_thread(_kb_search, query, 5)
+    if not hits:
+        await _reply(update, f"Nothing learned about '{query}' yet.")
+        return
+    lines = [f"🔎 *Recall: {query}*\n"]
+    for e in hits:
+        lines.append(f"[{e['ts'][:16].replace('T', ' ')}] *{e['topic']}*\n{e['summary']}\n")
+    await _send(ctx.bot, update.effective_chat.id, "\n".join(lines), "Markdown",
+                site="recall", filename="recall.txt")
 
 @owner_only
 async def cmd_topics(update, ctx):
@@ -746,20 +3606,19 @@ async def cmd_topics(update, ctx):
         if action == "add" and len(ctx.args) > 1:
             t = " ".join(ctx.args[1:])
             if t not in topics:
-                topics.append(t)
-                _ss("topics", topics)
+                _supdate("topics", lambda ts: ts if t in ts else (*ts, t), ())
                 _save_state()
-            await update.message.reply_text(f"✅ Added: {t}")
+            await _reply(update, f"✅ Added: {t}")
             return
         elif action == "remove" and len(ctx.args) > 1:
             t = " ".join(ctx.args[1:])
             _ss("topics", [x for x in topics if x != t])
             _save_state()
-            await update.message.reply_text(f"🗑️ Removed: {t}")
+            await _reply(update, f"🗑️ Removed: {t}")
             return
     msg = "*Study topics:*\n" + "\n".join(f"• {t}" for t in topics)
     msg += "\n\n/topics add <topic>\n/topics remove <topic>"
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await _reply(update, msg, "Markdown")
 
 @owner_only
 async def cmd_autostudy(update, ctx):
@@ -767,56 +3626,262 @@ async def cmd_autostudy(update, ctx):
         on = ctx.args[0].lower() in ("on", "1", "true")
         _ss("autostudy", on)
         _save_state()
-        await update.message.reply_text(f"Auto-study {'enabled ✅' if on else 'disabled ❌'}")
+        _sched_wake()
+        await _reply(update, f"Auto-study {'enabled ✅' if on else 'disabled ❌'}")
     else:
         on = _gs("autostudy", True)
-        await update.message.reply_text(f"Auto-study: {'on ✅' if on else 'off ❌'}")
+        await _reply(update, f"Auto-study: {'on ✅' if on else 'off ❌'}")
+
+@member_only
+async def cmd_stream(update, ctx):
+    if ctx.args:
+        on = ctx.args[0].lower() in ("on", "1", "true")
+        _ss("stream", on)
+        _save_state()
+        await _reply(update, f"Streaming replies {'enabled ✅' if on else 'disabled ❌'}")
+    else:
+        on = _gs("stream", True)
+        await _reply(update, f"Streaming replies: {'on ✅' if on else 'off ❌'}")
 
 @owner_only
-async def handle_message(update, _ctx):
+async def cmd_logs(update, ctx):
+    n, tag = 20, None
+    for a in ctx.args or []:
+        if a.isdigit():
+            n = min(int(a), 200)
+        else:
+            tag = a
+    await asyncio.to_thread(_log_flush, 0.5)
+    lines = await asyncio.to_thread(_log_tail, n, tag)
+    if not lines:
+        await _reply(update, "No matching log lines.")
+        return
+    body = "\n".join(lines)[-3500:]
+    await _reply(update, f"```\n{body}\n```", "Markdown")
+
+# Messages from one chat are handled in order (they share `history`); a newer
+# message cancels the previous one if it is still queued or generating.
+_SUPERSEDE = bool(CFG.get("supersede", True))
+_chat_locks: dict = {}
+_chat_jobs: dict = {}
+
+@member_only
+async def handle_message(update, ctx):
     _last_activity["time"] = datetime.utcnow()
     text = (update.message.text or "").strip()
-    if not text:
-        return
-    history = _gs("history", [])
-    reply = await asyncio.to_thread(ask_llm, history, text)
-    history = history[-10:]
-    history.append({"role": "user", "content": text})
-    history.append({"role": "assistant", "content": reply})
-    _ss("history", history[-12:])
+    if not text or await _over_quota(update, "llm"):
+        return
+    chat = update.effective_chat.id
+    prev = _chat_jobs.get(chat)
+    if _SUPERSEDE and prev and not prev.done():
+        prev.cancel()
+    job = _chat_jobs[chat] = asyncio.create_task(_chat_turn(update, ctx, text))
+    try:
+        await job
+    except asyncio.CancelledError:
+        if not job.cancelled():
+            raise
+        _log("CHAT:superseded", f"chat={chat}")
+    except _Busy:
+        await _reply(update, _BUSY_MSG)
+    finally:
+        if _chat_jobs.get(chat) is job:
+            del _chat_jobs[chat]
+
+async def _chat_turn(update, ctx, text: str):
+    lock = _chat_locks.setdefault(update.effective_chat.id, asyncio.Lock())
+    async with lock, _work_slot(update):
+        history = _gs("history", ())
+        stream = _gs("stream", True)
+        system = await asyncio.to_thread(_rag_system, text)   # FTS fallback hits SQLite
+        if stream:
+            live = _LiveReply(ctx.bot, update.effective_chat.id)
+            try:
+                async for delta in ask_llm_stream(history, text, system):
+                    await live.feed(delta)
+            except asyncio.CancelledError:
+                await live.feed(" …(superseded)")
+                await live.finish()
+                raise
+            reply = await live.finish()
+        else:
+            reply = await ask_llm_async(history, text, system)
+        _remember({"role": "user", "content": text}, {"role": "assistant", "content": reply})
     _save_state()
-    await update.message.reply_text(reply[:4000])
+    if not stream:
+        await _send(ctx.bot, update.effective_chat.id, reply, site="chat")
 
 # ── Flask keep-alive ────────────────────────────────────────────────────────────
 
+# In cloud mode the same server also receives Telegram updates on
+# webhook_path. Telegram echoes webhook_secret back in a header, which is the
+# only thing separating real updates from anyone who finds the URL.
+_WEBHOOK_PATH = CFG.get("webhook_path", "/telegram")
+_WEBHOOK_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+_hook: dict = {"app": None, "loop": None}
+
+def _cfg_str(key: str) -> str:
+    """A string setting, with secrets.example.json's YOUR_* placeholders read as unset."""
+    v = CFG.get(key) or ""
+    return v if _usable_key(v) else ""
+
+def _webhook_url() -> str:
+    base = _cfg_str("webhook_url") or os.getenv("WEBHOOK_URL", "")
+    if not base:
+        domain = os.getenv("RAILWAY_PUBLIC_DOMAIN") or os.getenv("REPLIT_DEV_DOMAIN")
+        base = f"https://{domain}" if domain else ""
+    return base.rstrip("/") + _WEBHOOK_PATH if base else ""
+
+def _webhook_secret() -> str:
+    s = _cfg_str("webhook_secret") or os.getenv("WEBHOOK_SECRET", "")
+    if not s:  # stable across restarts without extra config; [A-Za-z0-9_-] only
+        s = hashlib.sha256(f"nano-webhook:{CFG.get('telegram_bot_token', '')}".encode()).hexdigest()
+    return s
+
 def _start_flask():
+    # Flask is imported on its own thread so it never delays boot.
+    threading.Thread(target=_serve_flask, name="nano-http", daemon=True).start()
+
+def _serve_flask():
     try:
-        from flask import Flask
+        from flask import Flask, request
         app = Flask(__name__)
+        secret = _webhook_secret().encode()
 
         @app.route("/")
         def health():
             return f"Jai alive — {datetime.utcnow().strftime('%H:%M UTC')}", 200
 
+        @app.route("/metrics")
+        def metrics():
+            want = _cfg_str("metrics_token") or os.getenv("METRICS_TOKEN", "")
+            got = request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if want and not hmac.compare_digest(got.encode(), want.encode()):
+                return "forbidden", 403
+            return _metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+        @app.route(_WEBHOOK_PATH, methods=["POST"])
+        def webhook():
+            got = request.headers.get(_WEBHOOK_HEADER, "").encode()
+            if not hmac.compare_digest(got, secret):
+                _log("HOOK:deny", request.remote_addr or "")
+                return "forbidden", 403
+            tg, loop = _hook["app"], _hook["loop"]
+            if tg is None:
+                return "starting", 503   # Telegram retries non-2xx
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                return "bad update", 400
+            from telegram import Update
+            asyncio.run_coroutine_threadsafe(tg.update_queue.put(Update.de_json(data, tg.bot)), loop)
+            return "", 200
+
         port = int(os.getenv("PORT", 8080))
-        threading.Thread(
-            target=lambda: app.run(host="0.0.0.0", port=port, use_reloader=False),
-            daemon=True,
-        ).start()
         _log("FLASK", f"port {port}")
+        _boot_mark("http")
+        app.run(host="0.0.0.0", port=port, use_reloader=False, threaded=True)
     except Exception as e:
         _log("FLASK:err", str(e))
 
 # ── Boot ───────────────────────────────────────────────────────────────────────
 
+# Boot does only what polling needs (Bot API handshake + state load, run
+# together); heavy imports, provider TLS handshakes and the "online" message
+# happen in the background. BOOT:timing logs when each step finished.
+_boot: dict = {}
+
+def _boot_mark(step: str):
+    _boot[step] = round((time.perf_counter() - _BOOT_T0) * 1000)
+
+def _sched_setup(bot):
+    _sample()   # prime the CPU counters
+    _schedule("sampler", _sample_tick, every=_SAMPLE_SECS, delay=1)
+    _rem_schedule(bot)
+    _schedule("sysmon", partial(_sysmon_check, bot), every=30, delay=60, jitter=2,
+              enabled=lambda: _gs("sysmon", True))
+    _schedule("study", partial(_study_job, bot), idle=_STUDY_IDLE, every=_STUDY_EVERY, delay=90,
+              enabled=lambda: _gs("autostudy", True))
+    _schedule("briefing-prep", _briefing_prep, cron=lambda: _briefing_cron(_BRIEFING_PREP),
+              enabled=lambda: bool(OWNER_ID))
+    _schedule("briefing", partial(_briefing_send, bot), cron=_briefing_cron,
+              enabled=lambda: bool(OWNER_ID))
+    if IS_LOCAL:
+        _schedule("files-index", partial(asyncio.to_thread, _index_refresh), every=_INDEX_EVERY)
+    if _SYNC_EVERY:
+        _schedule("sync", partial(_push_to_telegram, bot), every=_SYNC_EVERY, delay=_SYNC_EVERY,
+                  jitter=30)
+
+def _warm_imports():
+    import importlib
+    mods = ["httpx", "openai", "duckduckgo_search", "numpy"] + (["mss", "PIL.Image"] if IS_LOCAL else [])
+    for mod in mods:
+        try:
+            importlib.import_module(mod)
+        except Exception as e:
+            _log("BOOT:import_err", f"{mod}: {e}")
+    _boot_mark("imports")
+
+async def _warm_providers():
+    """Open a pooled connection to each provider with a cheap models.list call.
+    Rejected keys open the breaker now instead of on the first user message;
+    any other HTTP answer still means the connection is warm."""
+    await asyncio.to_thread(_warm_imports)
+
+    async def probe(p: dict):
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(_client(p).models.list(), 10)
+            ok = True
+        except Exception as e:
+            ok = getattr(e, "status_code", None) not in (401, 403) and hasattr(e, "status_code")
+            if not ok:
+                _record(p["name"], False, None, e)
+        _log(f"LLM:{p['name']}", f"warm {'ok' if ok else 'failed'}", ms=round((time.monotonic() - t0) * 1000))
+    await asyncio.gather(*(probe(p) for p in _providers()))
+    _boot_mark("providers")
+
+async def _notify_online(bot):
+    if not OWNER_ID:
+        return
+    env = "🖥️ Local" if IS_LOCAL else "☁️ Cloud"
+    await _send(bot, OWNER_ID,
+                f"⚡ *Jai is online* — {env}\n"
+                f"Gemini {'✅' if CFG.get('gemini_api_key','').strip('YOUR_') else '❌'}  "
+                f"Grok {'✅' if CFG.get('grok_api_key','').strip('YOUR_') else '❌'}\n"
+                f"Type anything or /help",
+                "Markdown", site="notify")
+
+async def _boot_report():
+    # background steps usually finish within a few seconds of going live
+    for _ in range(30):
+        if {"imports", "providers"} <= _boot.keys():
+            break
+        await asyncio.sleep(1)
+    _log("BOOT:timing", f"live in {_boot.get('live')}ms", **dict(sorted(_boot.items(), key=lambda kv: kv[1])))
+
 async def _run(token: str):
     """Explicit async main — avoids post_init hook reliability issues."""
-    from telegram.ext import Application, CommandHandler, MessageHandler, filters
-
-    if IS_CLOUD or os.getenv("PORT"):
+    _boot_mark("main")
+    flask_up = IS_CLOUD or bool(os.getenv("PORT"))
+    if flask_up:
         _start_flask()
+    asyncio.create_task(_warm_providers())
 
-    app = Application.builder().token(token).build()
+    def load():
+        _load_state()
+        _boot_mark("state")
+    # submitted now, so it overlaps the (blocking) telegram import below
+    loading = asyncio.get_running_loop().run_in_executor(None, load)
+
+    from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+    _boot_mark("telegram_import")
+
+    # Updates are processed concurrently so quick commands never wait behind an
+    # LLM call; chat turns are serialised per chat in handle_message instead.
+    builder = Application.builder().token(token).concurrent_updates(int(CFG.get("concurrent_updates", 64)))
+    if CFG.get("telegram_base_url"):   # e.g. a local Bot API server or stand-in
+        builder = builder.base_url(CFG["telegram_base_url"])
+    app = builder.build()
 
     for name, fn in [
         ("start", cmd_start), ("help", cmd_help), ("status", cmd_status),
@@ -826,39 +3891,61 @@ async def _run(token: str):
         ("search", cmd_search), ("plan", cmd_plan),
         ("remind", cmd_remind), ("sysmon", cmd_sysmon),
         ("digest", cmd_digest), ("topics", cmd_topics), ("autostudy", cmd_autostudy),
+        ("stream", cmd_stream), ("recall", cmd_recall), ("logs", cmd_logs),
+        ("jobs", cmd_jobs), ("job", cmd_job), ("cancel", cmd_cancel), ("find", cmd_find),
     ]:
         app.add_handler(CommandHandler(name, fn))
+    app.add_handler(CallbackQueryHandler(cb_ls, pattern=r"^ls:"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    async with app:
-        _load_state()
+    async def init():
+        await app.initialize()
+        _boot_mark("telegram_init")
+    await asyncio.gather(init(), loading)
+    if _sync["fresh"]:
+        await _sync_restore(app.bot)   # before the loops read reminders
+        if _sync["pending"]:
+            asyncio.create_task(_sync_recover(app.bot))
+    else:
+        asyncio.create_task(_sync_restore(app.bot))   # only sets the delta baseline
+    _boot_mark("sync_restore")
+
+    async with app:   # already initialised; this only arranges shutdown
         _log("BOT:init", f"local={IS_LOCAL} cloud={IS_CLOUD}")
 
         # Background tasks
-        asyncio.create_task(_idle_loop(app.bot))
-        asyncio.create_task(_reminder_loop(app.bot))
-        asyncio.create_task(_sysmon_loop(app.bot))
+        _sched_setup(app.bot)
+        asyncio.create_task(_sched_main())
+        asyncio.get_running_loop().run_in_executor(None, _rag_build)
 
-        # Startup notification to owner
-        if OWNER_ID:
+        await app.start()
+        url = _webhook_url() if flask_up else ""
+        if url:
             try:
-                env = "🖥️ Local" if IS_LOCAL else "☁️ Cloud"
-                await app.bot.send_message(
-                    OWNER_ID,
-                    f"⚡ *Jai is online* — {env}\n"
-                    f"Gemini {'✅' if CFG.get('gemini_api_key','').strip('YOUR_') else '❌'}  "
-                    f"Grok {'✅' if CFG.get('grok_api_key','').strip('YOUR_') else '❌'}\n"
-                    f"Type anything or /help",
-                    parse_mode="Markdown",
-                )
+                _hook["app"], _hook["loop"] = app, asyncio.get_running_loop()
+                await app.bot.set_webhook(url, secret_token=_webhook_secret(),
+                                          drop_pending_updates=True)
+                _log("BOT:start", f"webhook {url}")
             except Exception as e:
-                _log("NOTIFY:err", str(e))
-
-        await app.updater.start_polling(drop_pending_updates=True)
-        _log("BOT:start", "polling active")
-        await app.start()
-        # Keep running until signal
-        await asyncio.Event().wait()
+                _hook["app"] = url = None
+                _log("HOOK:err", f"{e} — falling back to polling")
+        if not url:
+            # start_polling clears any webhook left over from a cloud deploy
+            await app.updater.start_polling(drop_pending_updates=True)
+            _log("BOT:start", "polling active")
+        _boot_mark("live")
+
+        asyncio.create_task(_notify_online(app.bot))
+        asyncio.create_task(_boot_report())
+        # Keep running until signal; stopping the updater first matters, its
+        # polling task shrugs off plain cancellation and would hang the exit.
+        try:
+            await asyncio.Event().wait()
+        finally:
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
 
 def main():
     token = CFG.get("telegram_bot_token", "")
@@ -868,6 +3955,9 @@ def main():
         asyncio.run(_run(token))
     except KeyboardInterrupt:
         _log("BOT:stop", "interrupted")
+    finally:
+        _persist_flush(compact=True)
+        _log_flush()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,84 @@
+"""
+fake_telegram_sender.py — replay Telegram updates against nano.py's webhook.
+
+Posts recorded updates (a JSON list, or one JSON object per line) to the
+webhook endpoint the way Telegram does, secret header included. Without a
+file it sends a single text message from --user.
+
+  python scripts/fake_telegram_sender.py --url http://127.0.0.1:8080/telegram \\
+      --secret <webhook_secret> --text "hello"
+  python scripts/fake_telegram_sender.py --url ... --secret ... updates.jsonl --rate 20
+"""
+
+import argparse
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+
+HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        raw = f.read().strip()
+    if raw.startswith("["):
+        return json.loads(raw)
+    return [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+
+def text_update(update_id: int, user: int, text: str) -> dict:
+    msg = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user, "type": "private"},
+        "from": {"id": user, "is_bot": False, "first_name": "Fake"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        cmd = text.split()[0]
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(cmd)}]
+    return {"update_id": update_id, "message": msg}
+
+
+def post(url: str, secret: str, update: dict) -> tuple[int, float]:
+    req = urllib.request.Request(
+        url, data=json.dumps(update).encode(), method="POST",
+        headers={"Content-Type": "application/json", HEADER: secret},
+    )
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=10) as r:
+            status = r.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, (time.perf_counter() - t0) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("file", nargs="?", help="recorded updates (.json list or .jsonl)")
+    ap.add_argument("--url", default="http://127.0.0.1:8080/telegram")
+    ap.add_argument("--secret", required=True)
+    ap.add_argument("--user", type=int, default=123456789, help="sender id for --text")
+    ap.add_argument("--text", default="/status")
+    ap.add_argument("--rate", type=float, default=0, help="updates per second (0 = as fast as possible)")
+    args = ap.parse_args()
+
+    updates = load_updates(args.file) if args.file else [
+        text_update(int(time.time()), args.user, args.text)]
+    gap = 1 / args.rate if args.rate > 0 else 0
+    bad = 0
+    for u in updates:
+        status, ms = post(args.url, args.secret, u)
+        bad += status != 200
+        print(f"update {u.get('update_id')}: {status} in {ms:.1f} ms")
+        if gap:
+            time.sleep(gap)
+    print(f"sent {len(updates)}, non-200: {bad}")
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+nano_bench.py — offline benchmark for nano.py.
+
+Runs the real handlers and background loops against local stand-ins: a fake
+Telegram Bot API, a fake OpenAI-compatible endpoint (latency, jitter, error
+rate, streaming) and a fake web search. Nothing leaves the machine; state,
+knowledge and logs go to a temp directory. Results are printed as JSON.
+
+  python scripts/nano_bench.py --chats 8 --messages 20 --out before.json
+  python scripts/nano_bench.py --quick --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+OWNER = 4242
+TOKEN = "123456:bench"
+
+# ── Stand-in servers ───────────────────────────────────────────────────────────
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def _serve(handler) -> tuple[_Server, int]:
+    srv = _Server(("127.0.0.1", 0), handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, srv.server_address[1]
+
+
+class FakeTelegram(BaseHTTPRequestHandler):
+    """Answers any Bot API method with a plausible result and counts calls."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True   # headers and body go out separately
+    calls: dict = {}
+    sent: list = []   # (time, chat_id, text)
+    lock = threading.Lock()
+    ids = iter(range(1, 1 << 62))
+
+    def log_message(self, *a):
+        pass
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        ctype = self.headers.get("Content-Type", "")
+        params: dict = {}
+        if "json" in ctype:
+            params = json.loads(raw or b"{}")
+        elif "urlencoded" in ctype:
+            params = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+        else:   # multipart (documents/photos): only chat_id matters here
+            m = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', raw)
+            params = {"chat_id": m.group(1).decode()} if m else {}
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            mid = next(self.ids)
+            if "text" in params:
+                self.sent.append((time.time(), params.get("chat_id"), params["text"]))
+        chat = {"id": int(params.get("chat_id") or OWNER), "type": "private"}
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Jai", "username": "jai_bench_bot"}
+        elif method.startswith(("send", "edit", "copy", "forward")):
+            result = {"message_id": int(params.get("message_id") or mid), "date": int(time.time()),
+                      "chat": chat, "text": params.get("text", "")}
+        elif method == "getChat":
+            result = chat
+        elif method == "getUpdates":   # lets a full bot run poll against this server
+            time.sleep(min(float(params.get("timeout") or 0), 1.0))
+            result = []
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeLLM(BaseHTTPRequestHandler):
+    """OpenAI-compatible /<provider>/v1/chat/completions with tunable behaviour."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    conf = {"latency": 0.2, "jitter": 0.05, "error_rate": 0.0, "chunks": 8, "chunk_delay": 0.02}
+    calls: dict = {}
+    lock = threading.Lock()
+
+    def log_message(self, *a):
+        pass
+
+    def _json(self, status: int, obj: dict):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._json(200, {"object": "list", "data": [{"id": "bench", "object": "model"}]})
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        name = self.path.split("/")[1]
+        c = self.conf
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        time.sleep(max(0.0, random.gauss(c["latency"], c["jitter"])))
+        if random.random() < c["error_rate"]:
+            return self._json(503, {"error": {"message": "bench: injected failure"}})
+        prompt = req["messages"][-1]["content"]
+        text = f"Bench reply to: {prompt[:80]}. " + "Lorem ipsum dolor sit amet. " * 4
+        if not req.get("stream"):
+            return self._json(200, {
+                "id": "b", "object": "chat.completion", "created": 0, "model": req["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            })
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(s: str):
+            b = s.encode()
+            self.wfile.write(f"{len(b):x}\r\n".encode() + b + b"\r\n")
+            self.wfile.flush()
+        step = max(1, len(text) // c["chunks"])
+        for i in range(0, len(text), step):
+            delta = {"id": "b", "object": "chat.completion.chunk", "created": 0, "model": req["model"],
+                     "choices": [{"index": 0, "delta": {"content": text[i:i + step]}, "finish_reason": None}]}
+            chunk(f"data: {json.dumps(delta)}\n\n")
+            time.sleep(c["chunk_delay"])
+        chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+# ── Helpers ────────────────────────────────────────────────────────────────────
+
+
+def _pct(xs: list[float], q: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(q / 100 * (len(xs) - 1))))]
+
+
+def _summary(ms: list[float], errors: int = 0) -> dict:
+    return {"n": len(ms), "errors": errors,
+            "mean_ms": round(sum(ms) / len(ms), 2) if ms else 0.0,
+            "p50_ms": round(_pct(ms, 50), 2), "p95_ms": round(_pct(ms, 95), 2),
+            "p99_ms": round(_pct(ms, 99), 2), "max_ms": round(max(ms, default=0.0), 2)}
+
+
+def _rss_mb() -> float | None:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024   # peak, KB on Linux
+    except Exception:
+        return None
+
+
+def _update(nano, bot, chat: int, text: str, uid: int = OWNER):
+    from telegram import Update
+    msg = {"message_id": random.randint(1, 1 << 30), "date": int(time.time()),
+           "chat": {"id": chat, "type": "private"},
+           "from": {"id": uid, "is_bot": False, "first_name": "Bench"}, "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": random.randint(1, 1 << 30), "message": msg}, bot)
+
+
+def _isolate(nano, tmp: Path, tg_port: int, llm_port: int):
+    nano.OWNER_ID = OWNER
+    nano.ALLOWED_IDS.add(OWNER)
+    nano._LOG_FILE = tmp / "nano.log"
+    nano._STATE_FILE = tmp / "state.json"
+    nano._JOURNAL_FILE = tmp / "state.journal"
+    nano._CACHE_FILE = tmp / "llm_cache.json"
+    nano._KB_FILE = tmp / "knowledge.db"
+    nano._USERS_DIR = tmp / "users"
+    nano._QWEN_CREDS = tmp / "no-qwen-creds.json"
+    nano.CFG.update({
+        "telegram_bot_token": TOKEN,
+        "telegram_base_url": f"http://127.0.0.1:{tg_port}/bot",
+        "gemini_api_key": "bench", "grok_api_key": "bench",
+        "llm_base_urls": {n: f"http://127.0.0.1:{llm_port}/{n}/v1" for n in ("qwen", "gemini", "grok")},
+    })
+
+    def fake_search(query: str, n: int = 5) -> list[dict]:
+        time.sleep(max(0.0, random.gauss(0.3, 0.05)))
+        return [{"title": f"{query} #{i}", "body": "Bench result body. " * 5,
+                 "href": f"https://example.com/{abs(hash(query)) % 10**6}/{i}"} for i in range(n)]
+    nano._search = fake_search
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "-C", str(ROOT), "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+# ── Scenarios ──────────────────────────────────────────────────────────────────
+
+
+async def bench_handlers(nano, bot, args) -> dict:
+    """N chats send M messages each, concurrently; every message also mixes in
+    a quick command so head-of-line blocking shows up in its latency."""
+    lat: dict = {k: [] for k in ("chat", "status", "search")}
+    errs = {k: 0 for k in lat}
+
+    async def timed(kind: str, fn, update, ctx):
+        t0 = time.perf_counter()
+        try:
+            await fn(update, ctx)
+        except Exception:
+            errs[kind] += 1
+        lat[kind].append((time.perf_counter() - t0) * 1000)
+
+    async def chat(cid: int):
+        for i in range(args.messages):
+            text = f"chat {cid} message {i}: summarise something for me"
+            ctx = SimpleNamespace(bot=bot, args=[])
+            jobs = [timed("chat", nano.handle_message, _update(nano, bot, cid, text), ctx)]
+            if i % 5 == 0:
+                jobs.append(timed("status", nano.cmd_status, _update(nano, bot, cid, "/status"), ctx))
+            if i % 10 == 0:
+                q = f"topic {cid}-{i}"
+                jobs.append(timed("search", nano.cmd_search, _update(nano, bot, cid, f"/search {q}"),
+                                  SimpleNamespace(bot=bot, args=q.split())))
+            await asyncio.gather(*jobs)
+            await asyncio.sleep(random.uniform(0, args.think))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(chat(1000 + c) for c in range(args.chats)))
+    wall = time.perf_counter() - t0
+    done = sum(len(v) for v in lat.values())
+    busy = sum(1 for _, _, t in FakeTelegram.sent if "Too many requests" in str(t))
+    return {
+        "latency": {k: _summary(v, errs[k]) for k, v in lat.items()},
+        "throughput": {"chats": args.chats, "updates": done, "wall_s": round(wall, 2),
+                       "updates_per_s": round(done / wall, 2) if wall else 0.0, "busy_replies": busy},
+    }
+
+
+async def bench_reminders(nano, bot, count: int) -> dict:
+    """Fire `count` reminders due in one second; measure delivery lag.
+    Reminders that fire together arrive merged, so count them inside messages."""
+    due = nano.datetime.utcnow() + nano.timedelta(seconds=1)
+    target = time.time() + 1
+    for i in range(count):
+        nano._rem_add(f"bench-rem-{i}", due)
+    start = len(FakeTelegram.sent)
+    nano._rem_schedule(bot)
+    deadline = time.time() + 10 + count / 50
+    while time.time() < deadline:
+        got = sum(str(s[2]).count("bench-rem-") for s in FakeTelegram.sent[start:])
+        if got >= count:
+            break
+        await asyncio.sleep(0.05)
+    nano._SCHED.pop("reminders", None)
+    msgs = [(t, str(text)) for t, _, text in FakeTelegram.sent[start:] if "bench-rem-" in str(text)]
+    lags = [(t - target) * 1000 for t, text in msgs for _ in range(text.count("bench-rem-"))]
+    return {"count": count, "delivered": len(lags), "messages": len(msgs), **_summary(lags)}
+
+
+async def bench_state(nano, bot, sizes: list[int]) -> list[dict]:
+    """Grow the knowledge base and time inserts, a full compaction and a sync."""
+    out, have = [], nano._kb_count()
+    for size in sizes:
+        adds = []
+        for i in range(have, size):
+            t0 = time.perf_counter()
+            nano._kb_add(nano.datetime.utcnow().isoformat(), f"topic {i % 40}",
+                         f"- bench fact {i} about things\n- another detail {i}")
+            adds.append((time.perf_counter() - t0) * 1000)
+        have = max(have, size)
+        for i in range(20):
+            nano._ss("bench_counter", i)
+        t0 = time.perf_counter()
+        nano._persist_flush()
+        journal_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        nano._persist_flush(compact=True)
+        compact_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        await nano._push_to_telegram(bot)
+        sync_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        nano._kb_search("bench things", 10)
+        search_ms = (time.perf_counter() - t0) * 1000
+        out.append({
+            "kb_entries": nano._kb_count(), "kb_add": _summary(adds[-500:]),
+            "journal_flush_ms": round(journal_ms, 2), "compact_ms": round(compact_ms, 2),
+            "sync_ms": round(sync_ms, 2), "kb_search_ms": round(search_ms, 2),
+            "state_bytes": nano._STATE_FILE.stat().st_size if nano._STATE_FILE.exists() else 0,
+            "kb_bytes": nano._KB_FILE.stat().st_size if nano._KB_FILE.exists() else 0,
+        })
+    return out
+
+
+async def _memory_sampler(series: list, every: float):
+    t0 = time.monotonic()
+    while True:
+        rss = _rss_mb()
+        if rss is not None:
+            series.append([round(time.monotonic() - t0, 1), round(rss, 1)])
+        await asyncio.sleep(every)
+
+
+async def run(args) -> dict:
+    tmp = Path(tempfile.mkdtemp(prefix="nano-bench-"))
+    tg, tg_port = _serve(FakeTelegram)
+    llm, llm_port = _serve(FakeLLM)
+    FakeLLM.conf.update(latency=args.llm_latency / 1000, jitter=args.llm_jitter / 1000,
+                        error_rate=args.llm_error_rate, chunks=args.llm_chunks)
+
+    import nano
+    _isolate(nano, tmp, tg_port, llm_port)
+    from telegram import Bot
+    bot = Bot(TOKEN, base_url=nano.CFG["telegram_base_url"])
+    await bot.initialize()
+    nano._load_state()
+    await nano._sync_restore(bot)   # nothing pinned on the fake server: clears restore-pending
+    nano._ss("stream", args.stream)
+
+    memory: list = []
+    mem_task = asyncio.create_task(_memory_sampler(memory, 0.5))
+    nano._sample()
+    nano._schedule("sampler", nano._sample_tick, every=nano._SAMPLE_SECS, delay=1)
+    sched = asyncio.create_task(nano._sched_main())
+    t0 = time.perf_counter()
+    result = {
+        "meta": {"rev": _git_rev(), "python": platform.python_version(), "platform": platform.platform(),
+                 "time": nano.datetime.utcnow().isoformat(timespec="seconds") + "Z"},
+        "config": {k: getattr(args, k) for k in
+                   ("chats", "messages", "stream", "llm_latency", "llm_jitter", "llm_error_rate",
+                    "llm_chunks", "reminders", "kb_sizes")},
+    }
+    result.update(await bench_handlers(nano, bot, args))
+    result["reminders"] = await bench_reminders(nano, bot, args.reminders)
+    result["state"] = await bench_state(nano, bot, args.kb_sizes)
+    sched.cancel()
+    mem_task.cancel()
+    rss = [m[1] for m in memory]
+    result["memory"] = {"start_mb": rss[0] if rss else None, "end_mb": rss[-1] if rss else None,
+                        "peak_mb": max(rss, default=None), "series": memory}
+    result["calls"] = {"telegram": dict(FakeTelegram.calls), "llm": dict(FakeLLM.calls),
+                       "llm_cache": {k: nano._cache_stats[k] for k in ("hit", "miss", "shared")}}
+    result["wall_s"] = round(time.perf_counter() - t0, 2)
+
+    await bot.shutdown()
+    nano._log_flush()
+    tg.shutdown()
+    llm.shutdown()
+    return result
+
+
+def compare(new: dict, old: dict) -> list[str]:
+    """p95 / throughput deltas between two result files."""
+    lines = []
+    for k, v in new.get("latency", {}).items():
+        before = old.get("latency", {}).get(k, {}).get("p95_ms")
+        if before:
+            lines.append(f"{k:8} p95 {before:9.1f} → {v['p95_ms']:9.1f} ms ({v['p95_ms'] / before - 1:+.0%})")
+    a = old.get("throughput", {}).get("updates_per_s")
+    b = new.get("throughput", {}).get("updates_per_s")
+    if a and b:
+        lines.append(f"throughput {a:.1f} → {b:.1f} updates/s ({b / a - 1:+.0%})")
+    return lines
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--chats", type=int, default=8)
+    ap.add_argument("--messages", type=int, default=20, help="messages per chat")
+    ap.add_argument("--think", type=float, default=0.05, help="max pause between a chat's messages (s)")
+    ap.add_argument("--stream", action="store_true", help="stream chat replies via message edits")
+    ap.add_argument("--llm-latency", type=float, default=200, help="mean LLM latency (ms)")
+    ap.add_argument("--llm-jitter", type=float, default=50, help="LLM latency stddev (ms)")
+    ap.add_argument("--llm-error-rate", type=float, default=0.0)
+    ap.add_argument("--llm-chunks", type=int, default=8, help="chunks per streamed reply")
+    ap.add_argument("--reminders", type=int, default=200)
+    ap.add_argument("--kb-sizes", type=lambda s: [int(x) for x in s.split(",")], default=[1000, 5000, 20000])
+    ap.add_argument("--quick", action="store_true", help="small run for a smoke check")
+    ap.add_argument("--out", help="write JSON here as well as stdout")
+    ap.add_argument("--compare", help="earlier result JSON to diff against (printed to stderr)")
+    args = ap.parse_args()
+    if args.quick:
+        args.chats, args.messages, args.reminders, args.kb_sizes = 4, 5, 50, [500, 2000]
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+    if args.compare:
+        for line in compare(result, json.loads(Path(args.compare).read_text(encoding="utf-8"))):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()